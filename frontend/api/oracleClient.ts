@@ -6,20 +6,104 @@ export type OracleResponse = {
   latency_ms?: number;
 };
 
+type ModelReply = {
+  probs: { yes: number; no: number };
+  model_version?: string;
+};
+
 const DEFAULT_BASE_URL = "https://lucky-ai-api-664189756248.europe-west1.run.app";
 
-export async function askOracle(
-  question: string,
-  opts?: { baseUrl?: string }
-): Promise<OracleResponse> {
-  const startTime = performance.now();
+// Longer than the server's default request timeout, so a slow answer normally arrives as a 504 first
+const ASK_TIMEOUT_MS = 15000;
 
-  // 1. Sanitize the Base URL
-  const rawBase = opts?.baseUrl?.trim() || DEFAULT_BASE_URL;
-  // Ensure the base doesn't have a trailing slash so we can control the path precisely
-  const baseUrl = rawBase.endsWith("/") ? rawBase.slice(0, -1) : rawBase;
+// Error reported by the model API itself, as opposed to a failed connection
+class OracleApiError extends Error {}
+
+// One persistent WebSocket per API, shared by all spins. Questions carry an id so answers can be
+// matched to them in whatever order the server sends them.
+class OracleSocket {
+  private ws: WebSocket | null = null;
+  private opening: Promise<WebSocket> | null = null;
+  private pending = new Map<string, { resolve: (reply: ModelReply) => void; reject: (err: Error) => void }>();
+  private nextId = 0;
+
+  constructor(private url: string) {}
+
+  private connect(): Promise<WebSocket> {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      return Promise.resolve(this.ws);
+    }
+    if (!this.opening) {
+      this.opening = new Promise((resolve, reject) => {
+        const ws = new WebSocket(this.url);
+        ws.onopen = () => {
+          this.ws = ws;
+          this.opening = null;
+          resolve(ws);
+        };
+        ws.onmessage = (event) => {
+          const data = JSON.parse(event.data);
+          const pending = this.pending.get(data.id);
+          if (!pending) return;
+          this.pending.delete(data.id);
+          if (data.error) {
+            pending.reject(new OracleApiError(`Model API error: ${data.error.status} - ${data.error.detail}`));
+          } else {
+            pending.resolve(data);
+          }
+        };
+        ws.onclose = () => {
+          // Fails the connection attempt if it never opened, and every question still in flight
+          this.ws = null;
+          this.opening = null;
+          reject(new Error("WebSocket closed"));
+          for (const pending of this.pending.values()) {
+            pending.reject(new Error("WebSocket closed"));
+          }
+          this.pending.clear();
+        };
+      });
+    }
+    return this.opening;
+  }
+
+  async ask(question: string, timeoutMs = ASK_TIMEOUT_MS): Promise<ModelReply> {
+    const ws = await this.connect();
+    const id = String(++this.nextId);
+    return new Promise((resolve, reject) => {
+      // A question the server never answers is given up on, so the caller can fall back to POST
+      const timer = setTimeout(() => {
+        this.pending.delete(id);
+        reject(new Error(`No WebSocket answer within ${timeoutMs} ms`));
+      }, timeoutMs);
+      this.pending.set(id, {
+        resolve: (reply) => {
+          clearTimeout(timer);
+          resolve(reply);
+        },
+        reject: (err) => {
+          clearTimeout(timer);
+          reject(err);
+        },
+      });
+      ws.send(JSON.stringify({ id, question }));
+    });
+  }
+}
+
+const sockets = new Map<string, OracleSocket>();
 
-  // 2. Build the URL with the mandatory trailing slash before the query string
+function socketFor(baseUrl: string): OracleSocket {
+  let socket = sockets.get(baseUrl);
+  if (!socket) {
+    socket = new OracleSocket(baseUrl.replace(/^http/, "ws") + "/ws/ask_model");
+    sockets.set(baseUrl, socket);
+  }
+  return socket;
+}
+
+async function postQuestion(baseUrl: string, question: string): Promise<ModelReply> {
+  // Build the URL with the mandatory trailing slash before the query string
   // Your Swagger proves it works with: .../ask_model/?question=...
   const url = new URL(baseUrl + "/ask_model/");
   url.searchParams.set("question", question);
@@ -30,19 +114,40 @@ export async function askOracle(
       "Accept": "application/json",
       "Content-Type": "application/json"
     },
-    // 3. Send an empty JSON object as the body. 
+    // Send an empty JSON object as the body.
     // This solves the '411 Length Required' error from Google Cloud.
     body: JSON.stringify({}),
   });
 
   if (!response.ok) {
     const errorBody = await response.text();
-    throw new Error(`Model API error: ${response.status} - ${errorBody}`);
+    throw new OracleApiError(`Model API error: ${response.status} - ${errorBody}`);
   }
 
-  const data = await response.json();
+  return response.json();
+}
+
+export async function askOracle(
+  question: string,
+  opts?: { baseUrl?: string }
+): Promise<OracleResponse> {
+  const startTime = performance.now();
+
+  // 1. Sanitize the Base URL
+  const rawBase = opts?.baseUrl?.trim() || DEFAULT_BASE_URL;
+  // Ensure the base doesn't have a trailing slash so we can control the path precisely
+  const baseUrl = rawBase.endsWith("/") ? rawBase.slice(0, -1) : rawBase;
+
+  // 2. Ask over the persistent WebSocket, falling back to a plain POST if the socket can't be used
+  let data: ModelReply;
+  try {
+    data = await socketFor(baseUrl).ask(question);
+  } catch (err) {
+    if (err instanceof OracleApiError) throw err;
+    data = await postQuestion(baseUrl, question);
+  }
 
-  // 4. Map the backend's "probs" structure
+  // 3. Map the backend's "probs" structure
   const p_yes = data.probs.yes;
   const p_no = data.probs.no;
   const answer = Math.random() < p_yes ? "yes" : "no";
@@ -51,6 +156,7 @@ export async function askOracle(
     p_yes: p_yes,
     p_no: p_no,
     answer: answer as "yes" | "no",
+    model_version: data.model_version,
     latency_ms: Math.round(performance.now() - startTime),
   };
-}
\ No newline at end of file
+}
@@ -0,0 +1,136 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class Overloaded(Exception):
+    """Raised when the admission queue is full and a request is shed."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Inference queue is full, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline expires before it reaches the model."""
+
+
+class AdmissionController:
+    """
+    Bounded admission queue in front of inference.
+
+    At most `max_concurrency` requests run inference at once and at most `max_queue` wait for a slot.
+    Requests beyond that are shed immediately, and waiting requests whose deadline expires are dropped
+    before they reach the model.
+    """
+
+    def __init__(self, max_concurrency: int = 1, max_queue: int = 8, ewma_alpha: float = 0.2) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.ewma_alpha = ewma_alpha
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.shed = 0
+        self.expired = 0
+        self.fallback = 0
+        self.service_time = 0.0
+
+    def retry_after(self) -> int:
+        """Estimate in whole seconds how long it takes to drain the current queue."""
+        return max(1, math.ceil(self.waiting * self.service_time / self.max_concurrency))
+
+    @asynccontextmanager
+    async def admit(self, deadline: float) -> AsyncIterator[None]:
+        """Wait for an inference slot until `deadline` (a time.monotonic() timestamp)."""
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(self.retry_after())
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            self.expired += 1
+            raise DeadlineExceeded("Request deadline expired while queued.") from None
+        finally:
+            self.waiting -= 1
+
+        try:
+            if time.monotonic() >= deadline:
+                self.expired += 1
+                raise DeadlineExceeded("Request deadline expired while queued.")
+
+            self.in_flight += 1
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                elapsed = time.perf_counter() - start
+                if self.completed == 0:
+                    self.service_time = elapsed
+                else:
+                    self.service_time += self.ewma_alpha * (elapsed - self.service_time)
+                self.completed += 1
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict[str, float]:
+        """Queue depth and shed counters for the metrics endpoint."""
+        return {
+            "queue_depth": self.waiting,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "shed": self.shed,
+            "expired": self.expired,
+            "fallback": self.fallback,
+            "service_time_s": self.service_time,
+        }
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values, NaN if there are none."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+
+class VersionStats:
+    """
+    Request outcomes and latency per model version, to compare the versions of a traffic split.
+
+    Latency percentiles are taken over the last `window` successful requests of every version.
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self.requests: dict[str, int] = {}
+        self.failed: dict[str, int] = {}
+        self._latencies: dict[str, deque[float]] = {}
+
+    def record(self, version: str, latency: float, ok: bool = True) -> None:
+        """Count a request answered (or failed) by a version, with its latency in seconds."""
+        self.requests[version] = self.requests.get(version, 0) + 1
+        if not ok:
+            self.failed[version] = self.failed.get(version, 0) + 1
+            return
+        self._latencies.setdefault(version, deque(maxlen=self.window)).append(latency)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Requests, failures and p50/p99 latency of every version for the metrics endpoint."""
+        stats = {}
+        for version, requests in self.requests.items():
+            latencies = sorted(self._latencies.get(version, ()))
+            stats[version] = {
+                "requests": requests,
+                "failed": self.failed.get(version, 0),
+                "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+                "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+        return stats
@@ -1,35 +1,155 @@
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
 from contextlib import asynccontextmanager
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Optional
 
-import torch
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
-from torch.nn import Softmax
-from transformers import BertTokenizerFast
+from fastapi import Depends, FastAPI, Header, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from lucky_ai.model import LuckyBertModel
-from lucky_ai.database import insert_user_data
+from lucky_ai.database import upsert_feedback_bulk
+from lucky_ai.admission import AdmissionController, DeadlineExceeded, Overloaded, VersionStats
+from lucky_ai.spool import FeedbackSpool, SpoolUnavailable
+
+# torch, transformers and the model code are imported by load_inference in the background, so the
+# process answers health checks while they load
+if TYPE_CHECKING:
+    import numpy as np
+
+    from lucky_ai.inference import LuckyPredictor
+    from lucky_ai.profiling import InferenceProfiler
+    from lucky_ai.registry import ModelRegistry
+
+MODEL_DIR = os.getenv("MODEL_DIR", "/app/models")
+TOKENIZER_DIR = "/app/tokenizer"
+COMPILE_MODE = os.getenv("COMPILE_MODE", "trace")
+# Fold LoRA adapters into their base weights at load time: lowest latency, but no shared base in memory
+MERGE_ADAPTERS = os.getenv("MERGE_ADAPTERS", "false").lower() in ("1", "true")
+# Thread counts and precision tuned for this host shape by the autotune command. Ignored when missing.
+INFERENCE_PROFILE = os.getenv("INFERENCE_PROFILE", "/app/inference_profile.json")
+# Version served by default at startup. Falls back to the most recently written version in MODEL_DIR.
+DEFAULT_MODEL_VERSION = os.getenv("DEFAULT_MODEL_VERSION")
+# Token required by the /admin endpoints. Admin endpoints are disabled when unset.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Admission control: inference slots, queue bound and default per-request deadline
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "1"))
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "8"))
+REQUEST_TIMEOUT_MS = int(os.getenv("REQUEST_TIMEOUT_MS", "10000"))
+# Optional cheaper model version that shed requests are routed to instead of being rejected, behind its
+# own inference slots and queue bound. Requests shed by both are rejected.
+FALLBACK_MODEL_VERSION = os.getenv("FALLBACK_MODEL_VERSION")
+FALLBACK_MAX_CONCURRENCY = int(os.getenv("FALLBACK_MAX_CONCURRENCY", "1"))
+FALLBACK_MAX_QUEUE = int(os.getenv("FALLBACK_MAX_QUEUE", "8"))
+
+# Questions a single WebSocket connection may have in flight before the server stops reading from it
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))
+
+# Local append-only log that feedback is written to before it is drained into the database
+FEEDBACK_SPOOL_DIR = os.getenv("FEEDBACK_SPOOL_DIR", "/tmp/lucky_ai/feedback_spool")
+FEEDBACK_SPOOL_MAX_MB = int(os.getenv("FEEDBACK_SPOOL_MAX_MB", "256"))
+
+# Where on-demand profiling sessions write their Chrome trace and op summary
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/lucky_ai/profiles")
+
+# Set by load_inference once the inference stack is imported, None until then
+registry: Optional["ModelRegistry"] = None
+profiler: Optional["InferenceProfiler"] = None
+# Why the inference stack failed to start, and the version it was starting as default
+startup_error: Optional[str] = None
+startup_version: Optional[str] = None
+
+
+def load_inference() -> None:
+    """Import the inference stack, apply the tuned profile and start loading the served versions."""
+    global startup_error
+    try:
+        start_inference()
+    except Exception as e:
+        # Reported by /ready instead of leaving the process warming up forever
+        traceback.print_exc()
+        startup_error = f"{type(e).__name__}: {e}"
+
+
+def start_inference() -> None:
+    """Build the model registry and start loading the default and fallback versions."""
+    global registry, profiler, startup_version
+    from transformers import BertTokenizerFast
+
+    from lucky_ai.inference import apply_inference_profile
+    from lucky_ai.profiling import InferenceProfiler
+    from lucky_ai.registry import ModelRegistry
+
+    precision = "fp32"
+    if os.path.exists(INFERENCE_PROFILE):
+        tuned = apply_inference_profile(INFERENCE_PROFILE)
+        precision = tuned["precision"]
+        print(f"Applied inference profile {INFERENCE_PROFILE}: {tuned}")
+
+    tokenizer = BertTokenizerFast.from_pretrained(TOKENIZER_DIR)
+    loading = ModelRegistry(
+        MODEL_DIR, tokenizer, compile_mode=COMPILE_MODE, precision=precision, merge_adapters=MERGE_ADAPTERS
+    )
+
+    startup_version = DEFAULT_MODEL_VERSION or loading.latest()
+    # Load and warm up in the background so the process can answer health checks while compiling
+    loading.load_async(startup_version, make_default=True)
+    if FALLBACK_MODEL_VERSION:
+        loading.load_async(FALLBACK_MODEL_VERSION)
+
+    profiler = InferenceProfiler(PROFILE_DIR)
+    registry = loading
+
+
+def loaded_registry() -> "ModelRegistry":
+    """The model registry, or a 503 while the inference stack is still being imported or failed to start."""
+    if startup_error is not None:
+        raise HTTPException(status_code=503, detail=f"Inference failed to start: {startup_error}")
+    if registry is None:
+        raise HTTPException(status_code=503, detail="Model is warming up.", headers={"Retry-After": "1"})
+    return registry
+
+
+def loaded_profiler() -> "InferenceProfiler":
+    """The inference profiler, or a 503 while the inference stack is still being imported."""
+    if profiler is None:
+        raise HTTPException(status_code=503, detail="Model is warming up.", headers={"Retry-After": "1"})
+    return profiler
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model, tokenizer, tokenize, softmax
-    model = LuckyBertModel.load_from_checkpoint("/app/model/model.ckpt")
-    model.eval()
+    global registry, admission, fallback_admission, version_stats, feedback_spool, profiler
+    global startup_error, startup_version
+    loader = threading.Thread(target=load_inference, daemon=True)
+    loader.start()
 
-    tokenizer = BertTokenizerFast.from_pretrained("/app/tokenizer")
+    admission = AdmissionController(max_concurrency=MAX_CONCURRENCY, max_queue=MAX_QUEUE)
+    fallback_admission = AdmissionController(max_concurrency=FALLBACK_MAX_CONCURRENCY, max_queue=FALLBACK_MAX_QUEUE)
+    version_stats = VersionStats()
 
-    softmax = Softmax(dim=1)
-
-    def tokenize(question: str, tokenizer: BertTokenizerFast = tokenizer) -> tuple[torch.Tensor, torch.Tensor]:
-        encoding = tokenizer(question, return_tensors="pt", padding=True, truncation=True, max_length=128)
-        input_ids = encoding["input_ids"]
-        attention_mask = encoding["attention_mask"]
-        return input_ids, attention_mask
+    feedback_spool = FeedbackSpool(
+        FEEDBACK_SPOOL_DIR, drain=upsert_feedback_bulk, max_bytes=FEEDBACK_SPOOL_MAX_MB * 1024 * 1024
+    )
+    feedback_spool.start()
 
     yield
 
-    del model, tokenizer, softmax
+    loader.join()
+    if profiler is not None:
+        profiler.finish()
+    feedback_spool.stop()
+    registry, profiler = None, None
+    startup_error, startup_version = None, None
+    del admission, fallback_admission, version_stats, feedback_spool
 
 
 app = FastAPI(lifespan=lifespan)
@@ -43,22 +163,285 @@ app.add_middleware(
 )
 
 
+def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    """Reject requests without the configured admin token."""
+    if ADMIN_TOKEN is None or x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+
 @app.get("/", include_in_schema=False)
 async def docs_redirect():
     return RedirectResponse(url="/docs")
 
 
+@app.get("/health")
+async def health():
+    """Liveness probe: the process is up."""
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """Readiness probe: only OK once the default model has been compiled and warmed up."""
+    error = startup_error
+    if error is None and registry is not None and not registry.is_ready():
+        error = registry.errors.get(startup_version)
+    if error is not None:
+        response.status_code = 503
+        return {"status": "failed", "error": error}
+    if registry is None or not registry.is_ready():
+        response.status_code = 503
+        return {"status": "warming_up"}
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Admission queue depth and shed counters, per-version outcomes and latency, feedback spool depth."""
+    return {
+        "admission": admission.stats(),
+        "fallback_admission": fallback_admission.stats(),
+        "versions": version_stats.stats(),
+        "feedback_spool": feedback_spool.stats(),
+    }
+
+
+def predict_fn(predictor: "LuckyPredictor") -> Callable[[list[str]], "np.ndarray"]:
+    """The predictor's predict, routed through the profiler while a profiling session is active."""
+    if profiler is not None and profiler.active:
+        return partial(profiler.predict, predictor)
+    return predictor.predict
+
+
+async def answer_fallback(registry: "ModelRegistry", question: str, deadline: float) -> tuple[str, "np.ndarray"]:
+    """Answer a request shed by the main queue with the fallback version, behind its own admission queue."""
+    try:
+        async with fallback_admission.admit(deadline):
+            version, predictor = registry.select(FALLBACK_MODEL_VERSION)
+            probs = (await run_in_threadpool(predict_fn(predictor), [question]))[0]
+    except Overloaded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return version, probs
+
+
+async def answer(question: str, version: Optional[str] = None, timeout_ms: Optional[int] = None) -> dict:
+    """Run a question through admission control and a model version. Failures raise HTTPException."""
+    registry = loaded_registry()
+    if not registry.is_ready():
+        raise HTTPException(status_code=503, detail="Model is warming up.", headers={"Retry-After": "1"})
+    try:
+        version, predictor = registry.select(version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    deadline = time.monotonic() + (timeout_ms or REQUEST_TIMEOUT_MS) / 1000
+    start = time.perf_counter()
+    try:
+        try:
+            async with admission.admit(deadline):
+                probs = (await run_in_threadpool(predict_fn(predictor), [question]))[0]
+        except Overloaded as e:
+            if FALLBACK_MODEL_VERSION is None or not registry.loaded().get(FALLBACK_MODEL_VERSION):
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+            admission.fallback += 1
+            version, probs = await answer_fallback(registry, question, deadline)
+        except DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=str(e))
+    except Exception:
+        version_stats.record(version, time.perf_counter() - start, ok=False)
+        raise
+    version_stats.record(version, time.perf_counter() - start)
+
+    return {"probs": {"yes": float(probs[0]), "no": float(probs[1])}, "model_version": version}
+
+
 @app.post("/ask_model/")
-def ask_model(question: str):
-    input_ids, attention_mask = tokenize(question)
-    out = model(input_ids=input_ids, attention_mask=attention_mask)
-    probs = softmax(out).detach().numpy()[0]
-    return {"probs": {"yes": float(probs[0]), "no": float(probs[1])}}
+async def ask_model(
+    question: str,
+    version: Optional[str] = None,
+    x_request_timeout_ms: Optional[int] = Header(default=None),
+):
+    return await answer(question, version, x_request_timeout_ms)
+
+
+def ws_message_error(message: Any) -> Optional[str]:
+    """Why a WebSocket message is not a valid question, or None if it is."""
+    if not isinstance(message, dict) or not isinstance(message.get("question"), str):
+        return "Message must be a JSON object with a string 'question'."
+    if not isinstance(message.get("version"), (str, type(None))):
+        return "'version' must be a string or null."
+    timeout_ms = message.get("timeout_ms")
+    if timeout_ms is not None and (not isinstance(timeout_ms, int) or isinstance(timeout_ms, bool) or timeout_ms <= 0):
+        return "'timeout_ms' must be a positive integer."
+    return None
+
+
+@app.websocket("/ws/ask_model")
+async def ask_model_ws(websocket: WebSocket):
+    """
+    Ask many questions over one persistent connection.
+
+    Clients send {"id": ..., "question": ..., "version": ..., "timeout_ms": ...} messages (version and
+    timeout_ms optional) and receive {"id": ..., "probs": ..., "model_version": ...} or
+    {"id": ..., "error": {"status": ..., "detail": ..., "retry_after": ...}} as soon as each answer is
+    ready, so answers may arrive out of order. Once WS_MAX_IN_FLIGHT questions of a connection are in
+    flight the server stops reading from it until one finishes, which pushes back on that client only.
+    """
+    await websocket.accept()
+    slots = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    send_lock = asyncio.Lock()
+    tasks: set[asyncio.Task] = set()
+
+    async def send(message: dict) -> None:
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def handle(message: dict) -> None:
+        try:
+            try:
+                result = await answer(message["question"], message.get("version"), message.get("timeout_ms"))
+            except HTTPException as e:
+                error = {"status": e.status_code, "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    error["retry_after"] = int(e.headers["Retry-After"])
+                result = {"error": error}
+            except Exception as e:
+                # Every question gets an answer, or the client waits for it forever
+                traceback.print_exc()
+                result = {"error": {"status": 500, "detail": f"Internal error: {type(e).__name__}"}}
+            await send({"id": message.get("id"), **result})
+        except (WebSocketDisconnect, RuntimeError):
+            # The client went away before its answer was ready
+            pass
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except json.JSONDecodeError:
+                message = None
+            detail = ws_message_error(message)
+            if detail is not None:
+                message_id = message.get("id") if isinstance(message, dict) else None
+                await send({"id": message_id, "error": {"status": 422, "detail": detail}})
+                continue
+
+            await slots.acquire()
+            task = asyncio.create_task(handle(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 @app.post("/submit_feedback/")
-def submit_feedback(prompt: str, label: str):
+async def submit_feedback(prompt: str, label: str, model_version: Optional[str] = None):
+    """Record a vote on a prompt, with the `model_version` from the answer so votes can be split by variant."""
     if label not in ["yes", "no"]:
         return {"status": "error", "message": "Invalid label. Must be 'yes' or 'no'."}
-    insert_user_data(prompt, label)
+    try:
+        feedback_spool.append(prompt, label, model_version)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except SpoolUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return {"status": "success"}
+
+
+@app.get("/admin/models", dependencies=[Depends(require_admin)])
+async def list_models():
+    """Available and loaded model versions, the default and the traffic split."""
+    registry = loaded_registry()
+    return {
+        "available": registry.available(),
+        "loaded": registry.loaded(),
+        "default": registry.default,
+        "weights": registry.weights,
+        "errors": dict(registry.errors),
+    }
+
+
+@app.post("/admin/models/{version}/load", dependencies=[Depends(require_admin)])
+async def load_model(version: str, make_default: bool = False):
+    """Load and warm up a version in the background, optionally swapping it in as default once ready."""
+    registry = loaded_registry()
+    try:
+        registry.load_async(version, make_default=make_default)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"status": "loading", "version": version}
+
+
+@app.post("/admin/models/{version}/default", dependencies=[Depends(require_admin)])
+async def set_default_model(version: str):
+    """Atomically make a loaded version the default."""
+    registry = loaded_registry()
+    try:
+        registry.set_default(version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"status": "success", "default": version}
+
+
+@app.put("/admin/models/weights", dependencies=[Depends(require_admin)])
+async def set_model_weights(weights: dict[str, float]):
+    """Split unpinned traffic between loaded versions, e.g. {"v3": 0.9, "v4": 0.1}."""
+    registry = loaded_registry()
+    try:
+        registry.set_weights(weights)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"status": "success", "weights": registry.weights}
+
+
+@app.delete("/admin/models/{version}", dependencies=[Depends(require_admin)])
+async def unload_model(version: str):
+    """Unload a version that is neither the default nor part of the traffic split."""
+    registry = loaded_registry()
+    try:
+        registry.unload(version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return {"status": "success"}
+
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def start_profile(requests: int = 50, seconds: float = 60.0):
+    """Profile the next `requests` predictions or `seconds` seconds, whichever ends first."""
+    if requests < 1 or seconds <= 0:
+        raise HTTPException(status_code=422, detail="requests and seconds must be positive.")
+    profiler = loaded_profiler()
+    try:
+        output_dir = profiler.start(requests, seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "profiling", "session": output_dir.name}
+
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile_status():
+    """Whether a profiling session is running and the id of the last finished one."""
+    return loaded_profiler().status()
+
+
+@app.get("/admin/profile/{session}/{name}", dependencies=[Depends(require_admin)])
+async def profile_report(session: str, name: str):
+    """Download trace.json, summary.md or python_stacks.folded of a finished session."""
+    from lucky_ai.profiling import REPORT_FILES
+
+    path = Path(PROFILE_DIR) / session / name
+    if name not in REPORT_FILES or Path(session).name != session or not path.is_file():
+        raise HTTPException(status_code=404, detail=f"No {name} for profiling session {session}.")
+    return FileResponse(path)
@@ -0,0 +1,195 @@
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+import typer
+
+# torch and the model are imported by the command and the workers, so --help starts quickly
+if TYPE_CHECKING:
+    from transformers import BertTokenizerFast
+
+    from lucky_ai.model import LuckyBertModel
+
+autotune_app = typer.Typer()
+
+# Per-process model and tokenizer, loaded once by _init_worker
+_model: Optional["LuckyBertModel"] = None
+_tokenizer: Optional["BertTokenizerFast"] = None
+
+
+def _init_worker(model_path: str, tokenizer_name: str, inter_op_threads: int) -> None:
+    """Load the model in a fresh process, where the inter-op thread count can still be set."""
+    import torch
+    from transformers import BertTokenizerFast
+
+    from lucky_ai.model import LuckyBertModel
+
+    global _model, _tokenizer
+    torch.set_num_interop_threads(inter_op_threads)
+    _model = LuckyBertModel.load_from_checkpoint(model_path, map_location="cpu")
+    _tokenizer = BertTokenizerFast.from_pretrained(tokenizer_name)
+
+
+def _sweep(
+    questions: list[str],
+    intra_op_threads: list[int],
+    batch_sizes: list[int],
+    precisions: list[str],
+    compile_mode: str,
+    batches: dict[int, int],
+) -> list[dict]:
+    """Measure every precision x intra-op threads x batch size combination in this worker."""
+    import torch
+
+    from lucky_ai.evaluate import measure_latency
+    from lucky_ai.inference import PRECISIONS, LuckyPredictor
+
+    assert _model is not None and _tokenizer is not None, "Worker not initialized"
+    results = []
+    reference: Optional[np.ndarray] = None
+    for precision in sorted(precisions, key=PRECISIONS.index):
+        predictor = LuckyPredictor(_model, _tokenizer, compile_mode=compile_mode, precision=precision)
+        predictor.warmup(passes=1)
+
+        # Largest change in probabilities compared to fp32, which is measured first
+        probs = np.concatenate([predictor.predict(questions[i : i + 64]) for i in range(0, 256, 64)])
+        reference = probs if reference is None else reference
+        max_prob_diff = float(np.abs(probs - reference).max())
+
+        for threads in intra_op_threads:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                results.append(
+                    {
+                        "intra_op_threads": threads,
+                        "inter_op_threads": torch.get_num_interop_threads(),
+                        "batch_size": batch_size,
+                        "precision": precision,
+                        "max_prob_diff": max_prob_diff,
+                        **measure_latency(
+                            predictor, questions[: batches[batch_size] * batch_size], batch_size=batch_size
+                        ),
+                    }
+                )
+    return results
+
+
+def select_profile(
+    results: list[dict], serve_batch_sizes: list[int], max_prob_diff: float, max_p99_ms: float = float("inf")
+) -> dict:
+    """
+    The combination to apply in the API: the lowest p50 among the batch sizes it serves.
+
+    Combinations whose probabilities drift more than `max_prob_diff` from fp32 are not considered, and
+    those within the `max_p99_ms` budget are preferred if there are any. The p99 of a few hundred samples
+    is decided by its slowest few, so it only checks the budget and does not rank. Results at other batch
+    sizes are only reported.
+    """
+    candidates = [r for r in results if r["batch_size"] in serve_batch_sizes and r["max_prob_diff"] <= max_prob_diff]
+    if not candidates:
+        raise ValueError(f"No combination at batch sizes {serve_batch_sizes} stays within {max_prob_diff} of fp32.")
+    candidates = [r for r in candidates if r["p99_ms"] <= max_p99_ms] or candidates
+    return min(candidates, key=lambda r: (r["p50_ms"], -r["throughput"]))
+
+
+@autotune_app.command()
+def autotune(
+    model_path: str = "models/model.ckpt",
+    tokenizer_name: str = "bert-base-uncased",
+    data_dir: str = "data/processed",
+    output: Path = Path("inference_profile.json"),
+    intra_op_threads: list[int] = typer.Option([]),
+    inter_op_threads: list[int] = typer.Option([1, 2]),
+    batch_sizes: list[int] = typer.Option([1, 8, 32]),
+    serve_batch_sizes: list[int] = typer.Option([1]),
+    precisions: list[str] = typer.Option(["fp32", "bf16"]),
+    compile_mode: str = "trace",
+    batches: int = 30,
+    serve_batches: int = 300,
+    max_p99_ms: float = 200.0,
+    max_prob_diff: float = 0.02,
+    seed: int = 0,
+) -> None:
+    """
+    Benchmark inference thread counts, batch sizes and precision on this host and write a tuned profile.
+
+    Every combination is measured on questions sampled from the processed test data, so sequence
+    lengths are realistic. The tuned profile is the combination with the lowest p50 latency at the batch
+    sizes the API serves (--serve-batch-sizes, the API predicts one question at a time) whose
+    probabilities stay within --max-prob-diff of fp32, preferring those whose p99 is within --max-p99-ms.
+    Served batch sizes are timed over --serve-batches batches so their p99 is not a single outlier,
+    other batch sizes over --batches and for the report only. Point the API's INFERENCE_PROFILE at the output to apply its thread counts and precision at
+    startup.
+    --intra-op-threads defaults to powers of two up to the number of cores. Each --inter-op-threads
+    value is measured in a fresh process, since it can only be set before torch starts parallel work.
+    """
+    import torch
+
+    from lucky_ai.dataset import LuckyDataset
+    from lucky_ai.inference import PRECISIONS
+
+    cpu_count = os.cpu_count() or 1
+    batch_sizes = sorted(set(batch_sizes) | set(serve_batch_sizes))
+    num_batches = {b: serve_batches if b in serve_batch_sizes else batches for b in batch_sizes}
+    intra_op_threads = intra_op_threads or [2**i for i in range(cpu_count.bit_length()) if 2**i <= cpu_count]
+    for precision in precisions:
+        if precision not in PRECISIONS:
+            raise typer.BadParameter(f"Invalid precision '{precision}'. Must be one of {PRECISIONS}.")
+
+    pool = LuckyDataset(train=False, data_dir=data_dir).df["input"].astype(str).tolist()
+    rng = random.Random(seed)
+    questions = rng.choices(pool, k=max(max(n * b for b, n in num_batches.items()), 256))
+
+    results: list[dict] = []
+    for inter in inter_op_threads:
+        print(f"Measuring with {inter} inter-op thread(s)...")
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_path, tokenizer_name, inter),
+        ) as executor:
+            results += executor.submit(
+                _sweep, questions, intra_op_threads, batch_sizes, precisions, compile_mode, num_batches
+            ).result()
+
+    print("| Intra | Inter | Batch | Precision | Questions/sec | p50 (ms) | p99 (ms) | Max prob diff | Served |")
+    print("|-------|-------|-------|-----------|---------------|----------|----------|---------------|--------|")
+    for r in results:
+        print(
+            f"| {r['intra_op_threads']} | {r['inter_op_threads']} | {r['batch_size']} | {r['precision']} | "
+            f"{r['throughput']:.1f} | {r['p50_ms']:.1f} | {r['p99_ms']:.1f} | {r['max_prob_diff']:.4f} | "
+            f"{'yes' if r['batch_size'] in serve_batch_sizes else 'no'} |"
+        )
+
+    best = select_profile(results, serve_batch_sizes, max_prob_diff, max_p99_ms)
+    if best["p99_ms"] > max_p99_ms:
+        print(f"Warning: no combination at the served batch sizes has a p99 within the budget of {max_p99_ms} ms.")
+
+    profile = {
+        "intra_op_threads": best["intra_op_threads"],
+        "inter_op_threads": best["inter_op_threads"],
+        "batch_size": best["batch_size"],
+        "precision": best["precision"],
+        "throughput": best["throughput"],
+        "p50_ms": best["p50_ms"],
+        "p99_ms": best["p99_ms"],
+        "cpu_count": cpu_count,
+        "torch_version": torch.__version__,
+        "sweep": results,
+    }
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(profile, indent=2))
+    print(
+        f"Tuned profile: {best['intra_op_threads']} intra-op / {best['inter_op_threads']} inter-op threads, "
+        f"batch size {best['batch_size']}, {best['precision']}. Written to {output}"
+    )
+
+
+if __name__ == "__main__":
+    autotune_app()
@@ -0,0 +1,86 @@
+import sys
+import time
+from typing import Any
+
+import pytorch_lightning as pl
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore[assignment]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB, or NaN where it cannot be measured."""
+    if resource is None:
+        return float("nan")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class ResourceMonitor(pl.Callback):
+    """
+    Log training throughput (samples/sec) and peak RSS every training step.
+
+    Throughput is this process's times the number of data-parallel processes, which run in lockstep.
+    The mean throughput after the first (warm-up) batch is printed when training ends.
+    """
+
+    def on_train_start(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        self._samples = 0
+        self._elapsed = 0.0
+
+    def on_train_batch_start(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, batch: Any, batch_idx: int
+    ) -> None:
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, outputs: Any, batch: Any, batch_idx: int
+    ) -> None:
+        elapsed = time.perf_counter() - self._start
+        num_samples = len(batch["labels"])
+        if batch_idx > 0:
+            self._samples += num_samples
+            self._elapsed += elapsed
+        pl_module.log(
+            "perf/samples_per_sec",
+            # This rank's throughput scaled to all ranks, not synced: an all-reduce every step would
+            # distort the scaling it measures
+            trainer.world_size * num_samples / elapsed,
+            on_step=True,
+            on_epoch=False,
+            batch_size=num_samples,
+        )
+        pl_module.log("perf/peak_rss_mb", peak_rss_mb(), on_step=True, on_epoch=False, batch_size=num_samples)
+
+    def on_train_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        # DDP keeps ranks in lockstep on equal batches, so every rank contributes the same throughput
+        if trainer.is_global_zero and self._elapsed > 0:
+            throughput = trainer.world_size * self._samples / self._elapsed
+            print(f"Throughput: {throughput:.1f} samples/sec with {trainer.world_size} process(es)")
+
+
+class TimeToTarget(pl.Callback):
+    """Log the wall time and global step at which `val/acc` first reaches a target accuracy."""
+
+    def __init__(self, target: float) -> None:
+        self.target = target
+        self.reached = False
+
+    def on_train_start(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        self._start = time.perf_counter()
+
+    def on_validation_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        acc = trainer.callback_metrics.get("val/acc")
+        if self.reached or trainer.sanity_checking or acc is None or acc < self.target:
+            return
+        self.reached = True
+        elapsed = time.perf_counter() - self._start
+        print(f"val/acc reached {self.target} after {elapsed:.1f}s at step {trainer.global_step}")
+        for logger in trainer.loggers:
+            logger.log_metrics(
+                {"perf/time_to_target_s": elapsed, "perf/steps_to_target": trainer.global_step},
+                step=trainer.global_step,
+            )
@@ -0,0 +1,336 @@
+import json
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+import typer
+
+# torch, Lightning and the model are imported by the functions that use them, so --help starts quickly
+if TYPE_CHECKING:
+    import torch
+    from transformers import BertModel, BertTokenizerFast
+
+coreset_app = typer.Typer()
+
+EMBEDDINGS_FILE = "embeddings.npz"
+
+
+def embed(texts: list[str], bert: "BertModel", tokenizer: "BertTokenizerFast", batch_size: int = 64) -> np.ndarray:
+    """Mean-pooled, L2-normalized last hidden states, computed in length-sorted batches."""
+    import torch
+
+    bert.eval()
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    embeddings = np.empty((len(texts), bert.config.hidden_size), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(texts), batch_size):
+            idx = order[start : start + batch_size]
+            encoding = tokenizer(
+                [texts[i] for i in idx], return_tensors="pt", padding=True, truncation=True, max_length=128
+            )
+            hidden = bert(**encoding).last_hidden_state
+            mask = encoding["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings[idx] = torch.nn.functional.normalize(pooled, dim=1).numpy()
+    return embeddings
+
+
+def kmeans(
+    x: "torch.Tensor", k: int, iterations: int = 25, seed: int = 0, chunk_size: int = 16384
+) -> tuple["torch.Tensor", "torch.Tensor"]:
+    """
+    Lloyd's k-means with k-means++ seeding.
+
+    Returns:
+        Centroids of shape (k, dims) and the cluster of every point.
+    """
+    import torch
+
+    # k-means++: every next seed is drawn with probability proportional to its squared distance to the
+    # closest seed so far, which spreads the seeds over the clusters
+    generator = torch.Generator().manual_seed(seed)
+    norms = (x**2).sum(dim=1)
+    seeds = [int(torch.randint(len(x), (1,), generator=generator))]
+    closest = (norms - 2 * x @ x[seeds[0]] + norms[seeds[0]]).clamp_min(0)
+    for _ in range(1, k):
+        cumulative = closest.cumsum(dim=0)
+        draw = torch.rand(1, generator=generator) * cumulative[-1]
+        seeds.append(min(int(torch.searchsorted(cumulative, draw)), len(x) - 1))
+        closest = torch.minimum(closest, (norms - 2 * x @ x[seeds[-1]] + norms[seeds[-1]]).clamp_min(0))
+    centroids = x[seeds].clone()
+
+    assignments = torch.zeros(len(x), dtype=torch.long)
+    for _ in range(iterations):
+        # argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c, in chunks to bound the distance matrix
+        centroid_norms = (centroids**2).sum(dim=1)
+        for start in range(0, len(x), chunk_size):
+            chunk = x[start : start + chunk_size]
+            assignments[start : start + chunk_size] = (centroid_norms - 2 * chunk @ centroids.T).argmin(dim=1)
+
+        counts = torch.bincount(assignments, minlength=k)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        # Empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).to(x.dtype)
+    return centroids, assignments
+
+
+def select_representatives(embeddings: np.ndarray, target: int, max_clusters: int = 512, seed: int = 0) -> np.ndarray:
+    """
+    Pick `target` representative rows of a group by clustering its embeddings.
+
+    Every cluster contributes the row nearest its centroid, and the remaining picks are apportioned to
+    clusters by size (largest remainder) and drawn at random within them. With `target` <= `max_clusters`
+    this is one medoid per cluster. Small clusters of unusual examples are thereby kept, while large
+    clusters of near-duplicates are thinned out.
+
+    Returns:
+        Sorted row indices of the picks.
+    """
+    import torch
+
+    if target >= len(embeddings):
+        return np.arange(len(embeddings))
+    if target == 0:
+        return np.array([], dtype=np.int64)
+
+    x = torch.from_numpy(embeddings.astype(np.float32))
+    centroids, assignments = kmeans(x, min(target, max_clusters), seed=seed)
+    distances = ((x - centroids[assignments]) ** 2).sum(dim=1).numpy()
+    assignments = assignments.numpy()
+
+    clusters = [np.flatnonzero(assignments == c) for c in range(len(centroids))]
+    clusters = [members[np.argsort(distances[members], kind="stable")] for members in clusters if len(members)]
+
+    # One pick per cluster, the rest apportioned over the remaining members by largest remainder
+    extra = target - len(clusters)
+    spare = np.array([len(members) - 1 for members in clusters])
+    exact = extra * spare / spare.sum() if spare.sum() else np.zeros(len(clusters))
+    quotas = np.floor(exact).astype(int)
+    for c in np.argsort(quotas - exact, kind="stable")[: extra - quotas.sum()]:
+        quotas[c] += 1
+
+    rng = np.random.default_rng(seed)
+    picks = []
+    for members, quota in zip(clusters, quotas):
+        picks.append(members[:1])
+        picks.append(rng.choice(members[1:], size=quota, replace=False))
+    return np.sort(np.concatenate(picks))
+
+
+def select_coreset(
+    embeddings: np.ndarray,
+    subsets: np.ndarray,
+    labels: np.ndarray,
+    fraction: float,
+    max_clusters: int = 512,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Select `fraction` of every subset, split as evenly between true and false labels as the subset allows.
+
+    Returns:
+        Boolean mask of the selected rows.
+    """
+    selected = np.zeros(len(embeddings), dtype=bool)
+    for subset in np.unique(subsets):
+        rows = np.flatnonzero(subsets == subset)
+        target = max(1, round(fraction * len(rows)))
+        true_rows, false_rows = rows[labels[rows]], rows[~labels[rows]]
+        num_true = min(len(true_rows), max(target - len(false_rows), target // 2))
+        for group, group_target in [(true_rows, num_true), (false_rows, target - num_true)]:
+            picks = select_representatives(embeddings[group], group_target, max_clusters=max_clusters, seed=seed)
+            selected[group[picks]] = True
+    return selected
+
+
+def load_embeddings(
+    texts: list[str],
+    keys: np.ndarray,
+    cache_path: Path,
+    model_id: str,
+    embed_fn: Callable[[list[str]], np.ndarray],
+) -> tuple[np.ndarray, int]:
+    """
+    Embeddings of the rows, reusing the cached ones of rows embedded by an earlier run with the same model.
+
+    Only rows whose key is not cached are embedded. The cache is rewritten with the current rows.
+
+    Returns:
+        The embeddings and the number of rows that had to be embedded.
+    """
+    cached_keys, cached = np.array([], dtype=np.uint64), None
+    if cache_path.exists():
+        with np.load(cache_path) as cache:
+            if str(cache["model_id"]) == model_id:
+                cached_keys, cached = cache["keys"], cache["embeddings"]
+
+    if len(keys) == 0:
+        # Nothing to embed, and the cache is kept for the next run over the full data
+        return (cached[:0] if cached is not None else embed_fn([])).astype(np.float32), 0
+
+    position = {key: i for i, key in enumerate(cached_keys.tolist())}
+    hits = np.array([position.get(key, -1) for key in keys.tolist()], dtype=np.int64)
+    missing = np.flatnonzero(hits < 0)
+
+    fresh = None
+    if len(missing):
+        # Repeated rows (soft labels) have their own keys but are embedded once
+        unique, inverse = np.unique(np.array([texts[i] for i in missing], dtype=object), return_inverse=True)
+        fresh = embed_fn(unique.tolist())[inverse]
+    dims = fresh.shape[1] if fresh is not None else cached.shape[1]
+    embeddings = np.empty((len(keys), dims), dtype=np.float32)
+    if fresh is not None:
+        embeddings[missing] = fresh
+    hit = hits >= 0
+    if hit.any():
+        embeddings[hit] = cached[hits[hit]]
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, keys=keys, embeddings=embeddings.astype(np.float16), model_id=np.array(model_id))
+    return embeddings, len(missing)
+
+
+def benchmark(
+    selections: dict[float, Optional[Path]],
+    model_name: str,
+    data_dir: str,
+    subsets: Optional[list[str]],
+    epochs: int,
+    batch_size: int,
+    lr: float,
+    seed: int,
+) -> list[dict]:
+    """Fine-tune a fresh model on every selection and report epoch time and per-subset test accuracy."""
+    import pytorch_lightning as pl
+
+    from lucky_ai.dataset import LuckyDataModule
+    from lucky_ai.evaluate import evaluate_subsets
+    from lucky_ai.model import LuckyBertModel
+
+    report = []
+    for fraction, selection in selections.items():
+        pl.seed_everything(seed)
+        dm = LuckyDataModule(
+            model_name=model_name,
+            batch_size=batch_size,
+            data_dir=data_dir,
+            subsets=subsets,
+            selection=str(selection) if selection is not None else None,
+        )
+        dm.setup()
+        model = LuckyBertModel(model_name=model_name, lr=lr)
+        trainer = pl.Trainer(
+            max_epochs=epochs,
+            limit_val_batches=0,
+            logger=False,
+            enable_checkpointing=False,
+            enable_model_summary=False,
+        )
+        start = time.perf_counter()
+        trainer.fit(model, train_dataloaders=dm.train_dataloader())
+        report.append(
+            {
+                "fraction": fraction,
+                "train_rows": len(dm.train_set),
+                "epoch_time_s": (time.perf_counter() - start) / epochs,
+                "accuracy": evaluate_subsets(model, dm.test_set, dm.collate_fn, batch_size=64),
+            }
+        )
+    return report
+
+
+@coreset_app.command()
+def coreset(
+    output_dir: Path = Path("data/coreset"),
+    data_dir: str = "data/processed",
+    model_name: str = "bert-base-uncased",
+    model_path: Optional[str] = None,
+    subsets: list[str] = typer.Option([]),
+    fractions: list[float] = typer.Option([0.25, 0.5]),
+    max_clusters: int = 512,
+    embed_batch_size: int = 64,
+    seed: int = 0,
+    benchmark_epochs: int = 0,
+    batch_size: int = 16,
+    lr: float = 1e-5,
+) -> None:
+    """
+    Select representative, label-balanced coresets of the training data at one or more fractions.
+
+    Training examples are embedded with BERT (the encoder of --model-path if given, else the pretrained
+    --model-name) and clustered per subset and label. Each coreset keeps --fractions of every subset, half
+    true and half false labels where the subset allows, chosen cluster by cluster. Embeddings are cached
+    in output_dir, so a rerun only embeds rows added since the last one. Each fraction is written as
+    <output_dir>/coreset-<pct>.parquet, which training uses when data.selection points at it. Rows added
+    after a coreset was built are kept until the next run.
+
+    With --benchmark-epochs N, a fresh model is fine-tuned for N epochs on the full data and on every
+    coreset, and epoch time and per-subset test accuracy are reported.
+    """
+    from transformers import BertModel, BertTokenizerFast
+
+    from lucky_ai.dataset import LuckyDataset, example_keys
+
+    for fraction in fractions:
+        if not 0 < fraction < 1:
+            raise typer.BadParameter(f"Invalid fraction {fraction}. Must be between 0 and 1.")
+
+    df = LuckyDataset(train=True, data_dir=data_dir, subsets=subsets or None).df
+    keys = example_keys(df)
+    texts = df["input"].astype(str).tolist()
+
+    tokenizer = BertTokenizerFast.from_pretrained(model_name)
+    model_id = model_path or model_name
+
+    def embed_fn(batch: list[str]) -> np.ndarray:
+        # Only loaded when some rows are not cached yet
+        if model_path is not None:
+            from lucky_ai.model import LuckyBertModel
+
+            bert = LuckyBertModel.load_from_checkpoint(model_path, map_location="cpu").bert
+        else:
+            bert = BertModel.from_pretrained(model_name)
+        return embed(batch, bert, tokenizer, batch_size=embed_batch_size)
+
+    start = time.perf_counter()
+    embeddings, embedded = load_embeddings(texts, keys, output_dir / EMBEDDINGS_FILE, model_id, embed_fn)
+    print(f"Embedded {embedded:,} new of {len(df):,} rows in {time.perf_counter() - start:.1f}s")
+
+    subset_names = df["subset"].to_numpy()
+    labels = df["label"].to_numpy(dtype=bool)
+    selections: dict[float, Optional[Path]] = {1.0: None}
+    print("| Fraction | Subset | Rows | Selected | True labels |")
+    print("|----------|--------|------|----------|-------------|")
+    for fraction in sorted(fractions):
+        selected = select_coreset(embeddings, subset_names, labels, fraction, max_clusters, seed)
+        path = output_dir / f"coreset-{round(fraction * 100)}.parquet"
+        df.assign(key=keys, selected=selected)[["key", "subset", "selected"]].to_parquet(path, index=False)
+        selections[fraction] = path
+
+        for subset in np.unique(subset_names):
+            rows = subset_names == subset
+            chosen = selected & rows
+            print(
+                f"| {fraction:.0%} | {subset} | {rows.sum():,} | {chosen.sum():,} | "
+                f"{labels[chosen].sum() / max(chosen.sum(), 1):.1%} |"
+            )
+        print(f"Wrote {path}")
+
+    if benchmark_epochs <= 0:
+        return
+
+    report = benchmark(selections, model_name, data_dir, subsets or None, benchmark_epochs, batch_size, lr, seed)
+    (output_dir / "report.json").write_text(json.dumps(report, indent=2))
+
+    names = sorted(report[0]["accuracy"])
+    print("| Fraction | Train rows | Epoch time (s) | " + " | ".join(names) + " |")
+    print("|----------|------------|----------------|" + "|".join("---" for _ in names) + "|")
+    for row in report:
+        accuracies = " | ".join(f"{row['accuracy'][s]:.3f}" for s in names)
+        print(f"| {row['fraction']:.0%} | {row['train_rows']:,} | {row['epoch_time_s']:.1f} | {accuracies} |")
+
+
+if __name__ == "__main__":
+    coreset_app()
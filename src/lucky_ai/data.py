@@ -1,26 +1,48 @@
+import hashlib
 import os
 from pathlib import Path
-import pandas as pd
-from datasets import load_dataset
-from lucky_ai.database import insert_user_data, fetch_user_data
+from typing import TYPE_CHECKING, Optional
+from lucky_ai.database import insert_user_data, fetch_user_feedback
 import typer
 
+# pandas, pyarrow and datasets are imported by the preprocessors that use them, so the CLIs start quickly
+if TYPE_CHECKING:
+    import pandas as pd
+
 RAW_DIR = Path("data/raw")
 PROCESSED_DIR = Path("data/processed")
 
+# Processed data is a single Hive-partitioned parquet dataset: PROCESSED_DIR/subset=<name>/split=<split>/
+# with columns input (string) and label (bool)
+# Rows per row group: about 1 MB of short texts. Large enough to compress well, small enough that
+# readers of a shard or a batch stream read little beyond the rows they need.
+ROW_GROUP_SIZE = 8192
+
+# How user feedback votes become labels: the majority vote, or soft labels as repeated rows
+USER_LABEL_MODES = ("majority", "soft")
+# Share of user prompts in the test split
+USER_TEST_FRACTION = 0.2
+
+# Earlier versions wrote one flat <subset>_<split>.parquet per subset and split, and new user feedback to
+# new_user_train.parquet
+NEW_USER_FLAT_FILE = "new_user_train.parquet"
+
 preprocess_app = typer.Typer()
 add_data_app = typer.Typer()
+migrate_app = typer.Typer()
 
 
 @add_data_app.command()
 def add_user_data(input: str, label: bool):
-    """Append a new user data entry to the user data database."""
+    """Add a vote for a prompt to the user feedback database."""
     insert_user_data(input, label)
 
 
 @preprocess_app.command()
 def preprocess(
     subset: str = "all",
+    user_labels: str = "majority",
+    soft_resolution: int = 4,
 ) -> None:
     """
     Preprocess datasets and store them as parquet files.
@@ -32,7 +54,13 @@ def preprocess(
     - strategyqa    : StrategyQA dataset
     - boolq         : Google BoolQ dataset
     - user          : User generated dataset
+
+    user_labels options (how the votes on a user prompt become labels):
+    - majority      : the majority vote, ties are skipped
+    - soft          : --soft-resolution training rows per prompt, true in proportion to its yes votes
     """
+    if user_labels not in USER_LABEL_MODES:
+        raise typer.BadParameter(f"Invalid user labels '{user_labels}'. Must be one of {USER_LABEL_MODES}.")
 
     print("Preprocessing data...")
 
@@ -45,13 +73,65 @@ def preprocess(
     if subset == "all" or subset == "boolq":
         preprocess_boolq()
     if subset == "all" or subset == "user":
-        preprocess_user()
+        preprocess_user(label_mode=user_labels, soft_resolution=soft_resolution)
 
     print("Preprocessing complete.")
 
 
+@migrate_app.command()
+def migrate_processed(processed_dir: Optional[Path] = None) -> None:
+    """
+    Move flat <subset>_<split>.parquet files of earlier versions into the partitioned layout.
+
+    Each flat file replaces its subset/split partition and is then deleted. new_user_train.parquet
+    becomes the user/new partition. Files that do not follow the old naming are left in place.
+    """
+    import pandas as pd
+
+    processed_dir = processed_dir or PROCESSED_DIR
+    flat_files = sorted(processed_dir.glob("*.parquet"))
+    if not flat_files:
+        print(f"No flat parquet files in {processed_dir}, nothing to migrate.")
+        return
+
+    for path in flat_files:
+        if path.name == NEW_USER_FLAT_FILE:
+            subset, split = "user", "new"
+        else:
+            subset, _, split = path.stem.rpartition("_")
+        if not subset or split not in ("train", "test", "new"):
+            print(f"Skipping {path}: not named <subset>_<split>.parquet")
+            continue
+        out_path = save_partition(pd.read_parquet(path), subset, split, processed_dir=processed_dir)
+        path.unlink()
+        print(f"Migrated {path} to {out_path}")
+
+
+def save_partition(df: "pd.DataFrame", subset: str, split: str, processed_dir: Optional[Path] = None) -> Path:
+    """Replace the subset/split partition of the processed dataset with the input/label columns of df."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition_dir = (processed_dir or PROCESSED_DIR) / f"subset={subset}" / f"split={split}"
+    partition_dir.mkdir(parents=True, exist_ok=True)
+
+    schema = pa.schema([("input", pa.string()), ("label", pa.bool_())])
+    table = pa.Table.from_pandas(df[["input", "label"]], preserve_index=False).cast(schema)
+    out_path = partition_dir / "part-0.parquet"
+    # Dataset readers skip dot-files, so a half-written partition is never read
+    tmp_path = partition_dir / f".{out_path.name}.tmp"
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp_path, out_path)
+    for stale in partition_dir.glob("*.parquet"):
+        if stale != out_path:
+            stale.unlink()
+    return out_path
+
+
 def preprocess_boolq() -> None:
     "Preprocess boolean questions from the BoolQ dataset."
+    from datasets import load_dataset
+
     print("Preprocessing boolq dataset...")
     ds = load_dataset("google/boolq")
 
@@ -63,13 +143,14 @@ def preprocess_boolq() -> None:
         df = df[["question", "answer"]]
         df.rename(columns={"question": "input", "answer": "label"}, inplace=True)
 
-        out_path = PROCESSED_DIR / f"boolq_{split}.parquet"
-        df.to_parquet(out_path, index=False)
+        out_path = save_partition(df, "boolq", split)
         print(f"Saved {out_path}")
 
 
 def preprocess_strategyQA() -> None:
     "Preprocess QA data from the StrategyQA dataset."
+    from datasets import load_dataset
+
     print("Preprocessing strategyqa dataset...")
 
     ds = load_dataset("ChilleD/StrategyQA")
@@ -80,13 +161,14 @@ def preprocess_strategyQA() -> None:
         df = df[["question", "answer"]]
         df.rename(columns={"question": "input", "answer": "label"}, inplace=True)
 
-        out_path = PROCESSED_DIR / f"strategyqa_{split}.parquet"
-        df.to_parquet(out_path, index=False)
+        out_path = save_partition(df, "strategyqa", split)
         print(f"Saved {out_path}")
 
 
 def preprocess_commonsense() -> None:
     "Preprocess commonsense data from ETHICS dataset."
+    import pandas as pd
+
     print("Preprocessing commonsense data...")
 
     commonsense_dir = RAW_DIR / "ethics" / "commonsense"
@@ -94,7 +176,7 @@ def preprocess_commonsense() -> None:
     train_path = commonsense_dir / "commonsense_train.csv"
     test_path = commonsense_dir / "commonsense_test.csv"
 
-    for file in [train_path, test_path]:
+    for split, file in [("train", train_path), ("test", test_path)]:
         df = pd.read_csv(file)
         df = df[df["is_short"]]
         df = df[["label", "input"]]
@@ -102,14 +184,15 @@ def preprocess_commonsense() -> None:
         # Invert labels as 0 corresponds to acceptable and 1 to unacceptable in dataset
         df["label"] = ~df["label"].astype(bool)
 
-        out_path = PROCESSED_DIR / (file.stem + ".parquet")
-        df.to_parquet(out_path, index=False)
+        out_path = save_partition(df, "commonsense", split)
 
         print(f"Processed {file.name} -> {out_path}")
 
 
 def preprocess_justice() -> None:
     "Preprocess justice data from ETHICS dataset."
+    import pandas as pd
+
     print("Preprocessing justice data...")
 
     justice_dir = RAW_DIR / "ethics" / "justice"
@@ -117,33 +200,58 @@ def preprocess_justice() -> None:
     train_path = justice_dir / "justice_train.csv"
     test_path = justice_dir / "justice_test.csv"
 
-    for file in [train_path, test_path]:
+    for split, file in [("train", train_path), ("test", test_path)]:
         df = pd.read_csv(file)
         df.rename(columns={"scenario": "input"}, inplace=True)
         df["label"] = df["label"].astype(bool)
 
-        out_path = PROCESSED_DIR / (file.stem + ".parquet")
-        df.to_parquet(out_path, index=False)
+        out_path = save_partition(df, "justice", split)
 
         print(f"Processed {file.name} -> {out_path}")
 
 
-def preprocess_user() -> None:
-    "Preprocess boolean user data."
+def feedback_labels(votes: "pd.DataFrame", label_mode: str = "majority", soft_resolution: int = 4) -> "pd.DataFrame":
+    """
+    Turn per-prompt vote counts into input/label rows.
+
+    "majority" gives one row per prompt labelled with its majority vote and skips ties. "soft" gives
+    `soft_resolution` rows per prompt, of which a share equal to its yes votes (rounded) is true.
+    Cross-entropy over these rows equals cross-entropy against the soft label at that resolution, so
+    training needs no other change.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if label_mode == "majority":
+        decided = votes[votes["yes_count"] != votes["no_count"]]
+        return pd.DataFrame({"input": decided["prompt"], "label": decided["yes_count"] > decided["no_count"]})
+
+    p_yes = votes["yes_count"] / (votes["yes_count"] + votes["no_count"])
+    num_true = (p_yes * soft_resolution).round().to_numpy()
+    return pd.DataFrame(
+        {
+            "input": np.repeat(votes["prompt"].to_numpy(), soft_resolution),
+            "label": (np.arange(soft_resolution)[None, :] < num_true[:, None]).ravel(),
+        }
+    )
+
+
+def preprocess_user(label_mode: str = "majority", soft_resolution: int = 4) -> None:
+    "Preprocess boolean user data from the per-prompt feedback vote counters."
+    import pandas as pd
+
     print("Preprocessing user data...")
 
-    # Fetch user data from database
-    df = fetch_user_data()
+    # Fetch vote counts per normalized prompt from database
+    df = fetch_user_feedback()
 
     if df.empty:
         print("No user data found in database.")
         return
 
-    # Ensure timestamp column is datetime
-    df["time"] = pd.to_datetime(df["time"])
-
-    # Rename columns to match expected format
-    df.rename(columns={"prompt": "input"}, inplace=True)
+    # Ensure timestamp columns are datetime
+    df["first_seen"] = pd.to_datetime(df["first_seen"], utc=True)
+    df["last_seen"] = pd.to_datetime(df["last_seen"], utc=True)
 
     # Path to sync timestamp file
     sync_file = "last_user_data_sync.txt"
@@ -152,40 +260,37 @@ def preprocess_user() -> None:
     if os.path.exists(sync_file):
         with open(sync_file, "r") as f:
             last_sync = f.read().strip()
-            last_sync_time = pd.to_datetime(last_sync)
+            last_sync_time = pd.to_datetime(last_sync, utc=True)
     else:
         # If no sync file, treat all data as new data
         last_sync_time = pd.Timestamp.min.tz_localize("UTC")
 
-    # Split data by timestamp
-    old_data = df[df["time"] <= last_sync_time]
-    new_data = df[df["time"] > last_sync_time]
+    # Split prompts by when they were first seen
+    old_data = df[df["first_seen"] <= last_sync_time]
+    new_data = df[df["first_seen"] > last_sync_time]
 
-    # Process old data with 80/20 split if it exists
+    # Process old prompts with an 80/20 split if they exist. The split is decided by a hash of the prompt,
+    # so a prompt stays in the same split as its votes change and new prompts come in.
     if not old_data.empty:
-        old_data = old_data.sample(frac=1, random_state=42).reset_index(drop=True)
-        split_idx = max(1, int(len(old_data) * 0.8))
-
-        train_df = old_data.iloc[:split_idx][["input", "label"]]
-        test_df = old_data.iloc[split_idx:][["input", "label"]]
+        bucket = old_data["prompt_key"].map(lambda key: int(hashlib.sha256(key.encode()).hexdigest()[:8], 16))
+        is_test = bucket % 100 < USER_TEST_FRACTION * 100
 
-        train_path = PROCESSED_DIR / "user_train.parquet"
-        test_path = PROCESSED_DIR / "user_test.parquet"
+        train_df = feedback_labels(old_data[~is_test], label_mode, soft_resolution)
+        test_df = feedback_labels(old_data[is_test])
 
-        train_df.to_parquet(train_path, index=False)
-        test_df.to_parquet(test_path, index=False)
+        train_path = save_partition(train_df, "user", "train")
+        test_path = save_partition(test_df, "user", "test")
         print(f"Saved {len(train_df)} old samples to {train_path}")
         print(f"Saved {len(test_df)} old samples to {test_path}")
 
-    # Save new data to new_user_train.parquet
+    # Save new data to its own split, which is not selected by the train or test datasets
     if not new_data.empty:
-        new_train_df = new_data[["input", "label"]]
-        new_train_path = PROCESSED_DIR / "new_user_train.parquet"
-        new_train_df.to_parquet(new_train_path, index=False)
+        new_train_df = feedback_labels(new_data)
+        new_train_path = save_partition(new_train_df, "user", "new")
         print(f"Saved {len(new_train_df)} new samples to {new_train_path}")
 
-    # Update last sync timestamp with latest timestamp in df
-    latest_timestamp = df["time"].max()
+    # Update last sync timestamp with latest feedback in df
+    latest_timestamp = df["last_seen"].max()
     with open(sync_file, "w") as f:
         f.write(str(latest_timestamp))
     print(f"Updated last sync timestamp to {latest_timestamp}")
@@ -0,0 +1,204 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import typer
+
+# pyarrow and the tokenizer are imported by the command, so --help starts quickly
+if TYPE_CHECKING:
+    import pyarrow.dataset as ds
+    from transformers import BertTokenizerFast
+
+# Token lengths above this are counted in the last histogram bin
+MAX_TRACKED_LENGTH = 1024
+HISTOGRAM_EDGES = [0, 16, 32, 64, 96, 128, 192, 256, 384, 512, MAX_TRACKED_LENGTH]
+HISTOGRAM_LABELS = [f"{lo + 1}-{hi}" for lo, hi in zip(HISTOGRAM_EDGES[:-2], HISTOGRAM_EDGES[1:-1])] + [
+    f">{HISTOGRAM_EDGES[-2]}"
+]
+
+profile_app = typer.Typer()
+
+
+def data_hash(data_dir: Path, files: list[Path], tokenizer_name: str) -> str:
+    """
+    Cache key of the tokenizer and the parquet files: their partition paths, sizes, modification times and
+    footer metadata (row count, row groups and schema). Only the footers are read, not the data.
+    """
+    import pyarrow.parquet as pq
+
+    digest = hashlib.sha256(tokenizer_name.encode())
+    for file in files:
+        stat = file.stat()
+        metadata = pq.read_metadata(file)
+        fingerprint = {
+            "path": file.relative_to(data_dir).as_posix(),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "num_rows": metadata.num_rows,
+            "num_row_groups": metadata.num_row_groups,
+            "schema": metadata.schema.to_arrow_schema().to_string(),
+        }
+        digest.update(json.dumps(fingerprint, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def scan(dataset: "ds.Dataset", tokenizer: "BertTokenizerFast", batch_rows: int = 8192) -> dict[str, dict]:
+    """
+    Stream the processed dataset in row batches and count token lengths and labels per partition.
+
+    Returns:
+        "<subset>/<split>" mapped to `length_counts` (count per token length, capped at
+        MAX_TRACKED_LENGTH) and `labels` (true/false counts).
+    """
+    import pyarrow.dataset as ds
+
+    profiles: dict[str, dict] = {}
+    for fragment in sorted(dataset.get_fragments(), key=lambda fragment: fragment.path):
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        name = f"{keys['subset']}/{keys['split']}"
+        if name not in profiles:
+            profiles[name] = {
+                "length_counts": np.zeros(MAX_TRACKED_LENGTH + 1, dtype=np.int64),
+                "labels": {"true": 0, "false": 0},
+            }
+        counts = profiles[name]["length_counts"]
+        labels = profiles[name]["labels"]
+        for batch in fragment.to_batches(batch_size=batch_rows, columns=["input", "label"]):
+            texts = [str(t) for t in batch.column("input").to_pylist()]
+            encoding = tokenizer(texts, return_attention_mask=False, return_token_type_ids=False)
+            lengths = np.minimum([len(ids) for ids in encoding["input_ids"]], MAX_TRACKED_LENGTH)
+            counts += np.bincount(lengths, minlength=MAX_TRACKED_LENGTH + 1)
+
+            num_true = sum(bool(label) for label in batch.column("label").to_pylist())
+            labels["true"] += num_true
+            labels["false"] += batch.num_rows - num_true
+
+    for profile in profiles.values():
+        profile["length_counts"] = profile["length_counts"].tolist()
+    return profiles
+
+
+def truncation_rate(counts: np.ndarray, max_length: int) -> float:
+    """Fraction of examples longer than max_length tokens."""
+    return float(counts[max_length + 1 :].sum() / counts.sum())
+
+
+def padding_waste(counts: np.ndarray, max_length: int, batch_size: int) -> float:
+    """
+    Expected fraction of padding tokens when batches of random examples are padded to their longest.
+
+    With empirical length CDF F, the longest of `batch_size` examples is at most l with probability
+    F(l) ** batch_size, which gives the expected padded length exactly.
+    """
+    clipped = counts[: max_length + 1].astype(np.float64)
+    clipped[max_length] += counts[max_length + 1 :].sum()
+    pmf = clipped / clipped.sum()
+    cdf_max = np.cumsum(pmf) ** batch_size
+    lengths = np.arange(max_length + 1)
+    expected_max = float((lengths * np.diff(cdf_max, prepend=0.0)).sum())
+    expected_length = float((lengths * pmf).sum())
+    return 1 - expected_length / expected_max
+
+
+def summarize(
+    profiles: dict[str, dict], max_lengths: list[int], batch_sizes: list[int], max_length: int
+) -> dict[str, dict]:
+    """Derive histograms, truncation rates, padding waste and label balance from the raw counts."""
+    all_counts = np.sum([p["length_counts"] for p in profiles.values()], axis=0)
+    all_labels = {k: sum(p["labels"][k] for p in profiles.values()) for k in ["true", "false"]}
+    rows = {**profiles, "all": {"length_counts": all_counts, "labels": all_labels}}
+
+    summary = {}
+    for subset, profile in rows.items():
+        counts = np.asarray(profile["length_counts"])
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        lengths = np.arange(len(counts))
+        summary[subset] = {
+            "count": total,
+            "mean_length": float((lengths * counts).sum() / total),
+            "p95_length": int(np.searchsorted(np.cumsum(counts), 0.95 * total)),
+            "histogram": {
+                label: int(counts[lo + 1 : hi + 1].sum())
+                for label, lo, hi in zip(HISTOGRAM_LABELS, HISTOGRAM_EDGES, HISTOGRAM_EDGES[1:])
+            },
+            "truncation_rate": {str(m): truncation_rate(counts, m) for m in max_lengths},
+            "padding_waste": {str(b): padding_waste(counts, max_length, b) for b in batch_sizes},
+            "label_true_rate": profile["labels"]["true"] / total,
+        }
+    return summary
+
+
+@profile_app.command()
+def profile(
+    data_dir: Path = Path("data/processed"),
+    tokenizer_name: str = "bert-base-uncased",
+    max_lengths: list[int] = typer.Option([32, 64, 128, 256, 512]),
+    batch_sizes: list[int] = typer.Option([8, 16, 32, 64]),
+    max_length: int = 128,
+    batch_rows: int = 8192,
+    cache_dir: Path = Path(".cache/data_profile"),
+    refresh: bool = False,
+) -> None:
+    """
+    Profile token lengths of the processed data per subset and split.
+
+    Reports the token-length histogram, truncation rate at each --max-lengths candidate, the expected
+    padding waste at each --batch-sizes value (padding to at most --max-length) and the label balance.
+    Token-length counts are cached by file metadata (see data_hash), so repeated runs on unchanged data skip
+    tokenization and do not read the data.
+    """
+    from lucky_ai.dataset import open_processed
+
+    dataset = open_processed(data_dir)
+    files = sorted(Path(f) for f in dataset.files)
+    if not files:
+        raise FileNotFoundError(f"No parquet files found in {data_dir.absolute()}")
+
+    cache_file = cache_dir / f"{data_hash(data_dir, files, tokenizer_name)}.json"
+    if cache_file.exists() and not refresh:
+        profiles = json.loads(cache_file.read_text())
+    else:
+        from transformers import BertTokenizerFast
+
+        tokenizer = BertTokenizerFast.from_pretrained(tokenizer_name)
+        profiles = scan(dataset, tokenizer, batch_rows=batch_rows)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps(profiles))
+
+    summary = summarize(profiles, max_lengths, batch_sizes, max_length)
+
+    print("### Token lengths")
+    print()
+    print("| Subset | Count | Mean | p95 | True labels | " + " | ".join(HISTOGRAM_LABELS) + " |")
+    print("|--------|-------|------|-----|-------------|" + "|".join("---" for _ in HISTOGRAM_LABELS) + "|")
+    for subset, s in summary.items():
+        histogram = " | ".join(f"{n:,}" for n in s["histogram"].values())
+        print(
+            f"| {subset} | {s['count']:,} | {s['mean_length']:.1f} | {s['p95_length']} | "
+            f"{s['label_true_rate']:.1%} | {histogram} |"
+        )
+    print()
+
+    print("### Truncation rate by max_length")
+    print()
+    print("| Subset | " + " | ".join(str(m) for m in max_lengths) + " |")
+    print("|--------|" + "|".join("---" for _ in max_lengths) + "|")
+    for subset, s in summary.items():
+        print(f"| {subset} | " + " | ".join(f"{r:.1%}" for r in s["truncation_rate"].values()) + " |")
+    print()
+
+    print(f"### Expected padding waste by batch size (max_length={max_length})")
+    print()
+    print("| Subset | " + " | ".join(str(b) for b in batch_sizes) + " |")
+    print("|--------|" + "|".join("---" for _ in batch_sizes) + "|")
+    for subset, s in summary.items():
+        print(f"| {subset} | " + " | ".join(f"{w:.1%}" for w in s["padding_waste"].values()) + " |")
+    print()
+
+
+if __name__ == "__main__":
+    profile_app()
@@ -1,51 +1,253 @@
 import os
-import psycopg2
-import pandas as pd
-from dotenv import load_dotenv
+import unicodedata
+import uuid
+from datetime import datetime, timezone
+from functools import cache
+from typing import TYPE_CHECKING, Any, Iterable
 
-load_dotenv()
+if TYPE_CHECKING:
+    import pandas as pd
+    import psycopg2
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+# Idempotency keys of drained feedback are kept this long, so a spool segment replayed within this window
+# is not counted twice. Older keys are deleted, which keeps the key table bounded by recent traffic.
+IDEMPOTENCY_KEY_RETENTION_DAYS = 7
 
+# Arbitrary id of the advisory lock that serializes creating (and backfilling) the feedback tables
+SCHEMA_LOCK_ID = 4242
 
-def get_conn() -> psycopg2.extensions.connection:
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+# Whether the feedback tables have been ensured by this process
+_schema_ready = False
 
+# Vote counters per normalized prompt, updated by bulk upserts. Replaces the raw user_data rows.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_feedback (
+    prompt_key TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    yes_count INTEGER NOT NULL DEFAULT 0,
+    no_count INTEGER NOT NULL DEFAULT 0,
+    first_seen TIMESTAMPTZ NOT NULL,
+    last_seen TIMESTAMPTZ NOT NULL
+);
+-- The same votes split by the model version the user was answered by, to compare traffic-split variants
+CREATE TABLE IF NOT EXISTS user_feedback_by_version (
+    prompt_key TEXT NOT NULL,
+    model_version TEXT NOT NULL,
+    yes_count INTEGER NOT NULL DEFAULT 0,
+    no_count INTEGER NOT NULL DEFAULT 0,
+    first_seen TIMESTAMPTZ NOT NULL,
+    last_seen TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (prompt_key, model_version)
+);
+CREATE TABLE IF NOT EXISTS feedback_idempotency_keys (
+    idempotency_key TEXT PRIMARY KEY,
+    received TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
 
-def insert_user_data(prompt: str, label: str) -> None:
+UPSERT_FEEDBACK = """
+INSERT INTO user_feedback
+(prompt_key, prompt, yes_count, no_count, first_seen, last_seen)
+VALUES %s
+ON CONFLICT (prompt_key) DO UPDATE SET
+    yes_count = user_feedback.yes_count + EXCLUDED.yes_count,
+    no_count = user_feedback.no_count + EXCLUDED.no_count,
+    first_seen = LEAST(user_feedback.first_seen, EXCLUDED.first_seen),
+    last_seen = GREATEST(user_feedback.last_seen, EXCLUDED.last_seen)
+"""
+
+UPSERT_VERSION_FEEDBACK = """
+INSERT INTO user_feedback_by_version
+(prompt_key, model_version, yes_count, no_count, first_seen, last_seen)
+VALUES %s
+ON CONFLICT (prompt_key, model_version) DO UPDATE SET
+    yes_count = user_feedback_by_version.yes_count + EXCLUDED.yes_count,
+    no_count = user_feedback_by_version.no_count + EXCLUDED.no_count,
+    first_seen = LEAST(user_feedback_by_version.first_seen, EXCLUDED.first_seen),
+    last_seen = GREATEST(user_feedback_by_version.last_seen, EXCLUDED.last_seen)
+"""
+
+
+@cache
+def database_url() -> str | None:
+    """DATABASE_URL from the environment or .env, read on first connection rather than at import."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv("DATABASE_URL")
+
+
+def get_conn() -> "psycopg2.extensions.connection":
+    import psycopg2
+
+    return psycopg2.connect(database_url(), sslmode="require")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Key that votes on a prompt are counted under: NFKC-normalized, case-folded and single-spaced."""
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+
+def is_yes(label: Any) -> bool:
+    """Whether a feedback label ('yes'/'no' from the API, or a boolean) is a yes vote."""
+    return str(label).lower() in ("yes", "true")
+
+
+def aggregate_feedback(counts: Iterable[tuple[str, int, int, Any, Any]]) -> list[tuple]:
+    """
+    Merge (prompt, yes, no, first_seen, last_seen) counts into one row per normalized prompt.
+
+    Returns:
+        (prompt_key, prompt, yes_count, no_count, first_seen, last_seen) rows sorted by prompt_key, so
+        concurrent upserts lock rows in the same order. The prompt is the first spelling seen.
+    """
+    rows: dict[str, list] = {}
+    for prompt, yes, no, first_seen, last_seen in counts:
+        key = normalize_prompt(prompt)
+        if key not in rows:
+            rows[key] = [key, prompt, 0, 0, first_seen, last_seen]
+        row = rows[key]
+        row[2] += yes
+        row[3] += no
+        if first_seen < row[4]:
+            row[1], row[4] = prompt, first_seen
+        row[5] = max(row[5], last_seen)
+    return [tuple(rows[key]) for key in sorted(rows)]
+
+
+def aggregate_version_feedback(records: Iterable[dict[str, Any]]) -> list[tuple]:
+    """
+    Merge feedback records that name a model version into one row per normalized prompt and version.
+
+    Returns:
+        (prompt_key, model_version, yes_count, no_count, first_seen, last_seen) rows sorted by prompt_key
+        and version, so concurrent upserts lock rows in the same order.
+    """
+    by_version: dict[str, list[dict[str, Any]]] = {}
+    for r in records:
+        if r.get("model_version") is not None:
+            by_version.setdefault(r["model_version"], []).append(r)
+    rows = [
+        (key, version, yes, no, first_seen, last_seen)
+        for version, version_records in by_version.items()
+        for key, _, yes, no, first_seen, last_seen in aggregate_feedback(
+            (r["prompt"], int(is_yes(r["label"])), int(not is_yes(r["label"])), r["time"], r["time"])
+            for r in version_records
+        )
+    ]
+    return sorted(rows, key=lambda row: row[:2])
+
+
+def ensure_schema(cur: "psycopg2.extensions.cursor") -> None:
+    """
+    Create the feedback tables and delete expired idempotency keys.
+
+    When user_feedback is created, the raw user_data rows of earlier versions are backfilled into it.
+    """
+    import psycopg2.extras
+
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+    cur.execute("SELECT to_regclass('user_feedback') IS NULL, to_regclass('user_data') IS NOT NULL")
+    created, has_raw_rows = cur.fetchone()
+    cur.execute(SCHEMA)
+
+    if created and has_raw_rows:
+        # Group exact duplicates in the database, normalization merges the rest
+        cur.execute(
+            """
+            SELECT
+                prompt,
+                COUNT(*) FILTER (WHERE label),
+                COUNT(*) FILTER (WHERE NOT label),
+                COALESCE(MIN(time), now()),
+                COALESCE(MAX(time), now())
+            FROM user_data
+            GROUP BY prompt
+            """
+        )
+        psycopg2.extras.execute_values(cur, UPSERT_FEEDBACK, aggregate_feedback(cur.fetchall()))
+
+    cur.execute(
+        "DELETE FROM feedback_idempotency_keys WHERE received < now() - %s * INTERVAL '1 day'",
+        (IDEMPOTENCY_KEY_RETENTION_DAYS,),
+    )
+
+
+def upsert_feedback_bulk(records: list[dict[str, Any]]) -> None:
+    """
+    Add spooled feedback records to the per-prompt vote counters in one transaction.
+
+    Records whose idempotency key was already stored (e.g. a spool segment replayed after a crash)
+    are skipped, so every click is counted once.
+    """
+    import psycopg2.extras
+
+    global _schema_ready
+    unique = list({r["idempotency_key"]: r for r in records}.values())
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
+            if not _schema_ready:
+                ensure_schema(cur)
+            fresh = psycopg2.extras.execute_values(
+                cur,
                 """
-                INSERT INTO user_data
-                (prompt, label)
-                VALUES (%s, %s)
+                INSERT INTO feedback_idempotency_keys
+                (idempotency_key)
+                VALUES %s
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING idempotency_key
             """,
-                (prompt, label),
+                [(r["idempotency_key"],) for r in unique],
+                fetch=True,
             )
+            fresh_keys = {key for (key,) in fresh}
+            fresh_records = [r for r in unique if r["idempotency_key"] in fresh_keys]
+            rows = aggregate_feedback(
+                (r["prompt"], int(is_yes(r["label"])), int(not is_yes(r["label"])), r["time"], r["time"])
+                for r in fresh_records
+            )
+            if rows:
+                psycopg2.extras.execute_values(cur, UPSERT_FEEDBACK, rows)
+            version_rows = aggregate_version_feedback(fresh_records)
+            if version_rows:
+                psycopg2.extras.execute_values(cur, UPSERT_VERSION_FEEDBACK, version_rows)
             conn.commit()
+            _schema_ready = True
     finally:
         conn.close()
 
 
-def fetch_user_data() -> pd.DataFrame:
-    """Fetch all user data from the database and return as a pandas DataFrame."""
-    conn = get_conn()
+def insert_user_data(prompt: str, label: Any) -> None:
+    """Count a single vote, as if it was submitted through the API."""
+    now = datetime.now(timezone.utc).isoformat()
+    upsert_feedback_bulk([{"idempotency_key": uuid.uuid4().hex, "prompt": prompt, "label": label, "time": now}])
 
-    df = pd.read_sql(
-        """
-        SELECT prompt, label, time
-        FROM user_data
-        """,
-        conn,
-    )
 
-    conn.close()
+def fetch_user_feedback() -> "pd.DataFrame":
+    """Fetch the vote counters of every prompt and return them as a pandas DataFrame."""
+    import pandas as pd
+
+    conn = get_conn()
+    try:
+        # Creates the table, backfilled from user_data, if no feedback has been drained since upgrading
+        with conn.cursor() as cur:
+            ensure_schema(cur)
+        conn.commit()
+
+        df = pd.read_sql(
+            """
+            SELECT prompt_key, prompt, yes_count, no_count, first_seen, last_seen
+            FROM user_feedback
+            """,
+            conn,
+        )
+    finally:
+        conn.close()
     return df
 
 
 if __name__ == "__main__":
     # Example usage
-    df = fetch_user_data()
+    df = fetch_user_feedback()
     print(df)
@@ -1,44 +1,168 @@
-import os
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import torch
 import pytorch_lightning as pl
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from transformers import BertTokenizerFast
-from typing import Optional
+from typing import Iterator, Optional
+
+
+# Hive partitioning of the processed dataset written by lucky_ai.data
+PARTITIONING = ds.partitioning(pa.schema([("subset", pa.string()), ("split", pa.string())]), flavor="hive")
+
+
+def open_processed(data_dir: Path) -> ds.Dataset:
+    """Open the partitioned processed dataset, ignoring files outside the subset=*/split=* layout."""
+    files = sorted(str(path) for path in data_dir.glob("subset=*/split=*/*.parquet"))
+    if not files and any(data_dir.glob("*.parquet")):
+        raise FileNotFoundError(
+            f"{data_dir.absolute()} holds flat <subset>_<split>.parquet files from an earlier version. "
+            f"Convert them to the subset=*/split=* layout with `migrate-processed --processed-dir {data_dir}`."
+        )
+    return ds.dataset(files, format="parquet", partitioning=PARTITIONING, partition_base_dir=str(data_dir))
+
+
+def _read_fragment(fragment: ds.ParquetFileFragment) -> pa.Table:
+    """Read the input and label columns of a fragment, plus its subset from the partition path."""
+    table = fragment.to_table(columns=["input", "label"])
+    subset = ds.get_partition_keys(fragment.partition_expression)["subset"]
+    return table.append_column("subset", pa.array([subset] * table.num_rows, pa.string()))
+
+
+def example_keys(df: pd.DataFrame) -> np.ndarray:
+    """
+    Stable 64-bit key per row from its subset, input and label, used to match rows to a coreset selection.
+
+    Soft labels are written as repeated rows, so the key also counts the earlier copies of the row: the
+    n-th copy is selected or dropped on its own, and a copy added later is a new row.
+    """
+    content = df[["subset", "input", "label"]]
+    copy = content.groupby(list(content.columns), sort=False, dropna=False).cumcount().rename("copy")
+    return pd.util.hash_pandas_object(pd.concat([content, copy], axis=1), index=False).to_numpy()
+
+
+def apply_selection(df: pd.DataFrame, selection: str) -> pd.DataFrame:
+    """
+    Keep the rows a coreset selection index selects, plus rows added since it was built.
+
+    The index (written by lucky_ai.coreset) lists the key of every row it considered and whether it was
+    selected. Rows are matched by content, so the index stays valid when partitions are rewritten.
+    """
+    index = pd.read_parquet(selection, columns=["key", "selected"])
+    keys = example_keys(df)
+    keep = ~np.isin(keys, index["key"].to_numpy()) | np.isin(keys, index.loc[index["selected"], "key"].to_numpy())
+    return df[keep].reset_index(drop=True)
 
 
 class LuckyDataset(Dataset):
-    """Dataset with questions and boolean dilemmas."""
+    """
+    Dataset with questions and boolean dilemmas.
 
-    def __init__(self, train: bool = True, data_dir: str = "data/processed") -> None:
+    Reads the train or test split of the processed parquet dataset, optionally restricted to some
+    `subsets`. The split and subset filters select partitions before anything is read, and only the
+    input and label columns are loaded.
+
+    For data-parallel training pass the process `rank` and `world_size`: the selected rows are then
+    split into `world_size` equal contiguous shards and only this rank's shard is read. `split_subsets`
+    holds the subset of every row of all shards, and `shard_start` the position of this shard's first row.
+
+    An optional coreset `selection` index restricts the rows to the selected ones. It matches rows by
+    content, so with a selection the whole split is read and sharded after filtering.
+    """
+
+    def __init__(
+        self,
+        train: bool = True,
+        data_dir: str = "data/processed",
+        subsets: Optional[list[str]] = None,
+        rank: int = 0,
+        world_size: int = 1,
+        selection: Optional[str] = None,
+    ) -> None:
         super().__init__()
 
         self.name: str = "LuckyDataset_train" if train else "LuckyDataset_test"
         self.mode = "train" if train else "test"
         self.data_dir = Path(data_dir)
+        self.subsets = list(subsets) if subsets is not None else None
+        self.rank = rank
+        self.world_size = world_size
+        self.selection = selection
         self.load_data()
 
     def load_data(self) -> None:
-        """Load all matching parquet files into a DataFrame."""
+        """Load the selected partitions (or this rank's shard of them) into a DataFrame."""
 
         if not self.data_dir.exists():
             raise FileNotFoundError(f"Data directory not found: {self.data_dir.absolute()}")
 
-        dfs = []
-        for f in os.listdir(self.data_dir):
-            if self.mode not in f:
+        dataset = open_processed(self.data_dir)
+        selection = pc.field("split") == self.mode
+        if self.subsets is not None:
+            selection &= pc.field("subset").isin(self.subsets)
+
+        # Sorted so every rank, on every host, sees the row groups in the same order
+        fragments = sorted(dataset.get_fragments(filter=selection), key=lambda fragment: fragment.path)
+        if not fragments:
+            raise ValueError(f"No data found for mode '{self.mode}' and subsets {self.subsets} in {self.data_dir}")
+        # Every subset of the split, including those outside this rank's shard
+        self.subset_names = sorted({ds.get_partition_keys(f.partition_expression)["subset"] for f in fragments})
+
+        if self.world_size > 1 and self.selection is None:
+            self.df = pa.concat_tables(self._read_shard(fragments)).to_pandas()
+            return
+
+        df = pa.concat_tables([_read_fragment(fragment) for fragment in fragments]).to_pandas()
+        if self.selection is not None:
+            df = apply_selection(df, self.selection)
+        self.split_subsets = df["subset"].to_numpy()
+        self.shard_start = 0
+        if self.world_size > 1:
+            shard_size = len(df) // self.world_size
+            if shard_size == 0:
+                raise ValueError(f"Cannot shard {len(df)} selected rows over {self.world_size} processes")
+            self.split_subsets = self.split_subsets[: shard_size * self.world_size]
+            self.shard_start = self.rank * shard_size
+            df = df.iloc[self.shard_start : self.shard_start + shard_size].reset_index(drop=True)
+        self.df = df
+
+    def _read_shard(self, fragments: list[ds.ParquetFileFragment]) -> list[pa.Table]:
+        """
+        Read the rows of this rank's shard, touching only the row groups that overlap it.
+
+        Shards are equal in size (the remainder rows are dropped), so every rank runs the same number of
+        steps and sync_dist averages of per-rank metrics equal the metric over all shards.
+        """
+        row_groups = []  # (row group fragment, index of its first row over all fragments)
+        subsets, sizes = [], []  # Subset and number of rows of every fragment, from the metadata only
+        total = 0
+        for fragment in fragments:
+            subsets.append(ds.get_partition_keys(fragment.partition_expression)["subset"])
+            sizes.append(0)
+            for row_group in fragment.split_by_row_group():
+                row_groups.append((row_group, total))
+                total += row_group.row_groups[0].num_rows
+                sizes[-1] += row_group.row_groups[0].num_rows
+
+        shard_size = total // self.world_size
+        if shard_size == 0:
+            raise ValueError(f"Cannot shard {total} '{self.mode}' rows over {self.world_size} processes")
+        start, end = self.rank * shard_size, (self.rank + 1) * shard_size
+        self.split_subsets = np.repeat(np.array(subsets, dtype=object), sizes)[: shard_size * self.world_size]
+        self.shard_start = start
+
+        tables = []
+        for row_group, first in row_groups:
+            num_rows = row_group.row_groups[0].num_rows
+            if first + num_rows <= start or first >= end:
                 continue
-            df = pd.read_parquet(self.data_dir / f)
-
-            subset_name = f.replace(".parquet", "")
-            df["subset"] = subset_name
-            dfs.append(df)
-
-        if not dfs:
-            raise ValueError(f"No data files found for mode '{self.mode}' in {self.data_dir}")
-
-        self.df = pd.concat(dfs, ignore_index=True)
+            offset = max(start - first, 0)
+            tables.append(_read_fragment(row_group).slice(offset, min(end - first, num_rows) - offset))
+        return tables
 
     def __getitem__(self, idx: int) -> tuple[str, bool]:
         """Return question (string) and target (bool)."""
@@ -50,8 +174,122 @@ class LuckyDataset(Dataset):
         return len(self.df)
 
 
+class IndexedDataset(Dataset):
+    """Wraps a dataset so every item also carries its index, used to attribute losses to examples."""
+
+    def __init__(self, dataset: LuckyDataset) -> None:
+        super().__init__()
+        self.dataset = dataset
+
+    def __getitem__(self, idx: int) -> tuple[str, bool, int]:
+        question, label = self.dataset[idx]
+        return question, label, idx
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+class HardExampleSampler(Sampler[int]):
+    """
+    Samples training examples with replacement, weighted towards high-loss and misclassified examples.
+
+    Every epoch draws `quotas[subset] * num_samples` examples from each subset. Within a subset an
+    example's probability is a mix of uniform sampling (weight `floor`, so every example keeps being
+    seen) and its hardness: an exponential moving average of its loss, plus `misclassified_bonus` if it
+    was misclassified the last time it was seen. Unseen examples start at the loss of a uniform guess.
+    """
+
+    def __init__(
+        self,
+        subsets: list[str],
+        num_samples: Optional[int] = None,
+        quotas: Optional[dict[str, float]] = None,
+        floor: float = 0.2,
+        ema: float = 0.5,
+        misclassified_bonus: float = 1.0,
+        seed: int = 0,
+    ) -> None:
+        self.subsets = np.asarray(subsets)
+        self.num_samples = num_samples or len(self.subsets)
+        self.floor = floor
+        self.ema = ema
+        self.misclassified_bonus = misclassified_bonus
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.subset_indices = {s: np.flatnonzero(self.subsets == s) for s in np.unique(self.subsets)}
+        if quotas is None:
+            quotas = {s: len(idx) / len(self.subsets) for s, idx in self.subset_indices.items()}
+        total = sum(quotas.get(s, 0.0) for s in self.subset_indices)
+        self.quotas = {s: quotas.get(s, 0.0) / total for s in self.subset_indices}
+
+        self.losses = np.full(len(self.subsets), np.log(2), dtype=np.float64)
+        self.misclassified = np.zeros(len(self.subsets), dtype=bool)
+
+    def update(self, indices: torch.Tensor, losses: torch.Tensor, correct: torch.Tensor) -> None:
+        """Record the per-example losses and correctness from a training step."""
+        idx = indices.cpu().numpy()
+        self.losses[idx] = self.ema * self.losses[idx] + (1 - self.ema) * losses.float().cpu().numpy()
+        self.misclassified[idx] = ~correct.cpu().numpy()
+
+    def weights(self, indices: np.ndarray) -> torch.Tensor:
+        """Sampling probabilities of the given examples, normalized within them."""
+        hardness = self.losses[indices] + self.misclassified_bonus * self.misclassified[indices]
+        total = hardness.sum()
+        if not np.isfinite(total) or total <= 0:
+            # A fully learned subset (every loss 0) gives no preference: sample it uniformly
+            return torch.full((len(indices),), 1 / len(indices), dtype=torch.float64)
+        probs = self.floor / len(indices) + (1 - self.floor) * hardness / total
+        return torch.as_tensor(probs, dtype=torch.float64)
+
+    def __iter__(self) -> Iterator[int]:
+        samples = []
+        counts = self._counts()
+        for subset, indices in self.subset_indices.items():
+            n = counts[subset]
+            if n == 0:
+                continue
+            picks = torch.multinomial(self.weights(indices), n, replacement=True, generator=self.generator)
+            samples.append(torch.as_tensor(indices)[picks])
+        order = torch.cat(samples)
+        order = order[torch.randperm(len(order), generator=self.generator)]
+        return iter(order.tolist())
+
+    def _counts(self) -> dict[str, int]:
+        """
+        Samples per subset, apportioned by largest remainder so they add up to exactly num_samples.
+
+        An exact epoch length keeps data-parallel ranks, whose shards hold different subsets, in step.
+        """
+        exact = {s: q * self.num_samples for s, q in self.quotas.items()}
+        counts = {s: int(x) for s, x in exact.items()}
+        shortfall = self.num_samples - sum(counts.values())
+        for s in sorted(exact, key=lambda s: counts[s] - exact[s])[:shortfall]:
+            counts[s] += 1
+        return counts
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+
+def stratified_sample(subset_ids: np.ndarray, per_subset: int, seed: int = 0) -> np.ndarray:
+    """Sorted indices of up to `per_subset` examples drawn without replacement from every subset."""
+    rng = np.random.default_rng(seed)
+    picks = [
+        rng.choice(indices, min(per_subset, len(indices)), replace=False)
+        for indices in (np.flatnonzero(subset_ids == s) for s in np.unique(subset_ids))
+    ]
+    return np.sort(np.concatenate(picks)) if picks else np.array([], dtype=np.int64)
+
+
 class LuckyDataModule(pl.LightningDataModule):
-    """Bridges raw strings to BERT tensors using a fast tokenizer"""
+    """
+    Bridges raw strings to BERT tensors using a fast tokenizer
+
+    With `val_samples_per_subset` > 0 most validation passes run on a fixed stratified sample of the test
+    set (drawn over the whole split, so data-parallel ranks validate on their parts of one sample), and
+    the full test set is used every `full_val_every` epochs, in the last epoch and by `Trainer.validate`. The Trainer must then reload dataloaders every epoch. Validation batches are
+    sorted by question length and carry the subset of every example, for per-subset metrics.
+    """
 
     def __init__(
         self,
@@ -59,32 +297,106 @@ class LuckyDataModule(pl.LightningDataModule):
         batch_size: int = 16,
         num_workers: int = 0,
         data_dir: str = "data/processed",
+        subsets: Optional[list[str]] = None,
+        sampling: str = "uniform",
+        hard_floor: float = 0.2,
+        subset_quotas: Optional[dict[str, float]] = None,
+        selection: Optional[str] = None,
+        val_samples_per_subset: int = 0,
+        full_val_every: int = 5,
     ) -> None:
         super().__init__()
+        if sampling not in ["uniform", "hard"]:
+            raise ValueError(f"Invalid sampling '{sampling}'. Must be 'uniform' or 'hard'.")
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.tokenizer = BertTokenizerFast.from_pretrained(model_name)
         self.data_dir = data_dir
+        self.subsets = subsets
+        self.sampling = sampling
+        self.hard_floor = hard_floor
+        self.subset_quotas = subset_quotas
+        self.selection = selection
+        self.val_samples_per_subset = val_samples_per_subset
+        self.full_val_every = full_val_every
+        self.sampler: Optional[HardExampleSampler] = None
+        # Whether the last validation dataloader covers the full test set
+        self.val_full = True
 
     def setup(self, stage: Optional[str] = None) -> None:
-        """Initializes the datasets"""
-        self.train_set = LuckyDataset(train=True, data_dir=self.data_dir)
-        self.test_set = LuckyDataset(train=False, data_dir=self.data_dir)
-
-    def collate_fn(self, batch: list[tuple[str, bool]]) -> dict[str, torch.Tensor]:
+        """Initializes the datasets, sharded by process when training data-parallel"""
+        rank, world_size = 0, 1
+        if self.trainer is not None:
+            rank, world_size = self.trainer.global_rank, self.trainer.world_size
+        self.train_set = LuckyDataset(
+            train=True,
+            data_dir=self.data_dir,
+            subsets=self.subsets,
+            rank=rank,
+            world_size=world_size,
+            selection=self.selection,
+        )
+        self.test_set = LuckyDataset(
+            train=False, data_dir=self.data_dir, subsets=self.subsets, rank=rank, world_size=world_size
+        )
+        self.val_subsets = self.test_set.subset_names
+        self.val_subset_ids = pd.Categorical(self.test_set.df["subset"], categories=self.val_subsets).codes
+        # Test examples per subset in this rank's shard, the weights of the stratified accuracy
+        self.val_population = np.bincount(self.val_subset_ids, minlength=len(self.val_subsets))
+        self.val_sample = self._shard_sample()
+
+        if self.sampling == "hard":
+            self.sampler = HardExampleSampler(
+                self.train_set.df["subset"].tolist(), quotas=self.subset_quotas, floor=self.hard_floor
+            )
+
+    def _shard_sample(self) -> np.ndarray:
+        """
+        This rank's part of the stratified validation sample, as indices into its shard of the test set.
+
+        The sample is drawn once over the whole test split, the same on every rank, so it holds
+        `val_samples_per_subset` examples per subset in total whatever the number of ranks. A rank whose
+        shard got none of them validates on its first example: a rank without validation batches skips
+        the validation loop and would leave the others waiting in its collectives.
+        """
+        split_ids = pd.Categorical(self.test_set.split_subsets, categories=self.val_subsets).codes
+        sample = stratified_sample(split_ids, self.val_samples_per_subset) - self.test_set.shard_start
+        sample = sample[(sample >= 0) & (sample < len(self.test_set))]
+        if len(sample) == 0 and self.val_samples_per_subset > 0:
+            sample = np.array([0], dtype=np.int64)
+        return sample
+
+    def record_losses(self, indices: torch.Tensor, losses: torch.Tensor, correct: torch.Tensor) -> None:
+        """Feed per-example training losses back to the hard-example sampler."""
+        if self.sampler is not None:
+            self.sampler.update(indices, losses, correct)
+
+    def collate_fn(self, batch: list[tuple]) -> dict[str, torch.Tensor]:
         """Tokenizes text and converts labels to tensors for the model"""
         texts = [item[0] for item in batch]
         labels = [item[1] for item in batch]
 
         encodings = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=128)
 
-        return {
+        output = {
             "input_ids": encodings["input_ids"],
             "attention_mask": encodings["attention_mask"],
             "labels": torch.tensor(labels).long(),
         }
+        # Items from an IndexedDataset also carry their dataset index
+        if batch and len(batch[0]) == 3:
+            output["indices"] = torch.tensor([item[2] for item in batch])
+        return output
 
     def train_dataloader(self) -> DataLoader:
+        if self.sampler is not None:
+            return DataLoader(
+                IndexedDataset(self.train_set),
+                batch_size=self.batch_size,
+                collate_fn=self.collate_fn,
+                sampler=self.sampler,
+                num_workers=self.num_workers,
+            )
         return DataLoader(
             self.train_set,
             batch_size=self.batch_size,
@@ -93,8 +405,31 @@ class LuckyDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
         )
 
+    def val_collate_fn(self, batch: list[tuple]) -> dict[str, torch.Tensor]:
+        """collate_fn for validation items from an IndexedDataset, with subset ids instead of indices"""
+        output = self.collate_fn(batch)
+        output["subset_ids"] = torch.as_tensor(self.val_subset_ids[output.pop("indices").numpy()], dtype=torch.long)
+        return output
+
+    def full_validation(self) -> bool:
+        """Whether the current validation pass runs on the full test set rather than the sample."""
+        if self.val_samples_per_subset <= 0 or self.trainer is None or self.trainer.state.fn != "fit":
+            return True
+        epoch, max_epochs = self.trainer.current_epoch + 1, self.trainer.max_epochs
+        return epoch % self.full_val_every == 0 or (max_epochs is not None and 0 < max_epochs <= epoch)
+
     def val_dataloader(self) -> DataLoader:
-        return DataLoader(self.test_set, batch_size=self.batch_size, collate_fn=self.collate_fn, num_workers=0)
+        self.val_full = self.full_validation()
+        indices = np.arange(len(self.test_set)) if self.val_full else self.val_sample
+        # Batches of similar lengths need less padding
+        lengths = self.test_set.df["input"].astype(str).str.len().to_numpy()[indices]
+        order = indices[np.argsort(lengths, kind="stable")].tolist()
+        return DataLoader(
+            IndexedDataset(self.test_set),
+            batch_sampler=[order[i : i + self.batch_size] for i in range(0, len(order), self.batch_size)],
+            collate_fn=self.val_collate_fn,
+            num_workers=self.num_workers,
+        )
 
 
 def dataset_statistics():
@@ -2,7 +2,7 @@ import os
 import wandb
 from transformers import BertTokenizerFast, BertModel
 
-MODEL_DIR = "/app/model"
+MODEL_DIR = "/app/models"
 TOKENIZER_DIR = "/app/tokenizer"
 
 wandb_api = wandb.Api(
@@ -16,7 +16,8 @@ wandb_api = wandb.Api(
 artifact_name = os.getenv("WANDB_ARTIFACT", "lucky_ai/lucky-ai/lucky_bert:latest")
 artifact = wandb_api.artifact(artifact_name)
 
-artifact.download(root=MODEL_DIR)
+# Each artifact version gets its own directory so the API registry can load and swap between them
+artifact.download(root=f"{MODEL_DIR}/{artifact.version}")
 BertModel.from_pretrained("bert-base-uncased")
 
 tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased", cache_dir=TOKENIZER_DIR)
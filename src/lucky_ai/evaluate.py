@@ -0,0 +1,55 @@
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+
+from lucky_ai.dataset import LuckyDataset
+from lucky_ai.inference import LuckyPredictor
+from lucky_ai.model import LuckyBertModel
+
+
+def count_parameters(model: torch.nn.Module) -> int:
+    """Total number of parameters in the model."""
+    return sum(p.numel() for p in model.parameters())
+
+
+def evaluate_subsets(
+    model: LuckyBertModel,
+    dataset: LuckyDataset,
+    collate_fn: Callable[[list[tuple[str, bool]]], dict[str, torch.Tensor]],
+    batch_size: int = 64,
+) -> dict[str, float]:
+    """Accuracy of the model on every subset of the dataset."""
+    model.eval()
+    accuracies = {}
+    with torch.inference_mode():
+        for subset, df in dataset.df.groupby("subset"):
+            correct = 0
+            for start in range(0, len(df), batch_size):
+                chunk = df.iloc[start : start + batch_size]
+                batch = collate_fn(list(zip(chunk["input"].astype(str), chunk["label"].astype(bool))))
+                preds = model(batch["input_ids"], batch["attention_mask"]).argmax(dim=1)
+                correct += int((preds == batch["labels"]).sum())
+            accuracies[str(subset)] = correct / len(df)
+    return accuracies
+
+
+def measure_latency(
+    predictor: LuckyPredictor, questions: list[str], warmup: int = 5, batch_size: int = 1
+) -> dict[str, float]:
+    """Latency of batches of questions through the serving path in milliseconds, and questions/sec."""
+    batches = [questions[i : i + batch_size] for i in range(0, len(questions), batch_size)]
+    for batch in batches[:warmup]:
+        predictor.predict(batch)
+
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        predictor.predict(batch)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "throughput": len(questions) / (sum(latencies) / 1000),
+    }
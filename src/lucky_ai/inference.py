@@ -0,0 +1,127 @@
+import json
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import torch
+from torch.nn import Softmax
+from transformers import BertTokenizerFast
+
+from lucky_ai.model import LuckyBertModel
+
+# Sequence lengths the forward path is compiled for. Questions are padded up to the nearest bucket.
+SEQ_LEN_BUCKETS: tuple[int, ...] = (16, 32, 64, 128)
+COMPILE_MODES = ("trace", "compile", "none")
+PRECISIONS = ("fp32", "bf16")
+
+ForwardFn = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+
+
+class LuckyPredictor:
+    """
+    Inference wrapper around a LuckyBertModel with shape-bucketed compilation and warmup.
+
+    Attributes:
+        model: The fine-tuned model in eval mode.
+        tokenizer: Fast tokenizer matching the model.
+        buckets: Sorted sequence-length buckets the forward path is compiled for.
+        precision: "fp32", or "bf16" to run the forward path under bfloat16 autocast.
+        ready: Event set once every bucket has been compiled and warmed up.
+    """
+
+    def __init__(
+        self,
+        model: LuckyBertModel,
+        tokenizer: BertTokenizerFast,
+        buckets: tuple[int, ...] = SEQ_LEN_BUCKETS,
+        compile_mode: str = "trace",
+        precision: str = "fp32",
+    ) -> None:
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Invalid compile mode '{compile_mode}'. Must be one of {COMPILE_MODES}.")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Invalid precision '{precision}'. Must be one of {PRECISIONS}.")
+
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.buckets = tuple(sorted(buckets))
+        self.max_length = self.buckets[-1]
+        self.compile_mode = compile_mode
+        self.precision = precision
+        self.softmax = Softmax(dim=1)
+        self.ready = threading.Event()
+        self._forwards: dict[int, ForwardFn] = {}
+
+    def bucket_for(self, length: int) -> int:
+        """Return the smallest bucket that fits a sequence of the given length."""
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return self.max_length
+
+    def tokenize(self, questions: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
+        """Tokenize questions and pad them up to the nearest sequence-length bucket."""
+        encoding = self.tokenizer(questions, truncation=True, max_length=self.max_length)
+        longest = max(len(ids) for ids in encoding["input_ids"])
+        padded = self.tokenizer.pad(
+            encoding, padding="max_length", max_length=self.bucket_for(longest), return_tensors="pt"
+        )
+        return padded["input_ids"], padded["attention_mask"]
+
+    def _example_inputs(self, bucket: int) -> tuple[torch.Tensor, torch.Tensor]:
+        input_ids = torch.full((1, bucket), self.tokenizer.pad_token_id or 0, dtype=torch.long)
+        attention_mask = torch.ones((1, bucket), dtype=torch.long)
+        return input_ids, attention_mask
+
+    def _autocast(self) -> torch.autocast:
+        # Traced graphs are recorded in fp32, autocast applies to them at call time
+        return torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.precision == "bf16")
+
+    def compile(self) -> None:
+        """Build a forward function for every bucket according to the compile mode."""
+        compiled = torch.compile(self.model, dynamic=False) if self.compile_mode == "compile" else None
+
+        with torch.no_grad():
+            for bucket in self.buckets:
+                if self.compile_mode == "trace":
+                    self._forwards[bucket] = self.model.to_torchscript(
+                        method="trace", example_inputs=self._example_inputs(bucket)
+                    )
+                elif compiled is not None:
+                    self._forwards[bucket] = compiled
+                else:
+                    self._forwards[bucket] = self.model
+
+    def warmup(self, passes: int = 2) -> None:
+        """Compile the forward path and run warmup passes through every bucket, then mark as ready."""
+        self.compile()
+        with torch.inference_mode(), self._autocast():
+            for bucket in self.buckets:
+                input_ids, attention_mask = self._example_inputs(bucket)
+                for _ in range(passes):
+                    self._forwards[bucket](input_ids, attention_mask)
+        self.ready.set()
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """Run the compiled forward for the input's bucket, falling back to the eager model."""
+        fn = self._forwards.get(input_ids.shape[1], self.model)
+        with torch.inference_mode(), self._autocast():
+            return fn(input_ids, attention_mask)
+
+    def predict(self, questions: list[str]) -> np.ndarray:
+        """Return an array of shape (len(questions), 2) with yes/no probabilities."""
+        input_ids, attention_mask = self.tokenize(questions)
+        return self.softmax(self.forward(input_ids, attention_mask).float()).numpy()
+
+
+def apply_inference_profile(path: str) -> dict[str, Any]:
+    """Set torch thread counts from a profile written by the autotune command and return the profile."""
+    profile = json.loads(Path(path).read_text())
+    torch.set_num_threads(profile["intra_op_threads"])
+    try:
+        torch.set_num_interop_threads(profile["inter_op_threads"])
+    except RuntimeError:
+        # Only possible before any inter-op parallel work has started in this process
+        print(f"Could not set inter-op threads to {profile['inter_op_threads']}, keeping the default.")
+    return profile
@@ -0,0 +1,83 @@
+import copy
+import math
+from typing import Any, Optional
+
+import torch
+from torch import nn
+
+# Projections of every encoder layer that get an adapter: the attention query/key/value and output
+# projections, and the two FFN projections
+LORA_TARGETS = (
+    "attention.self.query",
+    "attention.self.key",
+    "attention.self.value",
+    "attention.output.dense",
+    "intermediate.dense",
+    "output.dense",
+)
+
+
+class LoRALinear(nn.Module):
+    """
+    A frozen nn.Linear plus a trainable low-rank update: base(x) + B(A(dropout(x))) * alpha / rank.
+
+    B starts at zero, so a freshly injected adapter leaves the outputs of the base model unchanged.
+    """
+
+    def __init__(self, base: nn.Linear, rank: int, alpha: float = 16.0, dropout: float = 0.0) -> None:
+        super().__init__()
+        self.base = base
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout)
+        self.lora_A = nn.Linear(base.in_features, rank, bias=False)
+        self.lora_B = nn.Linear(rank, base.out_features, bias=False)
+        nn.init.kaiming_uniform_(self.lora_A.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_B.weight)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.base(x) + self.lora_B(self.lora_A(self.dropout(x))) * self.scaling
+
+    def merged(self) -> nn.Linear:
+        """A plain nn.Linear with the update folded into a new weight. The base layer is left untouched."""
+        merged = nn.Linear(self.base.in_features, self.base.out_features, bias=self.base.bias is not None)
+        with torch.no_grad():
+            merged.weight.copy_(self.base.weight + self.lora_B.weight @ self.lora_A.weight * self.scaling)
+            if self.base.bias is not None:
+                merged.bias = self.base.bias
+        return merged.requires_grad_(False)
+
+
+def inject_lora(
+    bert: nn.Module, rank: int, alpha: float = 16.0, dropout: float = 0.0, targets: Optional[list[str]] = None
+) -> None:
+    """Wrap the target projections of every encoder layer of a BertModel in LoRALinear adapters."""
+    for layer in bert.encoder.layer:
+        for target in targets or LORA_TARGETS:
+            parent_name, _, name = target.rpartition(".")
+            parent = layer.get_submodule(parent_name)
+            setattr(parent, name, LoRALinear(getattr(parent, name), rank, alpha=alpha, dropout=dropout))
+
+
+def merge_lora(module: nn.Module) -> None:
+    """Replace every LoRALinear in a module by its merged nn.Linear, so inference runs plain matmuls."""
+    for name, child in list(module.named_children()):
+        if isinstance(child, LoRALinear):
+            setattr(module, name, child.merged())
+        else:
+            merge_lora(child)
+
+
+def share_weights(module: nn.Module) -> nn.Module:
+    """
+    Copy a module's structure while sharing its parameters and buffers.
+
+    Adapters injected into (or merged into) the copy replace submodules of the copy only, so many
+    adapters can be served on top of one base model in memory.
+    """
+    memo: dict[int, Any] = {id(t): t for t in (*module.parameters(), *module.buffers())}
+    return copy.deepcopy(module, memo)
+
+
+def lora_state_dict(state_dict: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    """The adapter and classifier weights of a LuckyBertModel state dict, i.e. what an adapter checkpoint holds."""
+    return {k: v for k, v in state_dict.items() if ".lora_" in k or k.startswith("classifier.")}
@@ -1,9 +1,33 @@
-from typing import Any
+from typing import Any, Optional
 
 import pytorch_lightning as pl
 import torch
 from torch import nn
 from transformers import BertModel
+from transformers.pytorch_utils import prune_linear_layer
+
+from lucky_ai.lora import inject_lora, lora_state_dict
+
+
+def stratified_accuracy(
+    correct: torch.Tensor, count: torch.Tensor, population: torch.Tensor, z: float = 1.96
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Accuracy over the whole population estimated from per-subset samples, with confidence intervals.
+
+    Subset accuracies are weighted by subset size. The half-widths of the (by default 95%) normal
+    approximation intervals include the finite population correction, so they are zero when every
+    example was evaluated.
+
+    Returns:
+        Overall accuracy, its interval half-width, and the accuracy and half-width of every subset.
+    """
+    correct, count, population = correct.double(), count.double(), population.double()
+    acc = correct / count.clamp_min(1)
+    fpc = ((population - count) / (population - 1).clamp_min(1)).clamp_min(0)
+    variance = acc * (1 - acc) / count.clamp_min(1) * fpc
+    weights = population / population.sum().clamp_min(1)
+    return (weights * acc).sum(), z * (weights**2 * variance).sum().sqrt(), acc, z * variance.sqrt()
 
 
 class LuckyBertModel(pl.LightningModule):
@@ -14,17 +38,75 @@ class LuckyBertModel(pl.LightningModule):
         bert: The pre-trained BERT model.
         classifier: Linear layer for binary classification.
         criterion: Loss function (CrossEntropy).
+
+    Memory-lean fine-tuning is controlled by `gradient_checkpointing` (recompute encoder activations in
+    the backward pass), `freeze_embeddings` and `freeze_layers` (number of lower encoder layers to freeze).
+
+    Validation batches with `subset_ids` (from LuckyDataModule) are scored per subset: `val/acc` is then
+    the stratified accuracy with its 95% interval half-width in `val/acc_ci`, next to the accuracy and
+    half-width of every subset.
+
+    A structurally pruned encoder is described by `num_heads` and `intermediate_sizes` (one entry per
+    encoder layer), so pruned checkpoints can be loaded with `load_from_checkpoint`.
+
+    With `lora_rank` > 0 the encoder is frozen and low-rank adapters are trained in its `lora_targets`
+    projections instead. Checkpoints then only hold the adapter and classifier weights, and the encoder
+    is restored from `model_name`. A `bert` passed in (e.g. one sharing weights with other adapters) is
+    used instead of loading `model_name`.
     """
 
-    def __init__(self, model_name: str = "bert-base-uncased", lr: float = 1e-5) -> None:
+    def __init__(
+        self,
+        model_name: str = "bert-base-uncased",
+        lr: float = 1e-5,
+        gradient_checkpointing: bool = False,
+        freeze_embeddings: bool = False,
+        freeze_layers: int = 0,
+        num_heads: Optional[list[int]] = None,
+        intermediate_sizes: Optional[list[int]] = None,
+        lora_rank: int = 0,
+        lora_alpha: float = 16.0,
+        lora_dropout: float = 0.1,
+        lora_targets: Optional[list[str]] = None,
+        bert: Optional[BertModel] = None,
+    ) -> None:
         super().__init__()
         # Save hyperparameters to self.hparams for reproducibility
 
-        self.save_hyperparameters()
-        self.bert = BertModel.from_pretrained(self.hparams["model_name"])
+        self.save_hyperparameters(ignore=["bert"])
+        self.bert = bert if bert is not None else BertModel.from_pretrained(self.hparams["model_name"])
         self.bert.train()
         self.classifier = nn.Linear(self.bert.config.hidden_size, 2)
         self.criterion = nn.CrossEntropyLoss()
+        # Correct and evaluated examples per validation subset, accumulated over a validation pass
+        self._val_counts: Optional[torch.Tensor] = None
+
+        # Recreate the shapes of a pruned encoder, the weights are restored from the checkpoint
+        if num_heads is not None or intermediate_sizes is not None:
+            layers = self.bert.encoder.layer
+            self.prune_encoder(
+                heads={
+                    i: list(range(n, layer.attention.self.num_attention_heads))
+                    for i, (layer, n) in enumerate(zip(layers, num_heads or []))
+                },
+                neurons={
+                    i: list(range(n, layer.intermediate.dense.out_features))
+                    for i, (layer, n) in enumerate(zip(layers, intermediate_sizes or []))
+                },
+            )
+
+        if gradient_checkpointing:
+            self.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        if freeze_embeddings:
+            self.bert.embeddings.requires_grad_(False)
+        for layer in self.bert.encoder.layer[:freeze_layers]:
+            layer.requires_grad_(False)
+
+        if lora_rank > 0:
+            self.bert.requires_grad_(False)
+            inject_lora(self.bert, lora_rank, alpha=lora_alpha, dropout=lora_dropout, targets=lora_targets)
+            # Adapter checkpoints do not contain the frozen encoder weights
+            self.strict_loading = False
 
     def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
         """Standard forward pass for inference."""
@@ -32,6 +114,55 @@ class LuckyBertModel(pl.LightningModule):
         # Use the pooled representation of [CLS] token
         return self.classifier(outputs.pooler_output)
 
+    def prune_encoder(self, heads: dict[int, list[int]], neurons: dict[int, list[int]]) -> None:
+        """
+        Physically remove attention heads and intermediate FFN neurons from the encoder.
+
+        Args:
+            heads: Encoder layer index mapped to the attention heads to remove.
+            neurons: Encoder layer index mapped to the intermediate FFN neurons to remove.
+        """
+        for layer_idx, layer_heads in heads.items():
+            attention = self.bert.encoder.layer[layer_idx].attention
+            head_size = attention.self.attention_head_size
+            removed = set(layer_heads)
+            if not removed:
+                continue
+            keep = torch.tensor(
+                [
+                    i
+                    for head in range(attention.self.num_attention_heads)
+                    if head not in removed
+                    for i in range(head * head_size, (head + 1) * head_size)
+                ]
+            )
+            attention.self.query = prune_linear_layer(attention.self.query, keep)
+            attention.self.key = prune_linear_layer(attention.self.key, keep)
+            attention.self.value = prune_linear_layer(attention.self.value, keep)
+            attention.output.dense = prune_linear_layer(attention.output.dense, keep, dim=1)
+            attention.self.num_attention_heads -= len(removed)
+            attention.self.all_head_size = attention.self.num_attention_heads * head_size
+
+        for layer_idx, layer_neurons in neurons.items():
+            layer = self.bert.encoder.layer[layer_idx]
+            removed = set(layer_neurons)
+            if not removed:
+                continue
+            keep = torch.tensor([i for i in range(layer.intermediate.dense.out_features) if i not in removed])
+            layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, keep)
+            layer.output.dense = prune_linear_layer(layer.output.dense, keep, dim=1)
+
+        # Record the pruned shapes so checkpoints can be reloaded
+        self.hparams["num_heads"] = [layer.attention.self.num_attention_heads for layer in self.bert.encoder.layer]
+        self.hparams["intermediate_sizes"] = [
+            layer.intermediate.dense.out_features for layer in self.bert.encoder.layer
+        ]
+
+    def on_save_checkpoint(self, checkpoint: dict[str, Any]) -> None:
+        """Keep only the adapter and classifier weights when training adapters."""
+        if self.hparams["lora_rank"] > 0:
+            checkpoint["state_dict"] = lora_state_dict(checkpoint["state_dict"])
+
     def training_step(self, batch: dict[str, torch.Tensor], batch_idx: int) -> torch.Tensor:
         """Individual training step."""
 
@@ -40,8 +171,18 @@ class LuckyBertModel(pl.LightningModule):
         logits = self(input_ids, attention_mask)
         loss = self.criterion(logits, labels)
 
+        # Report per-example losses to a datamodule that samples by difficulty
+        if "indices" in batch and self._trainer is not None:
+            datamodule = self.trainer.datamodule
+            if hasattr(datamodule, "record_losses"):
+                per_example = nn.functional.cross_entropy(logits.detach(), labels, reduction="none")
+                datamodule.record_losses(batch["indices"], per_example, logits.detach().argmax(dim=1) == labels)
+
         # Session 4: Log metrics for visualization (e.g. in wandb later)
-        self.log("train/loss", loss, on_step=True, on_epoch=True, prog_bar=True)
+        # Only the epoch mean is synced across ranks, once per epoch; the step loss is this rank's own, since
+        # syncing it would all-reduce on every step. The names are those on_step + on_epoch logged under.
+        self.log("train/loss_step", loss, on_step=True, on_epoch=False, prog_bar=True)
+        self.log("train/loss_epoch", loss, on_step=False, on_epoch=True, sync_dist=True)
         return loss
 
     def validation_step(self, batch: dict[str, torch.Tensor], batch_idx: int) -> torch.Tensor:
@@ -52,16 +193,55 @@ class LuckyBertModel(pl.LightningModule):
         loss = self.criterion(logits, labels)
 
         preds = torch.argmax(logits, dim=1)
-        acc = (preds == labels).float().mean()
+        correct = preds == labels
 
         # sync_dist=True for multi-GPU scaling
         self.log("val/loss", loss, on_epoch=True, prog_bar=True, sync_dist=True)
-        self.log("val/acc", acc, on_epoch=True, prog_bar=True, sync_dist=True)
+        if "subset_ids" in batch:
+            num_subsets = len(self.trainer.datamodule.val_subsets)
+            counts = torch.stack(
+                [
+                    torch.bincount(batch["subset_ids"][correct], minlength=num_subsets),
+                    torch.bincount(batch["subset_ids"], minlength=num_subsets),
+                ]
+            )
+            self._val_counts = counts if self._val_counts is None else self._val_counts + counts
+        else:
+            self.log("val/acc", correct.float().mean(), on_epoch=True, prog_bar=True, sync_dist=True)
         return loss
 
+    def on_validation_epoch_start(self) -> None:
+        self._val_counts = None
+
+    def on_validation_epoch_end(self) -> None:
+        """Log the stratified and per-subset accuracy of a pass over subset-labelled batches."""
+        datamodule = self.trainer.datamodule
+        if not hasattr(datamodule, "val_subsets"):
+            return
+        counts = self._val_counts
+        if counts is None:
+            # Every rank joins the reduce, also one that saw no validation batch, or the others hang in it
+            counts = torch.zeros(2, len(datamodule.val_subsets), dtype=torch.long, device=self.device)
+        # Counts are summed over data-parallel ranks, every rank then logs the same values
+        correct, count = self.trainer.strategy.reduce(counts, reduce_op="sum")
+        population = self.trainer.strategy.reduce(
+            torch.as_tensor(datamodule.val_population, device=self.device), reduce_op="sum"
+        )
+        if count.sum() == 0:
+            return
+        acc, ci, subset_acc, subset_ci = stratified_accuracy(correct, count, population)
+
+        self.log("val/acc", acc.float(), prog_bar=True)
+        self.log("val/acc_ci", ci.float())
+        self.log("val/full", float(datamodule.val_full))
+        for i, subset in enumerate(datamodule.val_subsets):
+            if count[i] > 0:
+                self.log(f"val/acc/{subset}", subset_acc[i].float())
+                self.log(f"val/acc_ci/{subset}", subset_ci[i].float())
+
     def configure_optimizers(self) -> Any:
-        """Setup the Adam optimizer."""
-        return torch.optim.Adam(self.parameters(), lr=self.hparams["lr"])
+        """Setup the Adam optimizer over the trainable (non-frozen) parameters."""
+        return torch.optim.Adam([p for p in self.parameters() if p.requires_grad], lr=self.hparams["lr"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import json
+import sys
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+from torch.profiler import ProfilerActivity, profile, record_function
+
+from lucky_ai.inference import LuckyPredictor
+
+STAGES = ("tokenize", "forward", "softmax")
+REPORT_FILES = ("trace.json", "summary.md", "python_stacks.folded")
+
+
+def predict_with_stages(predictor: LuckyPredictor, questions: list[str]) -> np.ndarray:
+    """LuckyPredictor.predict with its tokenize/forward/softmax stages marked for torch.profiler."""
+    with record_function("tokenize"):
+        input_ids, attention_mask = predictor.tokenize(questions)
+    with record_function("forward"):
+        logits = predictor.forward(input_ids, attention_mask)
+    with record_function("softmax"):
+        return predictor.softmax(logits.float()).numpy()
+
+
+class InferenceProfiler:
+    """
+    On-demand profiler for the next `requests` predictions or `seconds` seconds, whichever ends first.
+
+    The serving path only checks `active` and calls `predict` instead of the predictor while a session
+    runs. torch.profiler records the ops of the thread that starts it, so every profiled prediction runs
+    in its own profiler session inside its worker thread, one at a time. A sampler thread records Python
+    stacks of all threads meanwhile. When the session ends the per-request traces are merged into one
+    Chrome trace, and a summary of the top ops by self CPU time per stage is written next to it.
+    """
+
+    def __init__(self, directory: str, top_ops: int = 15, sample_interval: float = 0.005) -> None:
+        self.directory = Path(directory)
+        self.top_ops = top_ops
+        self.sample_interval = sample_interval
+
+        self.active = False
+        self.session: Optional[str] = None
+        self.remaining = 0
+        self.profiled = 0
+        self.last_session: Optional[str] = None
+
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop_sampling = threading.Event()
+        self._traces: list[Path] = []
+        self._op_times: dict[tuple[str, str], float] = defaultdict(float)
+        self._op_counts: Counter[tuple[str, str]] = Counter()
+        self._stage_times: dict[str, float] = defaultdict(float)
+        self._stacks: Counter[str] = Counter()
+
+    def start(self, requests: int, seconds: float) -> Path:
+        """Arm a profiling session and return the directory its report is written to."""
+        with self._lock:
+            if self.active:
+                raise RuntimeError(f"Profiling session {self.session} is already running.")
+            self.session = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            (self.directory / self.session).mkdir(parents=True, exist_ok=True)
+            self.remaining = requests
+            self.profiled = 0
+            self._traces = []
+            self._op_times.clear()
+            self._op_counts.clear()
+            self._stage_times.clear()
+            self._stacks.clear()
+
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler.start()
+            self._timer = threading.Timer(seconds, self.finish)
+            self._timer.daemon = True
+            self._timer.start()
+            self.active = True
+            return self.directory / self.session
+
+    def predict(self, predictor: LuckyPredictor, questions: list[str]) -> np.ndarray:
+        """Predict while recording a profile, or plainly if the session has ended meanwhile."""
+        with self._lock:
+            if not self.active:
+                return predictor.predict(questions)
+
+            with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+                probs = predict_with_stages(predictor, questions)
+
+            trace = self.directory / str(self.session) / f".request-{self.profiled:05d}.json"
+            prof.export_chrome_trace(str(trace))
+            self._traces.append(trace)
+            self._aggregate(prof.events())
+            self.profiled += 1
+            self.remaining -= 1
+            done = self.remaining <= 0
+
+        if done:
+            self.finish()
+        return probs
+
+    def _aggregate(self, events: Any) -> None:
+        """Add self CPU time per (stage, op) and total time per stage. Caller holds the lock."""
+        for event in events:
+            if event.name in STAGES:
+                self._stage_times[event.name] += event.cpu_time_total
+                continue
+            parent = event.cpu_parent
+            while parent is not None and parent.name not in STAGES:
+                parent = parent.cpu_parent
+            stage = parent.name if parent is not None else "other"
+            key = (stage, event.name)
+            self._op_times[key] += event.self_cpu_time_total
+            self._op_counts[key] += 1
+
+    def _sample_loop(self) -> None:
+        own = threading.get_ident()
+        while not self._stop_sampling.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def finish(self) -> None:
+        """End the running session, if any, and write its report."""
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            if self._timer is not None:
+                self._timer.cancel()
+            self._stop_sampling.set()
+            if self._sampler is not None and self._sampler is not threading.current_thread():
+                self._sampler.join()
+
+            output_dir = self.directory / str(self.session)
+            self._write_trace(output_dir / "trace.json")
+            (output_dir / "summary.md").write_text(self.summary())
+            with open(output_dir / "python_stacks.folded", "w") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.last_session = self.session
+
+    def _write_trace(self, path: Path) -> None:
+        """Merge the per-request Chrome traces into one, they share the same clock."""
+        merged: dict[str, Any] = {"traceEvents": []}
+        for trace in self._traces:
+            data = json.loads(trace.read_text())
+            events = data.pop("traceEvents", [])
+            merged = {**data, **merged}
+            merged["traceEvents"].extend(events)
+            trace.unlink()
+        path.write_text(json.dumps(merged))
+
+    def summary(self) -> str:
+        """Markdown report of time per stage and the top ops by self CPU time within each stage."""
+        lines = [f"## Inference profile {self.session}", "", f"Profiled requests: {self.profiled}", ""]
+        lines += ["| Stage | Total CPU (ms) | Per request (ms) |", "|-------|----------------|------------------|"]
+        for stage in STAGES:
+            total = self._stage_times.get(stage, 0.0) / 1000
+            lines.append(f"| {stage} | {total:.2f} | {total / max(self.profiled, 1):.3f} |")
+        lines.append("")
+
+        for stage in (*STAGES, "other"):
+            ops = sorted(((name, t) for (s, name), t in self._op_times.items() if s == stage), key=lambda op: -op[1])[
+                : self.top_ops
+            ]
+            if not ops:
+                continue
+            lines += [f"### Top ops in {stage} by self CPU time", ""]
+            lines += ["| Op | Calls | Self CPU (ms) |", "|----|-------|---------------|"]
+            for name, t in ops:
+                lines.append(f"| {name} | {self._op_counts[(stage, name)]} | {t / 1000:.3f} |")
+            lines.append("")
+        return "\n".join(lines)
+
+    def status(self) -> dict[str, Any]:
+        """Current session state for the admin endpoint."""
+        return {
+            "active": self.active,
+            "session": self.session,
+            "profiled": self.profiled,
+            "remaining": max(self.remaining, 0) if self.active else 0,
+            "last_session": self.last_session,
+        }
@@ -0,0 +1,196 @@
+import copy
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import typer
+
+# torch, Lightning and the model are imported by the functions that use them, so --help starts quickly
+if TYPE_CHECKING:
+    import torch
+    from torch.utils.data import DataLoader
+
+    from lucky_ai.model import LuckyBertModel
+
+prune_app = typer.Typer()
+
+
+def compute_importance(
+    model: "LuckyBertModel", loader: "DataLoader", max_batches: int = 50
+) -> tuple["torch.Tensor", "torch.Tensor"]:
+    """
+    Score attention heads and intermediate FFN neurons with a first-order Taylor estimate.
+
+    The importance of a unit is |sum(activation * d loss / d activation)| over the data, i.e. the estimated
+    change in loss when the unit is removed. Scores are L2-normalized per layer so they can be ranked
+    globally.
+
+    Returns:
+        Head scores of shape (layers, heads) and neuron scores of shape (layers, intermediate_size).
+    """
+    import torch
+
+    layers = model.bert.encoder.layer
+    head_size = layers[0].attention.self.attention_head_size
+    head_scores = torch.zeros(len(layers), layers[0].attention.self.num_attention_heads)
+    neuron_scores = torch.zeros(len(layers), layers[0].intermediate.dense.out_features)
+
+    activations: dict[tuple[str, int], torch.Tensor] = {}
+
+    def capture(key: tuple[str, int]):
+        def hook(module: torch.nn.Module, args: tuple[torch.Tensor, ...]) -> None:
+            args[0].retain_grad()
+            activations[key] = args[0]
+
+        return hook
+
+    # The inputs of the attention output projection are the concatenated head contexts, the inputs of the
+    # FFN output projection are the intermediate neuron activations
+    handles = []
+    for i, layer in enumerate(layers):
+        handles.append(layer.attention.output.dense.register_forward_pre_hook(capture(("head", i))))
+        handles.append(layer.output.dense.register_forward_pre_hook(capture(("neuron", i))))
+
+    model.eval()
+    try:
+        for batch_idx, batch in enumerate(loader):
+            if batch_idx >= max_batches:
+                break
+            model.zero_grad()
+            logits = model(batch["input_ids"], batch["attention_mask"])
+            model.criterion(logits, batch["labels"]).backward()
+
+            for i in range(len(layers)):
+                heads = activations[("head", i)]
+                contribution = (heads * heads.grad).sum(dim=(0, 1))
+                head_scores[i] += contribution.view(-1, head_size).sum(dim=1).abs().detach()
+
+                neurons = activations[("neuron", i)]
+                neuron_scores[i] += (neurons * neurons.grad).sum(dim=(0, 1)).abs().detach()
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad()
+
+    head_scores /= head_scores.norm(dim=1, keepdim=True).clamp_min(1e-12)
+    neuron_scores /= neuron_scores.norm(dim=1, keepdim=True).clamp_min(1e-12)
+    return head_scores, neuron_scores
+
+
+def select_lowest(scores: "torch.Tensor", sparsity: float) -> dict[int, list[int]]:
+    """Pick the globally lowest-scoring units to remove, keeping at least one unit per layer."""
+    import torch
+
+    num_layers, num_units = scores.shape
+    to_remove = int(sparsity * scores.numel())
+    remaining = [num_units] * num_layers
+    removed: dict[int, list[int]] = {layer: [] for layer in range(num_layers)}
+
+    for flat_idx in torch.argsort(scores.flatten()).tolist():
+        if to_remove == 0:
+            break
+        layer, unit = divmod(flat_idx, num_units)
+        if remaining[layer] > 1:
+            removed[layer].append(unit)
+            remaining[layer] -= 1
+            to_remove -= 1
+    return removed
+
+
+def save_checkpoint(model: "LuckyBertModel", path: Path) -> None:
+    """Save a checkpoint that LuckyBertModel.load_from_checkpoint (and so the API registry) can read."""
+    import pytorch_lightning as pl
+    import torch
+
+    from lucky_ai.model import LuckyBertModel
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(
+        {
+            "state_dict": model.state_dict(),
+            LuckyBertModel.CHECKPOINT_HYPER_PARAMS_KEY: dict(model.hparams),
+            "pytorch-lightning_version": pl.__version__,
+        },
+        path,
+    )
+
+
+@prune_app.command()
+def prune(
+    model_path: str,
+    output_dir: Path = Path("models/pruned"),
+    data_dir: str = "data/processed",
+    sparsity: list[float] = typer.Option([0.1, 0.3, 0.5]),
+    recovery_steps: int = 0,
+    importance_batches: int = 50,
+    latency_samples: int = 200,
+    batch_size: int = 16,
+) -> None:
+    """
+    Prune attention heads and FFN neurons of a trained model at one or more sparsity levels.
+
+    Units are scored on the processed test data, the lowest-scoring ones are physically removed and the
+    pruned model is optionally fine-tuned for --recovery-steps steps. Each level is saved as
+    <output_dir>/sparsity-<pct>/model.ckpt, which the API registry can load as a model version, and
+    parameter count, latency and per-subset accuracy are reported for every level.
+    """
+    import pytorch_lightning as pl
+    from torch.utils.data import DataLoader
+
+    from lucky_ai.dataset import LuckyDataModule
+    from lucky_ai.evaluate import count_parameters, evaluate_subsets, measure_latency
+    from lucky_ai.inference import LuckyPredictor
+    from lucky_ai.model import LuckyBertModel
+
+    base = LuckyBertModel.load_from_checkpoint(model_path, map_location="cpu")
+    dm = LuckyDataModule(model_name=base.hparams["model_name"], batch_size=batch_size, data_dir=data_dir)
+    dm.setup()
+
+    print("Scoring attention heads and FFN neurons...")
+    # In dataset order, the validation dataloader sorts batches by length
+    loader = DataLoader(dm.test_set, batch_size=batch_size, collate_fn=dm.collate_fn)
+    head_scores, neuron_scores = compute_importance(base, loader, max_batches=importance_batches)
+
+    questions = [dm.test_set[i][0] for i in range(min(latency_samples, len(dm.test_set)))]
+    report = []
+    for level in [0.0, *sparsity]:
+        model = copy.deepcopy(base)
+        if level > 0:
+            model.prune_encoder(heads=select_lowest(head_scores, level), neurons=select_lowest(neuron_scores, level))
+            if recovery_steps > 0:
+                trainer = pl.Trainer(
+                    max_steps=recovery_steps,
+                    logger=False,
+                    enable_checkpointing=False,
+                    enable_model_summary=False,
+                )
+                trainer.fit(model, train_dataloaders=dm.train_dataloader())
+            save_checkpoint(model, output_dir / f"sparsity-{round(level * 100)}" / "model.ckpt")
+
+        predictor = LuckyPredictor(model, dm.tokenizer)
+        predictor.warmup(passes=1)
+        report.append(
+            {
+                "sparsity": level,
+                "parameters": count_parameters(model),
+                **measure_latency(predictor, questions),
+                "accuracy": evaluate_subsets(model, dm.test_set, dm.collate_fn, batch_size=64),
+            }
+        )
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "report.json").write_text(json.dumps(report, indent=2))
+
+    subsets = sorted(report[0]["accuracy"])
+    print("| Sparsity | Parameters | p50 (ms) | p99 (ms) | " + " | ".join(subsets) + " |")
+    print("|----------|------------|----------|----------|" + "|".join("---" for _ in subsets) + "|")
+    for row in report:
+        accuracies = " | ".join(f"{row['accuracy'][s]:.3f}" for s in subsets)
+        print(
+            f"| {row['sparsity']:.0%} | {row['parameters']:,} | {row['p50_ms']:.1f} | {row['p99_ms']:.1f} | "
+            f"{accuracies} |"
+        )
+
+
+if __name__ == "__main__":
+    prune_app()
@@ -0,0 +1,198 @@
+import gc
+import random
+import threading
+import traceback
+from pathlib import Path
+from typing import Optional
+
+import torch
+from transformers import BertModel, BertTokenizerFast
+
+from lucky_ai.inference import LuckyPredictor
+from lucky_ai.lora import merge_lora, share_weights
+from lucky_ai.model import LuckyBertModel
+
+CHECKPOINT_NAME = "model.ckpt"
+# Written instead of model.ckpt by LoRA fine-tunes: only the adapter and classifier weights
+ADAPTER_NAME = "adapter.ckpt"
+
+
+class ModelRegistry:
+    """
+    Registry of loaded model versions read from a local artifact directory.
+
+    Every subdirectory of `artifact_dir` containing a `model.ckpt` or an `adapter.ckpt` is a version.
+    Versions are loaded and warmed up in the background, and the default version is swapped atomically:
+    requests that already selected a predictor keep their reference until they finish.
+
+    Adapter versions are applied to one frozen base encoder per base model name, shared in memory by all
+    of them. With `merge_adapters` the adapters are folded into copies of the projection weights instead,
+    which costs the memory of those projections per version but runs as fast as a full checkpoint.
+    """
+
+    def __init__(
+        self,
+        artifact_dir: str,
+        tokenizer: BertTokenizerFast,
+        compile_mode: str = "trace",
+        precision: str = "fp32",
+        merge_adapters: bool = False,
+    ) -> None:
+        self.artifact_dir = Path(artifact_dir)
+        self.tokenizer = tokenizer
+        self.compile_mode = compile_mode
+        self.precision = precision
+        self.merge_adapters = merge_adapters
+        self.default: Optional[str] = None
+        self.weights: dict[str, float] = {}
+        # Last load failure of each version, cleared when the version is loaded again
+        self.errors: dict[str, str] = {}
+        self._predictors: dict[str, LuckyPredictor] = {}
+        self._bases: dict[str, BertModel] = {}
+        self._lock = threading.Lock()
+
+    def _checkpoints(self) -> list[Path]:
+        if not self.artifact_dir.exists():
+            return []
+        return [p for name in (CHECKPOINT_NAME, ADAPTER_NAME) for p in self.artifact_dir.glob(f"*/{name}")]
+
+    def _checkpoint(self, version: str) -> Path:
+        """The full or adapter checkpoint of a version."""
+        for name in (CHECKPOINT_NAME, ADAPTER_NAME):
+            if (self.artifact_dir / version / name).exists():
+                return self.artifact_dir / version / name
+        raise FileNotFoundError(f"Model version not found: {(self.artifact_dir / version).absolute()}")
+
+    def available(self) -> list[str]:
+        """Versions present in the artifact directory, loaded or not."""
+        return sorted({p.parent.name for p in self._checkpoints()})
+
+    def latest(self) -> str:
+        """The most recently written version in the artifact directory."""
+        checkpoints = self._checkpoints()
+        if not checkpoints:
+            raise FileNotFoundError(f"No model versions found in {self.artifact_dir.absolute()}")
+        return max(checkpoints, key=lambda p: p.stat().st_mtime).parent.name
+
+    def loaded(self) -> dict[str, bool]:
+        """Loaded versions mapped to whether they finished warming up."""
+        with self._lock:
+            return {version: predictor.ready.is_set() for version, predictor in self._predictors.items()}
+
+    def load(self, version: str, make_default: bool = False) -> LuckyPredictor:
+        """Load and warm up a version, blocking until it is ready. Failures are also recorded in `errors`."""
+        ckpt_path = self._checkpoint(version)
+        with self._lock:
+            self.errors.pop(version, None)
+            predictor = self._predictors.get(version)
+
+        try:
+            if predictor is None:
+                if ckpt_path.name == ADAPTER_NAME:
+                    model = self._load_adapter(ckpt_path)
+                else:
+                    model = LuckyBertModel.load_from_checkpoint(ckpt_path, map_location="cpu")
+                predictor = LuckyPredictor(
+                    model, self.tokenizer, compile_mode=self.compile_mode, precision=self.precision
+                )
+                with self._lock:
+                    predictor = self._predictors.setdefault(version, predictor)
+
+            if not predictor.ready.is_set():
+                predictor.warmup()
+        except Exception as e:
+            with self._lock:
+                self.errors[version] = f"{type(e).__name__}: {e}"
+                # A predictor that failed to warm up would otherwise be reported as loading forever
+                if predictor is not None and not predictor.ready.is_set():
+                    self._predictors.pop(version, None)
+            raise
+
+        if make_default:
+            self.set_default(version)
+        return predictor
+
+    def _load_logged(self, version: str, make_default: bool) -> None:
+        try:
+            self.load(version, make_default)
+        except Exception:
+            # Recorded in `errors` by load(), the traceback only goes to the logs
+            traceback.print_exc()
+
+    def load_async(self, version: str, make_default: bool = False) -> threading.Thread:
+        """Load a version in a background thread. A failure is recorded in `errors` instead of raised."""
+        self._checkpoint(version)
+        thread = threading.Thread(target=self._load_logged, args=(version, make_default), daemon=True)
+        thread.start()
+        return thread
+
+    def _load_adapter(self, ckpt_path: Path) -> LuckyBertModel:
+        """Apply an adapter checkpoint to the shared base encoder of its base model."""
+        checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+        hparams = checkpoint[LuckyBertModel.CHECKPOINT_HYPER_PARAMS_KEY]
+        # Loading full weights would overwrite the shared base in place
+        if hparams.get("lora_rank", 0) <= 0:
+            raise ValueError(f"{ckpt_path} is not an adapter checkpoint, save full checkpoints as {CHECKPOINT_NAME}.")
+
+        with self._lock:
+            base = self._bases.get(hparams["model_name"])
+        if base is None:
+            base = BertModel.from_pretrained(hparams["model_name"]).eval().requires_grad_(False)
+            with self._lock:
+                base = self._bases.setdefault(hparams["model_name"], base)
+
+        model = LuckyBertModel(**hparams, bert=share_weights(base))
+        unexpected = model.load_state_dict(checkpoint["state_dict"], strict=False).unexpected_keys
+        if unexpected:
+            raise ValueError(f"Adapter checkpoint {ckpt_path} does not match its base model: {unexpected[:5]}")
+        if self.merge_adapters:
+            merge_lora(model)
+        return model
+
+    def _require_ready(self, version: str) -> None:
+        predictor = self._predictors.get(version)
+        if predictor is None or not predictor.ready.is_set():
+            raise KeyError(f"Model version '{version}' is not loaded.")
+
+    def set_default(self, version: str) -> None:
+        """Atomically make a loaded version the default."""
+        with self._lock:
+            self._require_ready(version)
+            self.default = version
+
+    def set_weights(self, weights: dict[str, float]) -> None:
+        """Split unpinned traffic between loaded versions. An empty mapping sends everything to the default."""
+        if any(w < 0 for w in weights.values()) or (weights and sum(weights.values()) <= 0):
+            raise ValueError("Traffic weights must be non-negative and sum to a positive value.")
+        with self._lock:
+            for version in weights:
+                self._require_ready(version)
+            self.weights = dict(weights)
+
+    def unload(self, version: str) -> None:
+        """Drop a version so its memory is released once in-flight requests finish."""
+        with self._lock:
+            if version == self.default or version in self.weights:
+                raise ValueError(f"Model version '{version}' is in use and cannot be unloaded.")
+            if self._predictors.pop(version, None) is None:
+                raise KeyError(f"Model version '{version}' is not loaded.")
+        gc.collect()
+
+    def select(self, version: Optional[str] = None) -> tuple[str, LuckyPredictor]:
+        """Pick the predictor for a request: the pinned version, a weighted split, or the default."""
+        with self._lock:
+            if version is None:
+                if self.weights:
+                    versions = list(self.weights)
+                    version = random.choices(versions, weights=[self.weights[v] for v in versions])[0]
+                else:
+                    version = self.default
+            if version is None:
+                raise KeyError("No default model version is loaded.")
+            self._require_ready(version)
+            return version, self._predictors[version]
+
+    def is_ready(self) -> bool:
+        """Whether a warmed-up default version is available."""
+        with self._lock:
+            return self.default is not None
@@ -0,0 +1,156 @@
+import json
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+import typer
+
+# pyarrow, torch and the model are imported by the command and the workers, so --help starts quickly
+if TYPE_CHECKING:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from lucky_ai.inference import LuckyPredictor
+
+CHECKPOINT_FILE = "_checkpoint.json"
+
+score_app = typer.Typer()
+
+# Per-process predictor, loaded once by _init_worker
+_predictor: Optional["LuckyPredictor"] = None
+
+
+def _init_worker(model_path: str, tokenizer_name: str, compile_mode: str, num_threads: int) -> None:
+    """Load the model once per worker process."""
+    import torch
+    from transformers import BertTokenizerFast
+
+    from lucky_ai.inference import LuckyPredictor
+    from lucky_ai.model import LuckyBertModel
+
+    global _predictor
+    torch.set_num_threads(num_threads)
+    model = LuckyBertModel.load_from_checkpoint(model_path, map_location="cpu")
+    tokenizer = BertTokenizerFast.from_pretrained(tokenizer_name)
+    _predictor = LuckyPredictor(model, tokenizer, compile_mode=compile_mode)
+    _predictor.warmup(passes=1)
+
+
+def _score_texts(texts: list[Optional[str]], batch_size: int) -> np.ndarray:
+    """Score texts in length-sorted batches so each batch pads to a tight bucket. Null texts score NaN."""
+    assert _predictor is not None, "Worker not initialized"
+    valid = np.flatnonzero([t is not None for t in texts])
+    order = valid[np.argsort([len(texts[i]) for i in valid], kind="stable")]
+    probs = np.full((len(texts), 2), np.nan, dtype=np.float32)
+    for start in range(0, len(order), batch_size):
+        idx = order[start : start + batch_size]
+        probs[idx] = _predictor.predict([texts[i] for i in idx])
+    return probs
+
+
+def _fingerprint(path: Path, parquet_file: "pq.ParquetFile") -> dict:
+    stat = path.stat()
+    return {
+        "input": str(path.absolute()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "num_row_groups": parquet_file.num_row_groups,
+    }
+
+
+def _write_atomic(path: Path, write: Callable[[Path], None]) -> None:
+    # Dataset readers skip dot-files, so a part file left half-written by a killed job is never read
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+@score_app.command()
+def score(
+    input_path: Path,
+    output_dir: Path,
+    model_path: str = "models/model.ckpt",
+    tokenizer_name: str = "bert-base-uncased",
+    column: str = "input",
+    batch_size: int = 256,
+    num_workers: int = max(1, (os.cpu_count() or 1) // 2),
+    compile_mode: str = "trace",
+) -> None:
+    """
+    Score every row of a parquet file with LuckyBertModel and write p_yes/p_no to a parquet dataset.
+
+    The input is streamed one row group at a time and each row group is written to its own part file in
+    output_dir. Finished row groups are recorded in output_dir/_checkpoint.json, so rerunning the same
+    command after the job was killed only scores the remaining row groups. Rows with a null input get null
+    scores. Use --num-workers 0 to score in the current process.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import torch
+
+    parquet_file = pq.ParquetFile(input_path)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = output_dir / CHECKPOINT_FILE
+    # Temp files of a killed run, their row groups are not in the checkpoint and are scored again
+    for stale in output_dir.glob(".*.tmp"):
+        stale.unlink()
+
+    fingerprint = _fingerprint(input_path, parquet_file)
+    done: set[int] = set()
+    if checkpoint_path.exists():
+        checkpoint = json.loads(checkpoint_path.read_text())
+        if checkpoint["fingerprint"] != fingerprint:
+            raise ValueError(f"{checkpoint_path} belongs to a different input. Use a fresh output directory.")
+        done = set(checkpoint["done"])
+
+    todo = [rg for rg in range(parquet_file.num_row_groups) if rg not in done]
+    print(f"Scoring {len(todo)} of {parquet_file.num_row_groups} row groups ({len(done)} already done)...")
+
+    def finish(rg: int, table: "pa.Table", probs: np.ndarray) -> None:
+        # Rows without an input get null scores
+        null = np.isnan(probs[:, 0])
+        table = table.append_column("p_yes", pa.array(probs[:, 0], mask=null)).append_column(
+            "p_no", pa.array(probs[:, 1], mask=null)
+        )
+        _write_atomic(output_dir / f"part-{rg:05d}.parquet", lambda p: pq.write_table(table, p))
+        done.add(rg)
+        _write_atomic(
+            checkpoint_path,
+            lambda p: p.write_text(json.dumps({"fingerprint": fingerprint, "done": sorted(done)})),
+        )
+        print(f"Scored row group {rg} ({table.num_rows:,} rows)")
+
+    if num_workers == 0:
+        _init_worker(model_path, tokenizer_name, compile_mode, torch.get_num_threads())
+        for rg in todo:
+            table = parquet_file.read_row_group(rg)
+            finish(rg, table, _score_texts(table.column(column).to_pylist(), batch_size))
+    else:
+        threads = max(1, (os.cpu_count() or 1) // num_workers)
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_path, tokenizer_name, compile_mode, threads),
+        ) as pool:
+            # Keep at most two row groups per worker in flight to bound memory
+            pending: dict[int, tuple["pa.Table", Future]] = {}
+            for rg in todo:
+                table = parquet_file.read_row_group(rg)
+                pending[rg] = (table, pool.submit(_score_texts, table.column(column).to_pylist(), batch_size))
+                if len(pending) >= 2 * num_workers:
+                    oldest = min(pending)
+                    table, future = pending.pop(oldest)
+                    finish(oldest, table, future.result())
+            for rg in sorted(pending):
+                table, future = pending[rg]
+                finish(rg, table, future.result())
+
+    print(f"Scoring complete. Results in {output_dir}")
+
+
+if __name__ == "__main__":
+    score_app()
@@ -0,0 +1,295 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+SEGMENT_GLOB = "segment-*.log"
+# Segments holding a record the sink keeps rejecting are moved here, out of the way of the others
+QUARANTINE_DIR = "quarantine"
+
+
+class SpoolUnavailable(Exception):
+    """Raised when the spool cannot take a record right now."""
+
+
+class SpoolFull(SpoolUnavailable):
+    """Raised when the spool has reached its disk budget."""
+
+
+def check_storable(text: str) -> None:
+    """Reject text the database cannot store: NUL characters and unpaired surrogates."""
+    if "\x00" in text:
+        raise ValueError("Text must not contain NUL characters.")
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        raise ValueError("Text must be valid Unicode.")
+
+
+class FeedbackSpool:
+    """
+    Durable local append-only log for feedback, drained into the database in the background.
+
+    Records are appended as JSON lines to the active segment file and fsynced in batches every
+    `fsync_interval` seconds, so appending never waits on the disk or the database. A drainer thread
+    rolls the active segment, replays closed segments through `drain` in bulk and deletes a segment
+    only after `drain` succeeded. Every record carries an idempotency key, so a segment replayed after a
+    crash does not create duplicates as long as `drain` ignores keys it has already stored.
+
+    A segment that fails in a pass where other segments drained holds a record the sink rejects rather
+    than hitting an outage. After `max_drain_attempts` such passes it is moved to quarantine/ so the
+    segments behind it keep draining.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        drain: Callable[[list[dict[str, Any]]], None],
+        segment_bytes: int = 1 << 20,
+        max_bytes: int = 256 << 20,
+        fsync_interval: float = 0.05,
+        drain_interval: float = 1.0,
+        drain_batch: int = 500,
+        max_drain_attempts: int = 5,
+    ) -> None:
+        self.directory = Path(directory)
+        self.drain = drain
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.drain_interval = drain_interval
+        self.drain_batch = drain_batch
+        self.max_drain_attempts = max_drain_attempts
+
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._file: Optional[Any] = None
+        # Full segments rolled by append, synced and closed by the fsync thread
+        self._retired: list[Any] = []
+        self._active: Optional[Path] = None
+        self._seq = 0
+        self._active_bytes = 0
+        self._dirty = False
+        # Segment name -> passes in which it failed while other segments drained
+        self._attempts: dict[str, int] = {}
+
+        self.bytes = 0
+        self.pending = 0
+        self.drained = 0
+        self.rejected = 0
+        self.drain_failures = 0
+        self.quarantined = 0
+        self.drain_rate = 0.0
+
+    def _segments(self) -> list[Path]:
+        return sorted(self.directory.glob(SEGMENT_GLOB))
+
+    def _open_segment(self) -> None:
+        self._seq += 1
+        self._active = self.directory / f"segment-{self._seq:010d}.log"
+        self._file = open(self._active, "ab")
+        self._active_bytes = 0
+        self._dirty = False
+
+    def _roll_segment(self) -> Optional[Any]:
+        """
+        Swap in a new active segment and return the old file. Caller holds the lock.
+
+        The old file is flushed to the OS, so readers see all of it, but not synced: the caller syncs it
+        with _sync_close after releasing the lock.
+        """
+        old = self._file
+        if old is not None:
+            old.flush()
+        self._open_segment()
+        return old
+
+    @staticmethod
+    def _sync_close(file: Any) -> None:
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+
+    def start(self) -> None:
+        """Recover segments left by a previous process and start the fsync and drain threads."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for segment in self._segments():
+            self._seq = max(self._seq, int(segment.stem.split("-")[1]))
+            self.bytes += segment.stat().st_size
+            with open(segment, "rb") as f:
+                self.pending += sum(1 for _ in f)
+        with self._lock:
+            self._open_segment()
+
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._fsync_loop, daemon=True),
+            threading.Thread(target=self._drain_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """Stop the background threads, sync the active segment and make a last drain attempt."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self.drain_once()
+        with self._lock:
+            files = [*self._retired, self._file]
+            self._retired, self._file = [], None
+        for file in files:
+            if file is not None:
+                self._sync_close(file)
+
+    def append(self, prompt: str, label: str, model_version: Optional[str] = None) -> str:
+        """
+        Append a feedback record and return its idempotency key.
+
+        `model_version` is the version that answered the prompt, if the client reported it. Raises
+        ValueError for text the database cannot store, which would otherwise block draining.
+        """
+        for text in (prompt, label, model_version or ""):
+            check_storable(text)
+        key = uuid.uuid4().hex
+        record = {
+            "idempotency_key": key,
+            "prompt": prompt,
+            "label": label,
+            "model_version": model_version,
+            "time": datetime.now(timezone.utc).isoformat(),
+        }
+        data = (json.dumps(record) + "\n").encode()
+
+        with self._lock:
+            if self.bytes + len(data) > self.max_bytes:
+                self.rejected += 1
+                raise SpoolFull(f"Feedback spool is full ({self.bytes:,} bytes).")
+            if self._file is None:
+                raise SpoolUnavailable("Feedback spool is not running.")
+            self._file.write(data)
+            self._active_bytes += len(data)
+            self.bytes += len(data)
+            self.pending += 1
+            self._dirty = True
+            if self._active_bytes >= self.segment_bytes:
+                # Synced by the fsync thread: append runs on the event loop and must not wait on the disk
+                self._retired.append(self._roll_segment())
+        return key
+
+    def _fsync_loop(self) -> None:
+        while not self._stop.wait(self.fsync_interval):
+            fd = None
+            with self._lock:
+                retired, self._retired = self._retired, []
+                if self._dirty and self._file is not None:
+                    self._file.flush()
+                    # Sync a duplicate descriptor outside the lock so appends are not blocked by the disk
+                    fd = os.dup(self._file.fileno())
+                    self._dirty = False
+            for file in retired:
+                self._sync_close(file)
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def _drain_loop(self) -> None:
+        while not self._stop.wait(self.drain_interval):
+            self.drain_once()
+
+    def drain_once(self) -> int:
+        """Replay all closed segments into the sink. Returns the number of records drained."""
+        with self._drain_lock:
+            rolled = None
+            with self._lock:
+                if self._file is not None and self._active_bytes > 0:
+                    rolled = self._roll_segment()
+                closed = [s for s in self._segments() if s != self._active]
+            if rolled is not None:
+                self._sync_close(rolled)
+
+            drained = 0
+            failed: list[Path] = []
+            sink_up = False
+            for segment in closed:
+                records = []
+                num_lines = 0
+                with open(segment, "rb") as f:
+                    for line in f:
+                        num_lines += 1
+                        try:
+                            records.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            # Torn write from a crash mid-append
+                            continue
+
+                start = time.perf_counter()
+                try:
+                    for i in range(0, len(records), self.drain_batch):
+                        self.drain(records[i : i + self.drain_batch])
+                except Exception as e:
+                    # Keep the segment and retry on the next pass
+                    self.drain_failures += 1
+                    print(f"Failed to drain {segment.name}: {e}")
+                    failed.append(segment)
+                    if len(failed) > 1 and not sink_up:
+                        # Nothing went through yet: most likely the database is down, retry on the next pass
+                        break
+                    continue
+                elapsed = time.perf_counter() - start
+
+                size = segment.stat().st_size
+                segment.unlink()
+                with self._lock:
+                    self.bytes -= size
+                    self.pending -= num_lines
+                    self.drained += len(records)
+                    if records:
+                        self.drain_rate = len(records) / max(elapsed, 1e-9)
+                drained += len(records)
+                sink_up = sink_up or bool(records)
+
+            if sink_up:
+                # Other segments went through, so these hold a record the sink rejects
+                for segment in failed:
+                    self._attempts[segment.name] = self._attempts.get(segment.name, 0) + 1
+                    if self._attempts[segment.name] >= self.max_drain_attempts:
+                        self._quarantine(segment)
+            return drained
+
+    def _quarantine(self, segment: Path) -> None:
+        """Move a segment out of the drain queue, keeping it on disk for inspection and replay."""
+        quarantine_dir = self.directory / QUARANTINE_DIR
+        quarantine_dir.mkdir(exist_ok=True)
+        size = segment.stat().st_size
+        with open(segment, "rb") as f:
+            num_lines = sum(1 for _ in f)
+        os.replace(segment, quarantine_dir / segment.name)
+        self._attempts.pop(segment.name, None)
+        with self._lock:
+            self.bytes -= size
+            self.pending -= num_lines
+            self.quarantined += 1
+        print(f"Quarantined {segment.name} after {self.max_drain_attempts} failed drains")
+
+    def stats(self) -> dict[str, float]:
+        """Spool depth and drain counters for the metrics endpoint."""
+        with self._lock:
+            return {
+                "segments": len(self._segments()),
+                "bytes": self.bytes,
+                "pending": self.pending,
+                "drained": self.drained,
+                "drain_rate_per_s": self.drain_rate,
+                "rejected": self.rejected,
+                "drain_failures": self.drain_failures,
+                "quarantined": self.quarantined,
+            }
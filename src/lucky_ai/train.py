@@ -4,9 +4,12 @@ from dotenv import load_dotenv
 import pytorch_lightning as pl
 from omegaconf import DictConfig, OmegaConf
 from pytorch_lightning.loggers import WandbLogger
+from pytorch_lightning.strategies import DDPStrategy
 from lucky_ai.model import LuckyBertModel
 from lucky_ai.dataset import LuckyDataModule
+from lucky_ai.callbacks import ResourceMonitor, TimeToTarget
 from pathlib import Path
+import math
 import tempfile
 import wandb
 import os
@@ -34,12 +37,48 @@ def train(cfg: DictConfig) -> None:
         batch_size=data_cfg["batch_size"],
         num_workers=data_cfg["num_workers"],
         data_dir=data_cfg["path"],
+        subsets=data_cfg["subsets"],
+        sampling=data_cfg["sampling"],
+        hard_floor=data_cfg["hard_floor"],
+        subset_quotas=data_cfg["subset_quotas"],
+        selection=data_cfg["selection"],
+        val_samples_per_subset=data_cfg["val_samples_per_subset"],
+        full_val_every=data_cfg["full_val_every"],
     )
 
+    train_cfg: Any = cfg["training"]
+
     # Initialize the Model
-    model = LuckyBertModel(model_name=model_cfg["model_name"], lr=model_cfg["lr"])
+    model = LuckyBertModel(
+        model_name=model_cfg["model_name"],
+        lr=model_cfg["lr"],
+        gradient_checkpointing=train_cfg["gradient_checkpointing"],
+        freeze_embeddings=train_cfg["freeze_embeddings"],
+        freeze_layers=train_cfg["freeze_layers"],
+        lora_rank=model_cfg["lora_rank"],
+        lora_alpha=model_cfg["lora_alpha"],
+        lora_dropout=model_cfg["lora_dropout"],
+        lora_targets=model_cfg["lora_targets"],
+    )
 
-    train_cfg: Any = cfg["training"]
+    # Accumulate gradients up to the effective batch size
+    num_processes = train_cfg["devices"] * train_cfg["num_nodes"]
+    accumulate_grad_batches = 1
+    if train_cfg["effective_batch_size"] > 0:
+        accumulate_grad_batches = max(
+            1, math.ceil(train_cfg["effective_batch_size"] / (data_cfg["batch_size"] * num_processes))
+        )
+
+    strategy: Any = train_cfg["strategy"]
+    if strategy == "ddp":
+        # gloo is the collective backend that works without GPUs
+        strategy = DDPStrategy(process_group_backend="gloo" if train_cfg["accelerator"] == "cpu" else None)
+
+    callbacks: list[pl.Callback] = []
+    if train_cfg["monitor_resources"]:
+        callbacks.append(ResourceMonitor())
+    if train_cfg["target_val_acc"] > 0:
+        callbacks.append(TimeToTarget(train_cfg["target_val_acc"]))
     logger: Optional[WandbLogger] = None
 
     if train_cfg["logger"]["enabled"]:
@@ -54,8 +93,18 @@ def train(cfg: DictConfig) -> None:
         max_epochs=train_cfg["max_epochs"],
         accelerator=train_cfg["accelerator"],
         devices=train_cfg["devices"],
+        num_nodes=train_cfg["num_nodes"],
+        strategy=strategy,
+        # The DataModule reads one shard per rank, so batches must not be split again
+        use_distributed_sampler=False,
         precision=train_cfg["precision"],
+        limit_train_batches=train_cfg["limit_train_batches"],
+        limit_val_batches=train_cfg["limit_val_batches"],
         log_every_n_steps=train_cfg["log_every_n_steps"],
+        accumulate_grad_batches=accumulate_grad_batches,
+        # Lets the DataModule switch between the validation sample and the full test set
+        reload_dataloaders_every_n_epochs=1 if data_cfg["val_samples_per_subset"] > 0 else 0,
+        callbacks=callbacks,
         logger=logger,
         default_root_dir="models/",
     )
@@ -66,9 +115,13 @@ def train(cfg: DictConfig) -> None:
     # Save + log final model
     if logger is not None:
         with tempfile.TemporaryDirectory() as tmpdir:
-            ckpt_path = Path(tmpdir) / "model.ckpt"
+            # The registry tells adapter checkpoints apart from full ones by their name
+            ckpt_path = Path(tmpdir) / ("adapter.ckpt" if model_cfg["lora_rank"] > 0 else "model.ckpt")
 
+            # Every rank has to call this, only rank 0 writes the file
             trainer.save_checkpoint(ckpt_path)
+            if not trainer.is_global_zero:
+                return
 
             artifact = wandb.Artifact(
                 name="lucky_bert",
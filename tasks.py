@@ -20,6 +20,28 @@ def train(ctx: Context) -> None:
     ctx.run(f"uv run src/{PROJECT_NAME}/train.py", echo=True, pty=not WINDOWS)
 
 
+@task
+def benchmark_ddp(ctx: Context, processes: str = "1,2,4", batches: int = 50) -> None:
+    """Measure CPU data-parallel training throughput against the number of processes."""
+    results = {}
+    for n in [int(p) for p in processes.split(",")]:
+        result = ctx.run(
+            f"uv run src/{PROJECT_NAME}/train.py training=ddp_cpu training.devices={n} training.max_epochs=1 "
+            f"training.limit_train_batches={batches} training.limit_val_batches=0 training.logger.enabled=False",
+            echo=True,
+            hide="out",
+        )
+        for line in result.stdout.splitlines():
+            if line.startswith("Throughput:"):
+                results[n] = float(line.split()[1])
+
+    print("| Processes | Samples/sec | Speedup | Efficiency |")
+    print("|-----------|-------------|---------|------------|")
+    base = results[min(results)] / min(results)
+    for n, throughput in results.items():
+        print(f"| {n} | {throughput:.1f} | {throughput / base:.2f}x | {throughput / base / n:.0%} |")
+
+
 @task
 def test(ctx: Context) -> None:
     """Run tests."""
@@ -0,0 +1,79 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Iterator
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+from lucky_ai.model import LuckyBertModel
+
+TINY_VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "is", "the", "sky", "blue", "grass", "purple", "?"]
+
+
+@pytest.fixture
+def tiny_tokenizer(tmp_path) -> BertTokenizerFast:
+    """A BERT tokenizer over a handful of words, so tests do not need the Hugging Face hub."""
+    tokenizer_dir = tmp_path / "tokenizer"
+    tokenizer_dir.mkdir()
+    (tokenizer_dir / "vocab.txt").write_text("\n".join(TINY_VOCAB))
+    return BertTokenizerFast.from_pretrained(tokenizer_dir)
+
+
+@pytest.fixture
+def tiny_bert_config() -> BertConfig:
+    """Config for a two-layer BERT encoder, small enough to build in tests."""
+    return BertConfig(
+        vocab_size=len(TINY_VOCAB),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=128,
+    )
+
+
+@pytest.fixture
+def tiny_model(tiny_bert_config) -> LuckyBertModel:
+    """A LuckyBertModel with a two-layer BERT encoder instead of bert-base-uncased."""
+    with patch("lucky_ai.model.BertModel.from_pretrained", return_value=BertModel(tiny_bert_config)):
+        return LuckyBertModel()
+
+
+@pytest.fixture
+def api_client(tiny_model, tiny_tokenizer, tmp_path) -> Iterator[Callable[..., ContextManager[TestClient]]]:
+    """
+    Start the API against tmp_path, serving tiny_model as version v1 with "secret" as admin token.
+
+    Returns a context manager that runs the app and yields its TestClient once /ready is OK, or right
+    after startup with `wait_ready=False`. Patches a test needs at startup go around that call.
+    """
+    (tmp_path / "models" / "v1").mkdir(parents=True)
+    (tmp_path / "models" / "v1" / "model.ckpt").touch()
+
+    with (
+        patch("lucky_ai.api.MODEL_DIR", str(tmp_path / "models")),
+        patch("lucky_ai.api.COMPILE_MODE", "none"),
+        patch("lucky_ai.api.FEEDBACK_SPOOL_DIR", str(tmp_path / "spool")),
+        patch("lucky_ai.api.PROFILE_DIR", str(tmp_path / "profiles")),
+        patch("lucky_ai.api.ADMIN_TOKEN", "secret"),
+        patch("lucky_ai.api.upsert_feedback_bulk"),
+        patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer),
+        patch("lucky_ai.registry.LuckyBertModel.load_from_checkpoint", return_value=tiny_model),
+    ):
+
+        @contextmanager
+        def start(wait_ready: bool = True) -> Iterator[TestClient]:
+            from lucky_ai import api
+
+            with TestClient(api.app) as client:
+                if wait_ready:
+                    for _ in range(100):
+                        if client.get("/ready").status_code == 200:
+                            break
+                        time.sleep(0.05)
+                    assert client.get("/ready").status_code == 200
+                yield client
+
+        yield start
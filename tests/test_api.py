@@ -0,0 +1,354 @@
+import asyncio
+import json
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pytest
+import torch
+from fastapi import HTTPException
+from transformers import BertModel
+
+from lucky_ai.admission import AdmissionController, DeadlineExceeded, Overloaded, VersionStats
+from lucky_ai.autotune import select_profile
+from lucky_ai.inference import LuckyPredictor, apply_inference_profile
+from lucky_ai.lora import LoRALinear
+from lucky_ai.model import LuckyBertModel
+from lucky_ai.registry import ModelRegistry
+
+
+def test_tokenize_pads_to_bucket(tiny_model, tiny_tokenizer):
+    """Questions are padded up to the nearest sequence-length bucket."""
+    predictor = LuckyPredictor(tiny_model, tiny_tokenizer, buckets=(8, 16), compile_mode="none")
+
+    input_ids, attention_mask = predictor.tokenize(["Is the sky blue?"])
+    assert input_ids.shape == (1, 8)
+    assert attention_mask.sum() == 7
+
+    input_ids, _ = predictor.tokenize(["is the sky blue " * 3])
+    assert input_ids.shape == (1, 16)
+
+
+def test_warmup_compiles_every_bucket(tiny_model, tiny_tokenizer):
+    """Warmup traces a forward per bucket and matches the eager model."""
+    predictor = LuckyPredictor(tiny_model, tiny_tokenizer, buckets=(8, 16), compile_mode="trace")
+    assert not predictor.ready.is_set()
+
+    predictor.warmup(passes=1)
+    assert predictor.ready.is_set()
+    assert set(predictor._forwards) == {8, 16}
+
+    input_ids, attention_mask = predictor.tokenize(["Is the sky blue?", "Is grass purple?"])
+    with torch.no_grad():
+        expected = tiny_model(input_ids, attention_mask)
+    assert torch.allclose(predictor.forward(input_ids, attention_mask), expected, atol=1e-5)
+
+    probs = predictor.predict(["Is the sky blue?"])
+    assert probs.shape == (1, 2)
+
+
+def test_ready_endpoint(api_client):
+    """The readiness probe and inference only succeed once warmup has finished."""
+    warmup_done = threading.Event()
+
+    def blocked_warmup(self: LuckyPredictor, passes: int = 2) -> None:
+        warmup_done.wait(timeout=10)
+        self.ready.set()
+
+    with (
+        patch("lucky_ai.api.upsert_feedback_bulk") as upsert_feedback_bulk,
+        patch.object(LuckyPredictor, "warmup", blocked_warmup),
+    ):
+        with api_client(wait_ready=False) as client:
+            assert client.get("/health").status_code == 200
+            assert client.get("/ready").status_code == 503
+            assert client.post("/ask_model/", params={"question": "Is the sky blue?"}).status_code == 503
+
+            warmup_done.set()
+            for _ in range(100):
+                if client.get("/ready").status_code == 200:
+                    break
+                time.sleep(0.05)
+            assert client.get("/ready").status_code == 200
+            response = client.post("/ask_model/", params={"question": "Is the sky blue?"})
+            assert response.status_code == 200
+            assert response.json()["model_version"] == "v1"
+            probs = response.json()["probs"]
+            assert abs(probs["yes"] + probs["no"] - 1) < 1e-5
+
+            assert client.get("/metrics").json()["versions"]["v1"]["requests"] == 1
+
+            feedback = {"prompt": "Is the sky blue?", "label": "yes", "model_version": "v1"}
+            response = client.post("/submit_feedback/", params=feedback)
+            assert response.json() == {"status": "success"}
+            response = client.post("/submit_feedback/", params={"prompt": "Is the sky\x00 blue?", "label": "yes"})
+            assert response.status_code == 422
+            assert client.get("/metrics").json()["feedback_spool"]["pending"] == 1
+
+        # Shutdown drains the spool into the database
+        records = upsert_feedback_bulk.call_args.args[0]
+        assert [(r["prompt"], r["label"], r["model_version"]) for r in records] == [("Is the sky blue?", "yes", "v1")]
+
+
+def test_registry_swap_split_and_unload(tiny_model, tiny_tokenizer, tmp_path):
+    """Versions can be pinned, swapped, split by weight and unloaded."""
+    for version in ["v1", "v2"]:
+        (tmp_path / version).mkdir()
+        (tmp_path / version / "model.ckpt").touch()
+
+    with patch("lucky_ai.registry.LuckyBertModel.load_from_checkpoint", return_value=tiny_model):
+        registry = ModelRegistry(str(tmp_path), tiny_tokenizer, compile_mode="none")
+        assert registry.available() == ["v1", "v2"]
+        assert not registry.is_ready()
+
+        registry.load("v1", make_default=True)
+        registry.load_async("v2").join()
+
+    assert registry.select()[0] == "v1"
+    assert registry.select("v2")[0] == "v2"
+
+    registry.set_default("v2")
+    assert registry.select()[0] == "v2"
+
+    registry.set_weights({"v1": 1.0, "v2": 0.0})
+    assert registry.select()[0] == "v1"
+
+    with pytest.raises(ValueError):
+        registry.unload("v1")
+    registry.set_weights({})
+    registry.unload("v1")
+    assert registry.loaded() == {"v2": True}
+    with pytest.raises(KeyError):
+        registry.select("v1")
+
+
+def test_load_failures_are_reported(api_client, tiny_tokenizer, tmp_path):
+    """A failed background load is recorded per version and fails the readiness probe instead of hanging."""
+    corrupt = patch("lucky_ai.registry.LuckyBertModel.load_from_checkpoint", side_effect=RuntimeError("corrupt"))
+    with corrupt:
+        registry = ModelRegistry(str(tmp_path / "models"), tiny_tokenizer, compile_mode="none")
+        registry.load_async("v1").join()
+    assert registry.errors == {"v1": "RuntimeError: corrupt"}
+    assert registry.loaded() == {}
+
+    for model_dir, error in [(tmp_path / "models", "RuntimeError: corrupt"), (tmp_path / "empty", "FileNotFoundError")]:
+        with corrupt, patch("lucky_ai.api.MODEL_DIR", str(model_dir)), api_client(wait_ready=False) as client:
+            for _ in range(100):
+                response = client.get("/ready")
+                if response.json()["status"] == "failed":
+                    break
+                time.sleep(0.05)
+            assert response.status_code == 503
+            assert response.json()["error"].startswith(error)
+
+            models = client.get("/admin/models", headers={"X-Admin-Token": "secret"})
+            if model_dir.exists():
+                assert models.json()["errors"] == {"v1": "RuntimeError: corrupt"}
+            else:
+                assert models.status_code == 503
+
+
+def test_registry_serves_adapters_on_shared_base(tiny_bert_config, tiny_tokenizer, tmp_path):
+    """Adapter versions share one base encoder in memory, merged adapters give the same predictions."""
+    for version in ["a1", "a2"]:
+        model = LuckyBertModel(lora_rank=4, bert=BertModel(tiny_bert_config))
+        with torch.no_grad():
+            for name, p in model.named_parameters():
+                if ".lora_B" in name or name.startswith("classifier."):
+                    p.normal_(std=0.5)
+        checkpoint = {"state_dict": model.state_dict(), LuckyBertModel.CHECKPOINT_HYPER_PARAMS_KEY: dict(model.hparams)}
+        model.on_save_checkpoint(checkpoint)
+        (tmp_path / version).mkdir()
+        torch.save(checkpoint, tmp_path / version / "adapter.ckpt")
+
+    base = BertModel(tiny_bert_config)
+    with patch("lucky_ai.registry.BertModel.from_pretrained", return_value=base) as from_pretrained:
+        registry = ModelRegistry(str(tmp_path), tiny_tokenizer, compile_mode="trace")
+        assert registry.available() == ["a1", "a2"]
+        first, second = registry.load("a1"), registry.load("a2")
+        merged = ModelRegistry(str(tmp_path), tiny_tokenizer, compile_mode="trace", merge_adapters=True).load("a1")
+    assert from_pretrained.call_count == 2
+
+    # Traced forwards keep pointing at the shared weights
+    shared = base.embeddings.word_embeddings.weight.data_ptr()
+    for predictor in (first, second):
+        assert predictor.model.bert.embeddings.word_embeddings.weight.data_ptr() == shared
+        assert shared in {p.data_ptr() for p in predictor._forwards[16].parameters()}
+
+    questions = ["Is the sky blue?", "is the grass purple?"]
+    assert not np.allclose(first.predict(questions), second.predict(questions))
+    assert not any(isinstance(m, LoRALinear) for m in merged.model.modules())
+    assert np.allclose(merged.predict(questions), first.predict(questions), atol=1e-5)
+
+
+def test_admission_sheds_when_queue_full():
+    """Requests beyond the queue bound are shed, queued requests past their deadline are dropped."""
+
+    async def scenario() -> None:
+        controller = AdmissionController(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def hold_slot() -> None:
+            async with controller.admit(time.monotonic() + 10):
+                await release.wait()
+
+        async def queued() -> None:
+            async with controller.admit(time.monotonic() + 0.05):
+                pass
+
+        holder = asyncio.create_task(hold_slot())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(queued())
+        await asyncio.sleep(0)
+        assert controller.stats()["queue_depth"] == 1
+
+        with pytest.raises(Overloaded):
+            async with controller.admit(time.monotonic() + 10):
+                pass
+
+        with pytest.raises(DeadlineExceeded):
+            await waiter
+
+        release.set()
+        await holder
+
+        stats = controller.stats()
+        assert stats["shed"] == 1
+        assert stats["expired"] == 1
+        assert stats["completed"] == 1
+        assert stats["queue_depth"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_fallback_is_bounded_by_its_own_admission_queue():
+    """Requests shed by the main queue go to the fallback version until its queue is full as well."""
+    from lucky_ai import api
+
+    predictor = Mock(predict=Mock(side_effect=lambda questions: time.sleep(0.2) or np.array([[0.5, 0.5]])))
+    registry = Mock(is_ready=Mock(return_value=True), loaded=Mock(return_value={"small": True}))
+    registry.select.side_effect = lambda version=None: (version or "big", predictor)
+
+    admission = AdmissionController(max_concurrency=1, max_queue=0)
+    fallback_admission = AdmissionController(max_concurrency=1, max_queue=0)
+    version_stats = VersionStats()
+
+    async def scenario() -> list:
+        return await asyncio.gather(*(api.answer("Is it?") for _ in range(3)), return_exceptions=True)
+
+    with (
+        patch("lucky_ai.api.registry", registry),
+        patch("lucky_ai.api.admission", admission, create=True),
+        patch("lucky_ai.api.fallback_admission", fallback_admission, create=True),
+        patch("lucky_ai.api.version_stats", version_stats, create=True),
+        patch("lucky_ai.api.FALLBACK_MODEL_VERSION", "small"),
+    ):
+        results = asyncio.run(scenario())
+
+    assert [r["model_version"] for r in results[:2]] == ["big", "small"]
+    assert isinstance(results[2], HTTPException) and results[2].status_code == 503
+    assert admission.fallback == 2
+    assert fallback_admission.stats()["shed"] == 1
+    # Outcomes are counted under the version that answered, failures under the one that was selected
+    stats = version_stats.stats()
+    assert stats["big"]["requests"] == 2 and stats["big"]["failed"] == 1
+    assert stats["small"]["requests"] == 1 and stats["small"]["latency_p50_ms"] >= 200
+
+
+def test_websocket_answers_with_correlation_ids(api_client):
+    """Questions sent over one WebSocket are answered with their ids, bad messages get an error."""
+    with patch("lucky_ai.api.WS_MAX_IN_FLIGHT", 2), api_client() as client:
+        with client.websocket_connect("/ws/ask_model") as websocket:
+            for i in range(5):
+                websocket.send_json({"id": f"q{i}", "question": f"Question {i}?"})
+            websocket.send_json({"id": "bad"})
+            websocket.send_json({"id": "timeout", "question": "?", "timeout_ms": "abc"})
+            websocket.send_json({"id": "version", "question": "?", "version": ["x"]})
+            websocket.send_json({"id": "missing", "question": "Is it?", "version": "v9"})
+
+            answers = {}
+            for _ in range(9):
+                message = websocket.receive_json()
+                answers[message["id"]] = message
+
+            # Unexpected failures are answered too, instead of leaving the question pending
+            with patch("lucky_ai.api.predict_fn", return_value=Mock(side_effect=ValueError("boom"))):
+                websocket.send_json({"id": "fails", "question": "Is it?"})
+                answers["fails"] = websocket.receive_json()
+
+        for i in range(5):
+            assert answers[f"q{i}"]["model_version"] == "v1"
+            assert abs(sum(answers[f"q{i}"]["probs"].values()) - 1) < 1e-5
+        for message_id in ["bad", "timeout", "version"]:
+            assert answers[message_id]["error"]["status"] == 422
+        assert answers["missing"]["error"]["status"] == 404
+        assert answers["fails"]["error"]["status"] == 500
+        # The five answers and the failed prediction
+        assert client.get("/metrics").json()["admission"]["completed"] == 6
+
+
+def test_profile_endpoint_profiles_next_requests(api_client):
+    """An admin can profile the next N requests and download the trace and op summary."""
+    admin = {"X-Admin-Token": "secret"}
+
+    with api_client() as client:
+        from lucky_ai import api
+
+        assert client.post("/admin/profile", params={"requests": 2}).status_code == 403
+        session = client.post("/admin/profile", params={"requests": 2}, headers=admin).json()["session"]
+        assert client.post("/admin/profile", headers=admin).status_code == 409
+
+        for _ in range(2):
+            assert client.post("/ask_model/", params={"question": "Is the sky blue?"}).status_code == 200
+        status = client.get("/admin/profile", headers=admin).json()
+        assert not status["active"] and status["last_session"] == session
+        assert api.predict_fn(api.registry.select()[1]) == api.registry.select()[1].predict
+
+        summary = client.get(f"/admin/profile/{session}/summary.md", headers=admin).text
+        assert "Profiled requests: 2" in summary
+        assert "### Top ops in forward by self CPU time" in summary
+        assert "aten::" in summary
+        trace = client.get(f"/admin/profile/{session}/trace.json", headers=admin).json()
+        assert {"tokenize", "forward", "softmax"} <= {e.get("name") for e in trace["traceEvents"]}
+        assert client.get(f"/admin/profile/{session}/secrets.txt", headers=admin).status_code == 404
+
+
+def test_bf16_predictor_and_inference_profile(tiny_model, tiny_tokenizer, tmp_path):
+    """bf16 autocast stays close to fp32, and a tuned profile sets the torch thread count."""
+    questions = ["Is the sky blue?", "Is grass purple?"]
+    fp32 = LuckyPredictor(tiny_model, tiny_tokenizer, compile_mode="trace")
+    bf16 = LuckyPredictor(tiny_model, tiny_tokenizer, compile_mode="trace", precision="bf16")
+    fp32.warmup(passes=1)
+    bf16.warmup(passes=1)
+    probs = bf16.predict(questions)
+    assert probs.dtype == "float32"
+    assert abs(probs - fp32.predict(questions)).max() < 0.02
+
+    profile_path = tmp_path / "inference_profile.json"
+    profile_path.write_text(json.dumps({"intra_op_threads": 1, "inter_op_threads": 1, "precision": "bf16"}))
+    threads = torch.get_num_threads()
+    try:
+        assert apply_inference_profile(str(profile_path))["precision"] == "bf16"
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
+
+
+def test_autotune_profile_from_served_batch_sizes():
+    """The applied profile has the lowest p50 within the p99 budget at the served batch size."""
+    columns = ["batch_size", "intra_op_threads", "p50_ms", "p99_ms", "throughput", "max_prob_diff"]
+    rows = [
+        (1, 4, 6.0, 9.0, 150.0, 0.0),
+        (1, 2, 5.0, 30.0, 140.0, 0.0),
+        (1, 1, 3.0, 5.0, 200.0, 0.05),
+        (32, 8, 2.0, 4.0, 900.0, 0.0),
+    ]
+    results = [dict(zip(columns, row)) for row in rows]
+    # A single slow outlier in the p99 does not outrank a lower p50
+    assert select_profile(results, [1], max_prob_diff=0.02)["intra_op_threads"] == 2
+    assert select_profile(results, [1], max_prob_diff=0.02, max_p99_ms=20.0)["intra_op_threads"] == 4
+    assert select_profile(results, [1], max_prob_diff=0.02, max_p99_ms=1.0)["intra_op_threads"] == 2
+    assert select_profile(results, [1, 32], max_prob_diff=0.02)["batch_size"] == 32
+    with pytest.raises(ValueError):
+        select_profile(results, [8], max_prob_diff=0.02)
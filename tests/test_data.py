@@ -1,12 +1,19 @@
 import pandas as pd
 from unittest.mock import patch
 
+import pytest
+
 from lucky_ai.data import (
+    migrate_processed,
     preprocess_commonsense,
     preprocess_justice,
     preprocess_strategyQA,
     preprocess_boolq,
+    preprocess_user,
+    save_partition,
 )
+from lucky_ai.database import aggregate_feedback, aggregate_version_feedback
+from lucky_ai.dataset import LuckyDataset
 
 
 def test_preprocess_commonsense(tmp_path):
@@ -18,14 +25,14 @@ def test_preprocess_commonsense(tmp_path):
         preprocess_commonsense()
 
     # Check train file
-    train_df = pd.read_parquet(output_dir / "commonsense_train.parquet")
+    train_df = pd.read_parquet(output_dir / "subset=commonsense" / "split=train")
     assert "label" in train_df.columns
     assert "input" in train_df.columns
     assert train_df["label"].dtype == bool
     assert len(train_df) > 0
 
     # Check test file
-    test_df = pd.read_parquet(output_dir / "commonsense_test.parquet")
+    test_df = pd.read_parquet(output_dir / "subset=commonsense" / "split=test")
     assert "label" in test_df.columns
     assert "input" in test_df.columns
     assert test_df["label"].dtype == bool
@@ -41,14 +48,14 @@ def test_preprocess_justice(tmp_path):
         preprocess_justice()
 
     # Check train file
-    train_df = pd.read_parquet(output_dir / "justice_train.parquet")
+    train_df = pd.read_parquet(output_dir / "subset=justice" / "split=train")
     assert "input" in train_df.columns
     assert "label" in train_df.columns
     assert train_df["label"].dtype == bool
     assert len(train_df) > 0
 
     # Check test file
-    test_df = pd.read_parquet(output_dir / "justice_test.parquet")
+    test_df = pd.read_parquet(output_dir / "subset=justice" / "split=test")
     assert "input" in test_df.columns
     assert "label" in test_df.columns
     assert test_df["label"].dtype == bool
@@ -64,13 +71,13 @@ def test_preprocess_strategyqa(tmp_path):
         preprocess_strategyQA()
 
     # Check train file
-    train_df = pd.read_parquet(output_dir / "strategyqa_train.parquet")
+    train_df = pd.read_parquet(output_dir / "subset=strategyqa" / "split=train")
     assert list(train_df.columns) == ["input", "label"]
     assert train_df["label"].dtype == bool
     assert len(train_df) > 0
 
     # Check test file
-    test_df = pd.read_parquet(output_dir / "strategyqa_test.parquet")
+    test_df = pd.read_parquet(output_dir / "subset=strategyqa" / "split=test")
     assert list(test_df.columns) == ["input", "label"]
     assert test_df["label"].dtype == bool
     assert len(test_df) > 0
@@ -85,13 +92,112 @@ def test_preprocess_boolq(tmp_path):
         preprocess_boolq()
 
     # Check train file
-    train_df = pd.read_parquet(output_dir / "boolq_train.parquet")
+    train_df = pd.read_parquet(output_dir / "subset=boolq" / "split=train")
     assert list(train_df.columns) == ["input", "label"]
     assert train_df["label"].dtype == bool
     assert len(train_df) > 0
 
     # Check test file
-    test_df = pd.read_parquet(output_dir / "boolq_test.parquet")
+    test_df = pd.read_parquet(output_dir / "subset=boolq" / "split=test")
     assert list(test_df.columns) == ["input", "label"]
     assert test_df["label"].dtype == bool
     assert len(test_df) > 0
+
+
+def test_save_partition_replaces_partition(tmp_path):
+    """Saving a partition replaces its previous contents and leaves other partitions alone."""
+    with patch("lucky_ai.data.PROCESSED_DIR", tmp_path), patch("lucky_ai.data.ROW_GROUP_SIZE", 2):
+        save_partition(pd.DataFrame({"input": ["a", "b", "c"], "label": [True, False, True]}), "user", "train")
+        save_partition(pd.DataFrame({"input": ["x"], "label": [False]}), "user", "new")
+        path = save_partition(pd.DataFrame({"input": ["d"], "label": [False], "time": [0]}), "user", "train")
+
+    assert path == tmp_path / "subset=user" / "split=train" / "part-0.parquet"
+    assert pd.read_parquet(path).to_dict("list") == {"input": ["d"], "label": [False]}
+    assert len(pd.read_parquet(tmp_path / "subset=user" / "split=new")) == 1
+    assert not list(tmp_path.rglob(".*"))
+
+
+def test_migrate_flat_processed_files(tmp_path):
+    """Flat files of earlier versions are rejected with a hint, and readable once migrated."""
+    for name, labels in [("boolq_train", [True, False]), ("user_test", [True]), ("new_user_train", [False])]:
+        pd.DataFrame({"input": [f"{name} {i}?" for i in range(len(labels))], "label": labels}).to_parquet(
+            tmp_path / f"{name}.parquet", index=False
+        )
+
+    with pytest.raises(FileNotFoundError, match="migrate-processed"):
+        LuckyDataset(train=True, data_dir=str(tmp_path))
+
+    migrate_processed(processed_dir=tmp_path)
+    assert not list(tmp_path.glob("*.parquet"))
+    assert len(LuckyDataset(train=True, data_dir=str(tmp_path))) == 2
+    assert LuckyDataset(train=False, data_dir=str(tmp_path)).df["subset"].tolist() == ["user"]
+    assert len(pd.read_parquet(tmp_path / "subset=user" / "split=new")) == 1
+
+
+def test_aggregate_feedback_per_normalized_prompt():
+    """Votes on spellings of the same prompt are summed into one row with its first and last vote times."""
+    rows = aggregate_feedback(
+        [
+            ("Is the sky blue?", 1, 0, "2025-01-02", "2025-01-02"),
+            ("is the  SKY blue?", 0, 1, "2025-01-01", "2025-01-01"),
+            ("Is the sky blue? ", 1, 0, "2025-01-03", "2025-01-03"),
+            ("Is grass purple?", 0, 1, "2025-01-01", "2025-01-01"),
+        ]
+    )
+    assert rows == [
+        ("is grass purple?", "Is grass purple?", 0, 1, "2025-01-01", "2025-01-01"),
+        ("is the sky blue?", "is the  SKY blue?", 2, 1, "2025-01-01", "2025-01-03"),
+    ]
+
+
+def test_aggregate_feedback_per_model_version():
+    """Votes that name the model version they answered are counted per prompt and version."""
+    records = [
+        {"prompt": "Is the sky blue?", "label": "yes", "time": "2025-01-02", "model_version": "v2"},
+        {"prompt": "is the sky BLUE?", "label": "no", "time": "2025-01-01", "model_version": "v2"},
+        {"prompt": "Is the sky blue?", "label": "yes", "time": "2025-01-03", "model_version": "v1"},
+        {"prompt": "Is the sky blue?", "label": "no", "time": "2025-01-03", "model_version": None},
+        {"prompt": "Is the sky blue?", "label": "no", "time": "2025-01-03"},
+    ]
+    assert aggregate_version_feedback(records) == [
+        ("is the sky blue?", "v1", 1, 0, "2025-01-03", "2025-01-03"),
+        ("is the sky blue?", "v2", 1, 1, "2025-01-01", "2025-01-02"),
+    ]
+
+
+def test_preprocess_user_labels_from_votes(tmp_path, monkeypatch):
+    """Majority labels skip ties, soft labels repeat each train prompt in proportion to its votes."""
+    monkeypatch.chdir(tmp_path)
+    votes = pd.DataFrame(
+        {
+            "prompt_key": [f"prompt {i}" for i in range(50)],
+            "prompt": [f"Prompt {i}" for i in range(50)],
+            "yes_count": [3, 1, 2, 0, 5] * 10,
+            "no_count": [1, 1, 0, 4, 0] * 10,
+            "first_seen": ["2025-01-01T00:00:00+00:00"] * 50,
+            "last_seen": ["2025-01-02T00:00:00+00:00"] * 50,
+        }
+    )
+    (tmp_path / "last_user_data_sync.txt").write_text("2025-01-01 12:00:00+00:00")
+
+    with patch("lucky_ai.data.PROCESSED_DIR", tmp_path), patch("lucky_ai.data.fetch_user_feedback", return_value=votes):
+        preprocess_user(label_mode="majority")
+        train = pd.read_parquet(tmp_path / "subset=user" / "split=train")
+        test = pd.read_parquet(tmp_path / "subset=user" / "split=test")
+        # The ties of "Prompt 1", "Prompt 6", ... are skipped
+        assert len(train) + len(test) == 40
+        assert 0 < len(test) < len(train)
+        assert set(train["input"]).isdisjoint(test["input"])
+        labels = pd.concat([train, test]).set_index("input")["label"]
+        assert all(labels[p] == (int(p.split()[1]) % 5 in (0, 2, 4)) for p in labels.index)
+
+        preprocess_user(label_mode="soft", soft_resolution=4)
+        soft_train = pd.read_parquet(tmp_path / "subset=user" / "split=train")
+        # The split of a prompt does not depend on the label mode, ties are kept as 50/50 soft labels
+        assert set(train["input"]) < set(soft_train["input"])
+        assert set(soft_train["input"]).isdisjoint(test["input"])
+        true_rows = soft_train.groupby("input")["label"].sum()
+        assert all(true_rows[p] == [3, 2, 4, 0, 4][int(p.split()[1]) % 5] for p in true_rows.index)
+        assert (soft_train["input"].value_counts() == 4).all()
+
+    assert (tmp_path / "last_user_data_sync.txt").read_text() == "2025-01-02 00:00:00+00:00"
@@ -1,7 +1,31 @@
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+import pytorch_lightning as pl
 import torch
 from torch.utils.data import Dataset
+from transformers import BertModel
+
+from lucky_ai.coreset import coreset, load_embeddings, select_coreset
+from lucky_ai.data_profile import padding_waste, profile, scan, truncation_rate
+from lucky_ai.dataset import (
+    HardExampleSampler,
+    LuckyDataset,
+    LuckyDataModule,
+    apply_selection,
+    example_keys,
+    open_processed,
+)
 
-from lucky_ai.dataset import LuckyDataset, LuckyDataModule
+
+def write_partition(data_dir, subset: str, split: str, inputs: list[str], labels: list[bool]) -> None:
+    """Write one subset/split partition of a processed dataset, three rows per row group."""
+    partition_dir = data_dir / f"subset={subset}" / f"split={split}"
+    partition_dir.mkdir(parents=True)
+    pd.DataFrame({"input": inputs, "label": labels}).to_parquet(
+        partition_dir / "part-0.parquet", index=False, row_group_size=3
+    )
 
 
 def test_dataset():
@@ -54,3 +78,272 @@ def test_dataloaders():
 
     assert batch["input_ids"].ndim == 2
     assert batch["input_ids"].shape[0] == 2
+
+
+def test_profile_length_statistics():
+    """Check truncation rate and expected padding waste on known length distributions."""
+    counts = np.zeros(1025, dtype=np.int64)
+    counts[10] = 50
+    counts[200] = 50
+    assert truncation_rate(counts, 128) == 0.5
+    assert truncation_rate(counts, 256) == 0.0
+
+    # Equal lengths never need padding
+    uniform = np.zeros(1025, dtype=np.int64)
+    uniform[20] = 100
+    assert padding_waste(uniform, 128, 32) == 0.0
+
+    # A batch of one is never padded, larger batches of mixed lengths are
+    assert abs(padding_waste(counts, 128, 1)) < 1e-9
+    assert padding_waste(counts, 128, 16) > padding_waste(counts, 128, 2) > 0
+
+
+def test_profile_scan_and_cache(tiny_tokenizer, tmp_path):
+    """The profiler counts token lengths per subset and reuses its cache on unchanged data."""
+    data_dir = tmp_path / "processed"
+    data_dir.mkdir()
+    write_partition(data_dir, "boolq", "train", ["Is the sky blue?", "Is grass purple?", "sky"], [True, False, True])
+
+    profiles = scan(open_processed(data_dir), tiny_tokenizer, batch_rows=2)
+    counts = np.asarray(profiles["boolq/train"]["length_counts"])
+    assert counts.sum() == 3
+    # e.g. [CLS] is the sky blue ? [SEP]
+    assert counts[7] == 1 and counts[6] == 1 and counts[3] == 1
+    assert profiles["boolq/train"]["labels"] == {"true": 2, "false": 1}
+
+    cache_dir = tmp_path / "cache"
+    with patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer) as load:
+        profile(data_dir=data_dir, cache_dir=cache_dir, max_lengths=[4, 8], batch_sizes=[2])
+        profile(data_dir=data_dir, cache_dir=cache_dir, max_lengths=[4, 8], batch_sizes=[2])
+        assert load.call_count == 1
+        assert len(list(cache_dir.glob("*.json"))) == 1
+
+        # Rewritten data gets a new key
+        write_partition(data_dir, "user", "train", ["Is it?"], [True])
+        profile(data_dir=data_dir, cache_dir=cache_dir, max_lengths=[4, 8], batch_sizes=[2])
+    assert len(list(cache_dir.glob("*.json"))) == 2
+
+
+def test_hard_example_sampler():
+    """Hard examples are sampled more often while quotas and the coverage floor are respected."""
+    subsets = ["boolq"] * 10 + ["user"] * 10
+    sampler = HardExampleSampler(subsets, num_samples=1000, quotas={"boolq": 0.8, "user": 0.2}, floor=0.2)
+    assert len(sampler) == 1000
+
+    # Example 0 is hard and misclassified, the rest are easy
+    sampler.update(torch.arange(20), torch.full((20,), 0.01), torch.ones(20, dtype=torch.bool))
+    sampler.update(torch.tensor([0]), torch.tensor([5.0]), torch.tensor([False]))
+
+    samples = np.array(list(sampler))
+    assert len(samples) == 1000
+    assert (samples < 10).sum() == 800
+    counts = np.bincount(samples, minlength=20)
+    assert counts[0] > 5 * counts[1:10].max()
+    # The floor keeps easy examples in rotation
+    assert (counts[1:10] > 0).all()
+
+
+def test_hard_example_sampler_without_losses():
+    """An epoch can be drawn before any loss is recorded, and a subset whose losses are all 0 is uniform."""
+    sampler = HardExampleSampler(["boolq"] * 10 + ["user"] * 10, num_samples=400, floor=0.0)
+    assert len(list(sampler)) == 400
+
+    sampler.update(torch.arange(10, 20), torch.zeros(10), torch.ones(10, dtype=torch.bool))
+    assert torch.allclose(sampler.weights(np.arange(10, 20)), torch.full((10,), 0.1, dtype=torch.float64))
+    counts = np.bincount(list(sampler), minlength=20)
+    assert counts[10:].sum() == 200 and (counts[10:] > 0).all()
+
+
+def test_collate_fn_with_indices():
+    """Indexed items produce an indices tensor for the hard-example sampler."""
+    dm = LuckyDataModule(model_name="bert-base-uncased", batch_size=2)
+    output = dm.collate_fn([("Is the sky blue?", True, 7), ("Is grass purple?", False, 3)])
+    assert output["indices"].tolist() == [7, 3]
+
+
+def test_dataset_rank_shards(tmp_path):
+    """Data-parallel ranks read disjoint, equal-sized shards that together cover the data."""
+    write_partition(tmp_path, "a", "train", [f"a{i}" for i in range(7)], [True] * 7)
+    write_partition(tmp_path, "b", "train", [f"b{i}" for i in range(4)], [False] * 4)
+
+    shards = [LuckyDataset(train=True, data_dir=str(tmp_path), rank=r, world_size=3) for r in range(3)]
+    assert [len(s) for s in shards] == [3, 3, 3]
+    inputs = [q for s in shards for q in s.df["input"]]
+    assert len(set(inputs)) == 9
+    # The shard boundary falls inside a row group, the remainder row b3 is dropped
+    assert shards[2].df["input"].tolist() == ["a6", "b0", "b1"]
+    assert shards[2].df["subset"].tolist() == ["a", "b", "b"]
+
+
+def test_dataset_partition_filters(tmp_path):
+    """Only the requested split and subsets are read, new user data stays out of train."""
+    write_partition(tmp_path, "boolq", "train", ["q1", "q2"], [True, False])
+    write_partition(tmp_path, "boolq", "test", ["q3"], [True])
+    write_partition(tmp_path, "user", "train", ["u1"], [False])
+    write_partition(tmp_path, "user", "new", ["n1", "n2"], [True, True])
+    # Left over from the old flat layout
+    pd.DataFrame({"input": ["old"], "label": [True]}).to_parquet(tmp_path / "boolq_train.parquet")
+
+    train = LuckyDataset(train=True, data_dir=str(tmp_path))
+    assert sorted(train.df["input"]) == ["q1", "q2", "u1"]
+    assert list(train.df.columns) == ["input", "label", "subset"]
+    assert train[0] == ("q1", True)
+
+    user = LuckyDataset(train=True, data_dir=str(tmp_path), subsets=["user"])
+    assert user.df["input"].tolist() == ["u1"]
+    assert LuckyDataset(train=False, data_dir=str(tmp_path)).df["subset"].tolist() == ["boolq"]
+
+
+def test_hard_example_sampler_exact_length():
+    """Epoch length is exactly num_samples whatever the quotas, so data-parallel ranks stay in step."""
+    sampler = HardExampleSampler(["a", "b", "c"] * 5, num_samples=10)
+    assert len(sampler) == 10
+    assert len(list(sampler)) == 10
+
+
+def test_select_coreset_balances_labels_and_covers_clusters():
+    """Each subset keeps its fraction, split evenly by label, with one pick from every cluster."""
+    rng = np.random.default_rng(0)
+    # Four tight clusters of 10 examples per label in subset a, 10 examples of one label in subset b
+    centers = np.eye(8)[:4] * 10
+    true_rows = np.concatenate([center + rng.normal(scale=0.01, size=(10, 8)) for center in centers])
+    false_rows = np.concatenate([-center + rng.normal(scale=0.01, size=(10, 8)) for center in centers])
+    embeddings = np.concatenate([true_rows, false_rows, rng.normal(size=(10, 8))])
+    subsets = np.array(["a"] * 80 + ["b"] * 10)
+    labels = np.array([True] * 40 + [False] * 40 + [True] * 10)
+
+    selected = select_coreset(embeddings, subsets, labels, fraction=0.1)
+    assert selected[:80].sum() == 8 and selected[80:].sum() == 1
+    assert selected[:40].sum() == selected[40:80].sum() == 4
+    assert {i // 10 for i in np.flatnonzero(selected[:80])} == set(range(8))
+
+
+def test_coreset_selection_applied_by_dataset(tiny_tokenizer, tiny_bert_config, tmp_path):
+    """The dataset reads only selected rows plus rows added since, and reruns reuse cached embeddings."""
+    data_dir, output_dir = tmp_path / "processed", tmp_path / "coreset"
+    write_partition(data_dir, "boolq", "train", [f"is it {i}?" for i in range(12)], [i % 2 == 0 for i in range(12)])
+    options = dict(model_path=None, subsets=[], max_clusters=512, embed_batch_size=4, seed=0, benchmark_epochs=0)
+
+    with (
+        patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer),
+        patch("transformers.BertModel.from_pretrained", return_value=BertModel(tiny_bert_config)) as load,
+    ):
+        coreset(output_dir=output_dir, data_dir=str(data_dir), fractions=[0.5], **options)
+        selected = LuckyDataset(train=True, data_dir=str(data_dir), selection=str(output_dir / "coreset-50.parquet"))
+        assert len(selected) == 6
+        assert selected.df["label"].sum() == 3
+
+        # A new partition is kept in full until the next coreset run, which only embeds its rows
+        write_partition(data_dir, "user", "train", ["new?"], [True])
+        dataset = LuckyDataset(train=True, data_dir=str(data_dir), selection=str(output_dir / "coreset-50.parquet"))
+        assert "new?" in dataset.df["input"].tolist() and len(dataset) == 7
+
+        coreset(output_dir=output_dir, data_dir=str(data_dir), fractions=[0.5], **options)
+        assert load.call_count == 2
+        with np.load(output_dir / "embeddings.npz") as cache:
+            assert len(cache["keys"]) == 13
+
+
+def test_coreset_keys_tell_soft_label_copies_apart(tmp_path):
+    """Repeated rows get one key per copy, so a selection can keep some of them, and are embedded once."""
+    df = pd.DataFrame({"subset": "boolq", "input": ["is it?"] * 3 + ["other?"], "label": [True] * 4})
+    keys = example_keys(df)
+    assert len(set(keys.tolist())) == 4
+
+    selection = tmp_path / "coreset.parquet"
+    pd.DataFrame({"key": keys, "selected": [True, False, True, False]}).to_parquet(selection, index=False)
+    assert apply_selection(df, str(selection))["input"].tolist() == ["is it?", "is it?"]
+
+    embedded: list[str] = []
+
+    def embed_fn(texts: list[str]) -> np.ndarray:
+        embedded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts]).reshape(-1, 2)
+
+    embeddings, count = load_embeddings(df["input"].tolist(), keys, tmp_path / "embeddings.npz", "m", embed_fn)
+    assert sorted(embedded) == ["is it?", "other?"] and count == 4
+    assert embeddings[:, 0].tolist() == [6, 6, 6, 6]
+
+    # A rerun with everything cached embeds nothing, an empty group keeps the width and the cache
+    embeddings, count = load_embeddings(df["input"].tolist(), keys, tmp_path / "embeddings.npz", "m", embed_fn)
+    assert count == 0 and embeddings.shape == (4, 2) and len(embedded) == 2
+    empty, count = load_embeddings([], keys[:0], tmp_path / "embeddings.npz", "m", embed_fn)
+    assert empty.shape == (0, 2) and count == 0
+    empty, _ = load_embeddings([], keys[:0], tmp_path / "other.npz", "m", embed_fn)
+    assert empty.shape == (0, 2) and not (tmp_path / "other.npz").exists()
+    with np.load(tmp_path / "embeddings.npz") as cache:
+        assert len(cache["keys"]) == 4
+
+
+def test_stratified_validation_schedule(tiny_model, tiny_tokenizer, tmp_path):
+    """Most passes validate on a stratified sample, every K-th and the last pass on the full test set."""
+    questions = ["is the sky blue?", "is the grass purple?", "is the sky purple?", "is the grass blue?"]
+    for subset, n in [("boolq", 12), ("user", 4)]:
+        inputs = [questions[i % 4] * (1 + i % 3) for i in range(n)]
+        write_partition(tmp_path, subset, "train", inputs, [i % 2 == 0 for i in range(n)])
+        write_partition(tmp_path, subset, "test", inputs, [i % 2 == 0 for i in range(n)])
+
+    with patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer):
+        dm = LuckyDataModule(batch_size=4, data_dir=str(tmp_path), val_samples_per_subset=2, full_val_every=2)
+    dm.setup()
+    assert dm.val_subsets == ["boolq", "user"]
+    assert np.bincount(dm.val_subset_ids[dm.val_sample]).tolist() == [2, 2]
+
+    # Outside of fitting the full test set is used, in batches sorted by length
+    batches = list(dm.val_dataloader())
+    assert sum(len(b["labels"]) for b in batches) == 16
+    widths = [b["input_ids"].shape[1] for b in batches]
+    assert widths == sorted(widths)
+    assert sorted(torch.cat([b["subset_ids"] for b in batches]).tolist()) == [0] * 12 + [1] * 4
+
+    logged = []
+
+    class Record(pl.Callback):
+        def on_validation_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+            if not trainer.sanity_checking:
+                logged.append({k: float(v) for k, v in trainer.callback_metrics.items() if k.startswith("val/")})
+
+    trainer = pl.Trainer(
+        max_epochs=3,
+        reload_dataloaders_every_n_epochs=1,
+        logger=False,
+        enable_checkpointing=False,
+        enable_model_summary=False,
+        enable_progress_bar=False,
+        callbacks=[Record()],
+    )
+    trainer.fit(tiny_model, datamodule=dm)
+
+    assert [m["val/full"] for m in logged] == [0.0, 1.0, 1.0]
+    assert logged[0]["val/acc_ci"] > 0 and logged[-1]["val/acc_ci"] == 0
+    assert {"val/acc/boolq", "val/acc/user", "val/acc_ci/boolq"} <= logged[-1].keys()
+    # The full pass reports the plain accuracy over all test examples
+    full = logged[-1]
+    assert abs(full["val/acc"] - (12 * full["val/acc/boolq"] + 4 * full["val/acc/user"]) / 16) < 1e-6
+
+
+def test_validation_sample_drawn_over_all_ranks(tiny_model, tiny_tokenizer, tmp_path):
+    """Data-parallel ranks share one stratified sample, and a rank without batches still joins the reduce."""
+    for subset, n in [("boolq", 12), ("user", 4)]:
+        for split in ["train", "test"]:
+            write_partition(tmp_path, subset, split, [f"is it {i}?" for i in range(n)], [True] * n)
+
+    sampled = []
+    for rank in range(2):
+        with patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer):
+            dm = LuckyDataModule(batch_size=4, data_dir=str(tmp_path), val_samples_per_subset=3)
+        dm.trainer = Mock(global_rank=rank, world_size=2)
+        dm.setup()
+        assert dm.test_set.shard_start == 8 * rank and len(dm.test_set.split_subsets) == 16
+        sampled.extend(dm.test_set.df["subset"].to_numpy()[dm.val_sample])
+    # Three per subset over both ranks, not three per subset on each rank
+    assert sorted(sampled) == ["boolq"] * 3 + ["user"] * 3
+
+    reduce = Mock(side_effect=lambda tensor, reduce_op: tensor)
+    datamodule = Mock(val_subsets=["boolq", "user"], val_population=np.array([6, 2]))
+    tiny_model._trainer = Mock(datamodule=datamodule, strategy=Mock(reduce=reduce))
+    tiny_model.on_validation_epoch_start()
+    with patch.object(tiny_model, "log") as log:
+        tiny_model.on_validation_epoch_end()
+    assert reduce.call_count == 2 and reduce.call_args_list[0].args[0].tolist() == [[0, 0], [0, 0]]
+    log.assert_not_called()
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+import pytest
+
+# Cumulative import time budget of each entry point. Measured at roughly 0.1-0.3 s, the budget leaves
+# headroom for slower CI machines but fails when torch or another heavy dependency creeps back in.
+IMPORT_BUDGET_S = {
+    "lucky_ai.api": 1.0,
+    "lucky_ai.data": 1.0,
+    "lucky_ai.database": 0.2,
+    "lucky_ai.score": 1.0,
+    "lucky_ai.prune": 1.0,
+    "lucky_ai.autotune": 1.0,
+    "lucky_ai.coreset": 1.0,
+    "lucky_ai.data_profile": 1.0,
+}
+
+# Only imported on the paths that need them
+HEAVY_MODULES = {"torch", "pytorch_lightning", "lightning", "transformers", "datasets", "psycopg2", "pandas", "pyarrow"}
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module imported by `import module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGET_S))
+def test_entry_point_import_time(module):
+    """Entry points import within their budget and without heavy dependencies."""
+    times = import_times(module)
+    assert not HEAVY_MODULES & times.keys(), f"{module} imports {sorted(HEAVY_MODULES & times.keys())}"
+    assert times[module] / 1e6 < IMPORT_BUDGET_S[module]
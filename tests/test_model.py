@@ -1,6 +1,14 @@
 # tests/test_model.py
+from unittest.mock import patch
+
+import pytorch_lightning as pl
 import torch
-from lucky_ai.model import LuckyBertModel
+from torch.utils.data import DataLoader
+from transformers import BertModel
+
+from lucky_ai.lora import LORA_TARGETS, LoRALinear, merge_lora, share_weights
+from lucky_ai.model import LuckyBertModel, stratified_accuracy
+from lucky_ai.prune import compute_importance, save_checkpoint, select_lowest
 
 
 def test_model_initialization():
@@ -32,3 +40,138 @@ def test_model_training_step():
     loss = model.training_step(batch, 0)
     assert loss.ndim == 0  # Should be a single number
     assert not torch.isnan(loss)
+
+
+def test_training_loss_syncs_only_per_epoch(tiny_model):
+    """Check that the step loss is logged without an all-reduce per step."""
+    batch = {
+        "input_ids": torch.randint(0, 10, (2, 8)),
+        "attention_mask": torch.ones((2, 8)),
+        "labels": torch.tensor([0, 1]),
+    }
+    with patch.object(tiny_model, "log") as log:
+        tiny_model.training_step(batch, 0)
+
+    logged = {call.args[0]: call.kwargs for call in log.call_args_list}
+    assert not logged["train/loss_step"].get("sync_dist", False) and not logged["train/loss_step"]["on_epoch"]
+    assert logged["train/loss_epoch"]["sync_dist"] and not logged["train/loss_epoch"]["on_step"]
+
+
+def test_model_memory_lean_mode(tiny_bert_config):
+    """Check that frozen parameters get no gradients and are left out of the optimizer."""
+    with patch("lucky_ai.model.BertModel.from_pretrained", return_value=BertModel(tiny_bert_config)):
+        model = LuckyBertModel(gradient_checkpointing=True, freeze_embeddings=True, freeze_layers=1)
+
+    assert model.bert.is_gradient_checkpointing
+    assert not any(p.requires_grad for p in model.bert.embeddings.parameters())
+    assert not any(p.requires_grad for p in model.bert.encoder.layer[0].parameters())
+    assert all(p.requires_grad for p in model.bert.encoder.layer[1].parameters())
+
+    batch = {
+        "input_ids": torch.randint(0, 10, (2, 8)),
+        "attention_mask": torch.ones((2, 8)),
+        "labels": torch.tensor([0, 1]),
+    }
+    model.training_step(batch, 0).backward()
+    assert model.bert.encoder.layer[0].attention.self.query.weight.grad is None
+    assert model.bert.encoder.layer[1].attention.self.query.weight.grad is not None
+
+    optimized = {id(p) for group in model.configure_optimizers().param_groups for p in group["params"]}
+    assert id(model.bert.embeddings.word_embeddings.weight) not in optimized
+    assert id(model.classifier.weight) in optimized
+
+
+def test_model_pruning_roundtrip(tiny_bert_config, tmp_path):
+    """Check that pruned heads and neurons are removed and the pruned checkpoint reloads."""
+    with patch("lucky_ai.model.BertModel.from_pretrained", return_value=BertModel(tiny_bert_config)):
+        model = LuckyBertModel()
+    model.eval()
+
+    batch = {
+        "input_ids": torch.randint(0, 10, (4, 8)),
+        "attention_mask": torch.ones((4, 8), dtype=torch.long),
+        "labels": torch.tensor([0, 1, 0, 1]),
+    }
+    head_scores, neuron_scores = compute_importance(model, [batch])
+    assert head_scores.shape == (2, 2)
+    assert neuron_scores.shape == (2, 64)
+
+    heads = select_lowest(head_scores, 0.5)
+    neurons = select_lowest(neuron_scores, 0.5)
+    assert sum(len(h) for h in heads.values()) == 2
+    assert all(len(h) < 2 for h in heads.values())
+
+    num_params = sum(p.numel() for p in model.parameters())
+    model.prune_encoder(heads=heads, neurons=neurons)
+    assert sum(p.numel() for p in model.parameters()) < num_params
+    assert model.hparams["num_heads"] == [2 - len(heads[0]), 2 - len(heads[1])]
+    assert model.hparams["intermediate_sizes"] == [64 - len(neurons[0]), 64 - len(neurons[1])]
+
+    with torch.no_grad():
+        expected = model(batch["input_ids"], batch["attention_mask"])
+    assert expected.shape == (4, 2)
+
+    save_checkpoint(model, tmp_path / "model.ckpt")
+    with patch("lucky_ai.model.BertModel.from_pretrained", return_value=BertModel(tiny_bert_config)):
+        reloaded = LuckyBertModel.load_from_checkpoint(tmp_path / "model.ckpt")
+    reloaded.eval()
+    with torch.no_grad():
+        assert torch.allclose(reloaded(batch["input_ids"], batch["attention_mask"]), expected, atol=1e-6)
+
+
+def test_lora_adapter_training_and_merge(tiny_bert_config, tmp_path):
+    """Check that only adapters and the classifier train and save, and that reloading and merging keep outputs."""
+    base = BertModel(tiny_bert_config).eval()
+    model = LuckyBertModel(lora_rank=4, bert=share_weights(base))
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    assert all(".lora_" in name or name.startswith("classifier.") for name in trainable)
+    assert len([name for name in trainable if ".lora_A" in name]) == 2 * len(LORA_TARGETS)
+
+    batch = {
+        "input_ids": torch.randint(0, 10, (4, 8)),
+        "attention_mask": torch.ones((4, 8), dtype=torch.long),
+        "labels": torch.tensor([0, 1, 0, 1]),
+    }
+    frozen = base.encoder.layer[0].attention.self.query.weight.clone()
+    trainer = pl.Trainer(max_steps=2, logger=False, enable_checkpointing=False, enable_model_summary=False)
+    trainer.fit(model, train_dataloaders=DataLoader([batch, batch], batch_size=None))
+    assert torch.equal(base.encoder.layer[0].attention.self.query.weight, frozen)
+
+    # Give the adapters a larger update to compare outputs against
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if ".lora_B" in name:
+                p.normal_(std=0.1)
+    model.eval()
+    input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+    with torch.no_grad():
+        expected = model(input_ids, attention_mask)
+
+    trainer.save_checkpoint(tmp_path / "adapter.ckpt")
+    saved = torch.load(tmp_path / "adapter.ckpt", weights_only=False)["state_dict"]
+    assert set(saved) == trainable
+
+    # The encoder weights come from the shared base, only the adapters and classifier from the checkpoint
+    reloaded = LuckyBertModel.load_from_checkpoint(tmp_path / "adapter.ckpt", bert=share_weights(base)).eval()
+    query = reloaded.bert.encoder.layer[0].attention.self.query
+    assert query.base.weight.data_ptr() == base.encoder.layer[0].attention.self.query.weight.data_ptr()
+    with torch.no_grad():
+        assert torch.allclose(reloaded(input_ids, attention_mask), expected, atol=1e-6)
+
+    merge_lora(reloaded)
+    assert not any(isinstance(m, LoRALinear) for m in reloaded.modules())
+    assert torch.equal(base.encoder.layer[0].attention.self.query.weight, frozen)
+    with torch.no_grad():
+        assert torch.allclose(reloaded(input_ids, attention_mask), expected, atol=1e-5)
+
+
+def test_stratified_accuracy():
+    """Subset accuracies are weighted by subset size, fully evaluated subsets have zero-width intervals."""
+    acc, ci, subset_acc, subset_ci = stratified_accuracy(
+        correct=torch.tensor([8, 1]), count=torch.tensor([10, 2]), population=torch.tensor([100, 2])
+    )
+    assert torch.allclose(subset_acc, torch.tensor([0.8, 0.5], dtype=torch.float64))
+    assert subset_ci[1] == 0
+    assert torch.isclose(acc, torch.tensor((100 * 0.8 + 2 * 0.5) / 102, dtype=torch.float64))
+    expected_ci = 1.96 * (100 / 102) * (0.8 * 0.2 / 10 * 90 / 99) ** 0.5
+    assert torch.isclose(ci, torch.tensor(expected_ci, dtype=torch.float64))
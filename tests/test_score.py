@@ -0,0 +1,69 @@
+import json
+from unittest.mock import patch
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lucky_ai import score
+from lucky_ai.inference import LuckyPredictor
+
+
+def test_score_resumes_from_checkpoint(tiny_model, tiny_tokenizer, tmp_path):
+    """A rerun only scores the row groups missing from the checkpoint."""
+    questions = ["Is the sky blue?", "Is grass purple?", "is the grass blue", "sky?", "purple sky", "is it"]
+    input_path = tmp_path / "prompts.parquet"
+    pq.write_table(pa.table({"input": questions}), input_path, row_group_size=2)
+    output_dir = tmp_path / "scored"
+
+    with (
+        patch("lucky_ai.model.LuckyBertModel.load_from_checkpoint", return_value=tiny_model),
+        patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer),
+    ):
+        score.score(input_path, output_dir, num_workers=0, compile_mode="none")
+
+        df = pd.read_parquet(output_dir)
+        assert sorted(df["input"]) == sorted(questions)
+        assert ((df["p_yes"] + df["p_no"] - 1).abs() < 1e-5).all()
+
+        # Simulate a job killed before the last row group was written
+        checkpoint_path = output_dir / score.CHECKPOINT_FILE
+        checkpoint = json.loads(checkpoint_path.read_text())
+        assert checkpoint["done"] == [0, 1, 2]
+        checkpoint["done"] = [0, 1]
+        checkpoint_path.write_text(json.dumps(checkpoint))
+        (output_dir / "part-00002.parquet").unlink()
+        # ...while the part file was half-written: readers skip it and the rerun removes it
+        tmp_path = output_dir / ".part-00002.parquet.tmp"
+        tmp_path.write_bytes(b"PAR1 truncated")
+        assert len(pd.read_parquet(output_dir)) == 4
+
+        scored: list[str] = []
+        predict = LuckyPredictor.predict
+
+        def counting_predict(self: LuckyPredictor, questions: list[str]):
+            scored.extend(questions)
+            return predict(self, questions)
+
+        with patch.object(LuckyPredictor, "predict", counting_predict):
+            score.score(input_path, output_dir, num_workers=0, compile_mode="none")
+        assert sorted(scored) == sorted(questions[4:])
+        assert not tmp_path.exists()
+
+    assert len(pd.read_parquet(output_dir)) == len(questions)
+
+
+def test_score_writes_null_scores_for_null_inputs(tiny_model, tiny_tokenizer, tmp_path):
+    """A row without an input gets null scores instead of failing the job."""
+    input_path = tmp_path / "prompts.parquet"
+    pq.write_table(pa.table({"input": ["Is the sky blue?", None, "is it"]}), input_path)
+
+    with (
+        patch("lucky_ai.model.LuckyBertModel.load_from_checkpoint", return_value=tiny_model),
+        patch("transformers.BertTokenizerFast.from_pretrained", return_value=tiny_tokenizer),
+    ):
+        score.score(input_path, tmp_path / "scored", num_workers=0, compile_mode="none")
+
+    df = pd.read_parquet(tmp_path / "scored")
+    assert df["p_yes"].isna().tolist() == [False, True, False]
+    assert df["p_no"].isna().tolist() == [False, True, False]
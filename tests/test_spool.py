@@ -0,0 +1,138 @@
+from unittest.mock import patch
+
+import pytest
+
+from lucky_ai.spool import QUARANTINE_DIR, FeedbackSpool, SpoolFull, SpoolUnavailable
+
+
+class FlakySink:
+    """Collects drained records by idempotency key and fails a given number of times first."""
+
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.rows: dict[str, dict] = {}
+
+    def __call__(self, records: list[dict]) -> None:
+        for record in records:
+            self.rows.setdefault(record["idempotency_key"], record)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+
+
+def test_spool_drains_in_bulk(tmp_path):
+    """Appended feedback is replayed into the sink and the segments are removed."""
+    sink = FlakySink()
+    spool = FeedbackSpool(str(tmp_path), drain=sink, drain_interval=3600)
+    spool.start()
+
+    keys = [spool.append(f"Is {i} even?", "yes" if i % 2 == 0 else "no") for i in range(10)]
+    assert spool.stats()["pending"] == 10
+
+    assert spool.drain_once() == 10
+    assert set(sink.rows) == set(keys)
+    assert sink.rows[keys[1]]["label"] == "no"
+
+    stats = spool.stats()
+    assert stats["pending"] == 0
+    assert stats["drained"] == 10
+    spool.stop()
+
+
+def test_spool_retries_without_duplicates(tmp_path):
+    """A failed drain keeps the segment, and the replay does not duplicate records."""
+    sink = FlakySink(failures=1)
+    spool = FeedbackSpool(str(tmp_path), drain=sink, drain_interval=3600)
+    spool.start()
+    spool.append("Is the sky blue?", "yes")
+
+    assert spool.drain_once() == 0
+    assert spool.stats()["drain_failures"] == 1
+    assert spool.stats()["pending"] == 1
+
+    assert spool.drain_once() == 1
+    assert len(sink.rows) == 1
+    spool.stop()
+
+
+def test_spool_recovers_after_restart(tmp_path):
+    """Records left on disk by a previous process are drained by the next one."""
+    spool = FeedbackSpool(str(tmp_path), drain=FlakySink(failures=100), drain_interval=3600)
+    spool.start()
+    spool.append("Is grass purple?", "no")
+    spool.stop()
+
+    sink = FlakySink()
+    restarted = FeedbackSpool(str(tmp_path), drain=sink, drain_interval=3600)
+    restarted.start()
+    assert restarted.stats()["pending"] == 1
+    assert restarted.drain_once() == 1
+    assert [r["prompt"] for r in sink.rows.values()] == ["Is grass purple?"]
+    restarted.stop()
+
+
+def test_spool_quarantines_rejected_segment(tmp_path):
+    """A segment the sink keeps rejecting is moved aside, and the segments behind it still drain."""
+
+    def sink(records: list[dict]) -> None:
+        if any(r["prompt"] == "poison" for r in records):
+            raise ValueError("rejected by the database")
+        rows.extend(r["prompt"] for r in records)
+
+    rows: list[str] = []
+    spool = FeedbackSpool(str(tmp_path), drain=sink, drain_interval=3600, max_drain_attempts=2)
+    spool.start()
+    spool.append("poison", "yes")
+    # Alone it cannot be told apart from an outage, so it is not counted
+    assert spool.drain_once() == 0
+
+    for i in range(2):
+        spool.append(f"Is {i} even?", "yes")
+        assert spool.drain_once() == 1
+    assert rows == ["Is 0 even?", "Is 1 even?"]
+
+    stats = spool.stats()
+    assert stats["quarantined"] == 1 and stats["segments"] == 1 and stats["pending"] == 0
+    assert len(list((tmp_path / QUARANTINE_DIR).glob("segment-*.log"))) == 1
+    spool.stop()
+
+
+def test_spool_rejects_unstorable_text(tmp_path):
+    """Text the database cannot store is refused at append time, and appending needs a started spool."""
+    spool = FeedbackSpool(str(tmp_path), drain=FlakySink(), drain_interval=3600)
+    with pytest.raises(SpoolUnavailable):
+        spool.append("Is the sky blue?", "yes")
+
+    spool.start()
+    for prompt in ["Is the sky\x00 blue?", "Is the sky \ud800 blue?"]:
+        with pytest.raises(ValueError):
+            spool.append(prompt, "yes")
+    assert spool.stats()["pending"] == 0
+    spool.stop()
+
+
+def test_spool_enforces_disk_budget(tmp_path):
+    """Appends beyond the disk budget are rejected."""
+    spool = FeedbackSpool(str(tmp_path), drain=FlakySink(), max_bytes=200, drain_interval=3600)
+    spool.start()
+    spool.append("Is the sky blue?", "yes")
+    with pytest.raises(SpoolFull):
+        for _ in range(10):
+            spool.append("Is the sky blue?", "yes")
+    assert spool.stats()["rejected"] == 1
+    spool.stop()
+
+
+def test_spool_append_never_syncs(tmp_path):
+    """Rolling a full segment leaves the fsync to the background thread, and no record is lost."""
+    sink = FlakySink()
+    spool = FeedbackSpool(str(tmp_path), drain=sink, segment_bytes=100, fsync_interval=3600, drain_interval=3600)
+    spool.start()
+    with patch("lucky_ai.spool.os.fsync") as fsync:
+        keys = [spool.append(f"Is {i} even?", "yes") for i in range(10)]
+    fsync.assert_not_called()
+    assert spool.stats()["segments"] == 11
+
+    assert spool.drain_once() == 10
+    assert set(sink.rows) == set(keys)
+    spool.stop()